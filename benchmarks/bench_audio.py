@@ -0,0 +1,149 @@
+"""
+Compare the upload size and the encode time of the Whisper audio encodings
+(utils.whisper_utils) with the previous full-rate wav written to a temporary
+file, on browser-like microphone recordings (48 kHz stereo int32).
+
+Also measure `atranscribe_audio_data` end to end against the local mock server
+(answering immediately), and its splitting and encoding alone.
+
+Usage: python benchmarks/bench_audio.py [--seconds 10 --seconds 60]
+"""
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import warnings
+from pathlib import Path
+
+import click
+import numpy as np
+from mock_server import MockConfig, start_mock_server
+from gradio.processing_utils import audio_to_file
+
+sys.path.append(str(Path(__file__).parent.parent / "jet"))
+
+from utils import whisper_utils  # noqa: E402
+from utils.whisper_utils import (  # noqa: E402
+    to_pcm16,
+    encode_audio,
+    encode_audio_data,
+    atranscribe_audio_data,
+)
+
+
+def make_recording(seconds, sr=48000, seed=0):
+    """
+    A speech-like recording: harmonics of a gliding pitch, modulated by syllables
+    and pauses, with some background noise.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    pitch = 150 + 30 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sr
+    voice = sum(np.sin(k * phase) / k for k in range(1, 8))
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None) * (np.sin(t) > -0.5)
+    signal = 0.3 * voice * envelope + 0.01 * rng.standard_normal(len(t))
+    samples = (np.clip(signal, -1, 1) * (2**31 - 1)).astype(np.int32)
+    return sr, np.stack([samples, samples], axis=1)
+
+
+def encode_legacy(sr, data):
+    with tempfile.NamedTemporaryFile(suffix=".wav") as file:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            audio_to_file(sr, data, file.name, format="wav")
+        with open(file.name, "rb") as f:
+            return f.read()
+
+
+def bench_transcribe(seconds):
+    base_url, _ = start_mock_server(
+        MockConfig(transcribe_latency=0.0, transcribe_rtf=0.0)
+    )
+    whisper_utils.OPENAI_WHISPER_API_TYPE = "openai"
+    whisper_utils.OPENAI_WHISPER_API_BASE = base_url + "/v1"
+    whisper_utils.OPENAI_WHISPER_API_KEY = "mock"
+    whisper_utils.OPENAI_WHISPER_MODEL_NAME = "whisper-1"
+
+    async def encode_only(sr, data, prompt=None):
+        await asyncio.to_thread(encode_audio_data, sr, data)
+        return ""
+
+    async def transcribe(sr, data, transcribe_fn):
+        start = time.perf_counter()
+        if transcribe_fn is None:
+            await atranscribe_audio_data(sr, data, use_cache=False)
+        else:
+            await atranscribe_audio_data(
+                sr, data, transcribe_fn=transcribe_fn, use_cache=False
+            )
+        elapsed = time.perf_counter() - start
+        await whisper_utils.get_aiohttp_session().close()
+        return elapsed
+
+    results = []
+    for duration in seconds:
+        sr, data = make_recording(duration)
+        encode_time = asyncio.run(transcribe(sr, data, encode_only))
+        total_time = asyncio.run(transcribe(sr, data, None))
+        results.append(
+            {
+                "name": "audio.transcribe_audio_data",
+                "seconds": duration,
+                "format": whisper_utils.get_audio_format(),
+                "split_encode_ms": encode_time * 1000,
+                "total_ms": total_time * 1000,
+            }
+        )
+    return results
+
+
+def run(seconds=(10, 60), repeat=3):
+    formats = ["wav"]
+    if whisper_utils.soundfile is not None:
+        formats += ["flac", "opus"]
+
+    results = []
+    for duration in seconds:
+        sr, data = make_recording(duration)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            blob = encode_legacy(sr, data)
+        results.append(
+            {
+                "name": "audio.legacy_wav_tempfile",
+                "seconds": duration,
+                "upload_bytes": len(blob),
+                "encode_ms": (time.perf_counter() - start) / repeat * 1000,
+            }
+        )
+
+        for audio_format in formats:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                pcm_start = time.perf_counter()
+                pcm_sr, samples = to_pcm16(sr, data)
+                pcm_time = time.perf_counter() - pcm_start
+                file = encode_audio(pcm_sr, samples, audio_format)
+            results.append(
+                {
+                    "name": f"audio.{audio_format}_{pcm_sr // 1000}k_mono",
+                    "seconds": duration,
+                    "upload_bytes": len(file.getvalue()),
+                    "encode_ms": (time.perf_counter() - start) / repeat * 1000,
+                    "pcm_ms": pcm_time * 1000,
+                }
+            )
+    return results + bench_transcribe(seconds)
+
+
+@click.command()
+@click.option("--seconds", multiple=True, type=float, default=[10, 60])
+def main(seconds):
+    print(json.dumps(run(seconds), indent=2))
+
+
+if __name__ == "__main__":
+    main()
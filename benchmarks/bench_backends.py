@@ -0,0 +1,207 @@
+"""
+Write and read the same user state from several processes at once (as the
+workers of `jet/launch.py`), with each backend of the user states: the SQLite
+state db (with its memory cache) and redis (the local stand-in kv_server.py,
+with --latency seconds per command).
+
+Each process loops: write all --keys keys of a user in one `set_many` (every
+other loop), with its id and the loop index, then read them. Report the
+throughput (loops per second), and check the consistency guarantees of
+`utils.db_utils.StateBackend`:
+- torn reads: a read returns keys from different writes (`set_many` is atomic)
+- stale reads: a read returns a write when another write, started after it was
+  done, was done before the read started (no cache serves outdated values)
+Exit with status 1 if the check fails.
+
+Usage: python benchmarks/bench_backends.py [--processes 2 --latency 0.0005]
+"""
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+import multiprocessing
+from pathlib import Path
+
+import click
+
+BENCHMARKS_DIR = Path(__file__).parent
+sys.path.append(str(BENCHMARKS_DIR.parent / "jet"))
+
+from utils.db_utils import StateStore  # noqa: E402
+from utils.kv_utils import RedisStateStore  # noqa: E402
+
+CACHE_BYTES = 64 * 1024 * 1024
+
+
+def start_kv_server(latency):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            str(BENCHMARKS_DIR / "kv_server.py"),
+            f"--port={port}",
+            f"--latency={latency}",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return process, f"redis://127.0.0.1:{port}/0"
+
+
+def make_backend(backend, location):
+    if backend == "sqlite":
+        return StateStore(location, cache_bytes=CACHE_BYTES)
+    return RedisStateStore(location, prefix="bench:")
+
+
+def is_stale(value, done_writes):
+    """
+    Whether `value`, read after the `done_writes` (process id -> loop index,
+    start and end time of its last done write) is outdated.
+    """
+    writer, index, _ = value
+    last_index, _, end = done_writes[writer]
+    if index < last_index:
+        return True
+    return index == last_index and any(
+        other_start > end
+        for other, (_, other_start, _) in enumerate(done_writes)
+        if other != writer
+    )
+
+
+def run_process(
+    backend, location, process_id, num_ops, num_keys, start, done_writes, results
+):
+    store = make_backend(backend, location)
+    keys = [f"user::key{j}" for j in range(num_keys)]
+    torn_reads = stale_reads = 0
+
+    while time.time() < start:  # start all the processes together
+        time.sleep(0.001)
+    begin = time.perf_counter()
+    for i in range(num_ops):
+        if i % 2 == 0:
+            write_start = time.monotonic()
+            store.set_many({key: [process_id, i, write_start] for key in keys})
+            write_end = time.monotonic()
+        with done_writes.get_lock():
+            if i % 2 == 0:
+                done_writes[process_id * 3 : process_id * 3 + 3] = [
+                    i,
+                    write_start,
+                    write_end,
+                ]
+            snapshot = [
+                tuple(done_writes[p : p + 3]) for p in range(0, len(done_writes), 3)
+            ]
+        values = store.get_many(keys)
+        if len({tuple(value) for value in values.values()}) > 1:
+            torn_reads += 1
+        elif is_stale(values[keys[0]], snapshot):
+            stale_reads += 1
+    seconds = time.perf_counter() - begin
+    store.close()
+    results.put((num_ops / seconds, torn_reads, stale_reads))
+
+
+def bench_backend(backend, location, num_processes, num_ops, num_keys):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    # (loop index, start, end) of the last done write of each process
+    done_writes = context.Array("d", [-1.0, 0.0, 0.0] * num_processes)
+    start = time.time() + 2
+    processes = [
+        context.Process(
+            target=run_process,
+            args=(
+                backend,
+                location,
+                p,
+                num_ops,
+                num_keys,
+                start,
+                done_writes,
+                results,
+            ),
+        )
+        for p in range(num_processes)
+    ]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return {
+        "name": "backends.concurrent",
+        "backend": backend,
+        "processes": num_processes,
+        "ops": num_ops,
+        "keys": num_keys,
+        "ops_per_sec": sum(ops_per_sec for ops_per_sec, _, _ in outcomes),
+        "torn_reads": sum(torn for _, torn, _ in outcomes),
+        "stale_reads": sum(stale for _, _, stale in outcomes),
+    }
+
+
+def run(backends=("sqlite", "redis"), processes=(1, 2), ops=2000, keys=10, latency=0.0):
+    results = []
+    for backend in backends:
+        for num_processes in processes:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                kv_process = None
+                if backend == "sqlite":
+                    location = str(Path(tmpdir) / "bench.sqlite")
+                else:
+                    kv_process, location = start_kv_server(latency)
+                try:
+                    results.append(
+                        bench_backend(backend, location, num_processes, ops, keys)
+                    )
+                finally:
+                    if kv_process is not None:
+                        kv_process.terminate()
+                        kv_process.wait()
+    return results
+
+
+@click.command()
+@click.option(
+    "--backend",
+    "backends",
+    multiple=True,
+    type=click.Choice(["sqlite", "redis"]),
+    default=["sqlite", "redis"],
+)
+@click.option("--processes", multiple=True, type=int, default=[1, 2])
+@click.option("--ops", default=2000, help="Loops of each process.")
+@click.option("--keys", default=10, help="Keys written at once.")
+@click.option("--latency", default=0.0, help="Seconds per command of the kv server.")
+@click.option("--check/--no-check", default=True)
+def main(backends, processes, ops, keys, latency, check):
+    results = run(backends, processes, ops, keys, latency)
+    print(json.dumps(results, indent=2))
+    if check:
+        failures = [
+            f"{result['backend']} with {result['processes']} processes: "
+            f"{result['torn_reads']} torn reads, {result['stale_reads']} stale reads"
+            for result in results
+            if result["torn_reads"] or result["stale_reads"]
+        ]
+        for failure in failures:
+            print(f"FAILED: {failure}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Measure the client side overhead of the chat: the CPU time per streamed token of
+`agenerate_new_text` (api client, routing, callbacks and coalescing) against the
+local mock server, and `make_langchain_history` on long histories.
+
+The CPU time is the one of the thread running the event loop, the mock server runs
+in its own thread.
+
+Usage: python benchmarks/bench_chat.py [--num-tokens 2000 --tokens-per-sec 1000]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+from pathlib import Path
+
+import click
+from mock_server import MockConfig, start_mock_server
+
+sys.path.append(str(Path(__file__).parent.parent / "jet"))
+
+MODEL_NAME = "mock-model"
+
+
+def setup_mock_api(config):
+    """
+    Start the mock server and point the chat api at it, before importing the app.
+    """
+    base_url, config = start_mock_server(config)
+    os.environ.update(
+        {
+            "OPENAI_API_TYPE": "openai",
+            "OPENAI_API_BASE": base_url + "/v1",
+            "OPENAI_API_KEY": "mock",
+            "OPENAI_MODEL_NAME": MODEL_NAME,
+            "OPENAI_ALLOWED_MODELS": MODEL_NAME,
+            "OPENAI_RATE_LIMITS": "",
+        }
+    )
+    return base_url, config
+
+
+async def stream_reply(stream_interval, num_tokens):
+    from utils import chat_utils
+
+    history = [["new question", None]]
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    ttft = None
+    num_yields = 0
+    async for _ in chat_utils.agenerate_new_text(
+        message=None,
+        history=history,
+        return_history=True,
+        model_name=MODEL_NAME,
+        max_tokens=num_tokens,
+        stream_interval=stream_interval,
+    ):
+        if ttft is None:
+            ttft = time.perf_counter() - start
+        num_yields += 1
+    return {
+        "ttft_sec": ttft,
+        "wall_sec": time.perf_counter() - start,
+        "cpu_sec": time.thread_time() - cpu_start,
+        "num_yields": num_yields,
+    }
+
+
+def bench_agenerate_new_text(num_tokens, tokens_per_sec, intervals=(0.0, 0.05)):
+    config = MockConfig(
+        tokens_per_sec=tokens_per_sec, latency=0.0, num_tokens=num_tokens
+    )
+    setup_mock_api(config)
+
+    async def run_all():
+        from utils import chat_utils
+
+        results = []
+        await stream_reply(0.05, 10)  # warm up the client and the connection
+        for interval in intervals:
+            result = await stream_reply(interval, num_tokens)
+            results.append(
+                {
+                    "name": "chat.agenerate_new_text",
+                    "stream_interval": interval,
+                    "num_tokens": num_tokens,
+                    "mock_rate": tokens_per_sec,
+                    "cpu_us_per_token": result["cpu_sec"] / num_tokens * 1e6,
+                    **result,
+                }
+            )
+        await chat_utils.get_aiohttp_session().close()
+        return results
+
+    return asyncio.run(run_all())
+
+
+def bench_make_langchain_history(sizes):
+    from utils.chat_utils import make_langchain_history
+
+    results = []
+    for size in sizes:
+        history = [["question " * 50, "answer " * 200] for _ in range(size)]
+        repeat = max(1, 100_000 // size)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            make_langchain_history(history, message="hi", system_message="system")
+        elapsed = (time.perf_counter() - start) / repeat
+        results.append(
+            {
+                "name": "chat.make_langchain_history",
+                "history_size": size,
+                "ms": elapsed * 1000,
+                "us_per_message": elapsed / (2 * size) * 1e6,
+            }
+        )
+    return results
+
+
+def run(num_tokens=2000, tokens_per_sec=1000, history_sizes=(100, 1000, 10000)):
+    return bench_agenerate_new_text(
+        num_tokens, tokens_per_sec
+    ) + bench_make_langchain_history(history_sizes)
+
+
+@click.command()
+@click.option("--num-tokens", default=2000)
+@click.option("--tokens-per-sec", default=1000.0)
+@click.option("--history-size", multiple=True, type=int, default=[100, 1000, 10000])
+def main(num_tokens, tokens_per_sec, history_size):
+    print(json.dumps(run(num_tokens, tokens_per_sec, history_size), indent=2))
+
+
+if __name__ == "__main__":
+    main()
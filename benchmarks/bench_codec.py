@@ -0,0 +1,104 @@
+"""
+Compare the db size and the encode / decode time of the state value codecs on
+realistic chat histories (Markdown and LaTeX, thousands of messages).
+
+Usage: python benchmarks/bench_codec.py [--num-messages 2000 --num-messages 5000]
+"""
+import sys
+import json
+import time
+import random
+import tempfile
+from pathlib import Path
+
+import click
+
+sys.path.append(str(Path(__file__).parent.parent / "jet"))
+
+from utils import db_utils  # noqa: E402
+from utils.db_utils import Codec, StateStore  # noqa: E402
+
+WORDS = (
+    "the of model token latency cache request stream user history prompt "
+    "gradient matrix vector function python server queue answer question"
+).split()
+SNIPPETS = [
+    "$$\\int_0^1 x^2 \\, dx = \\frac{1}{3}$$",
+    "$e^{i\\pi} + 1 = 0$",
+    "```python\nfor i in range(10):\n    print(i)\n```",
+    "| a | b |\n|---|---|\n| 1 | 2 |",
+    "- first item\n- second item",
+    "**Note:** see the documentation.",
+]
+
+
+def make_history(num_messages, seed=0):
+    rng = random.Random(seed)
+
+    def make_text(num_words):
+        words = [rng.choice(WORDS) for _ in range(num_words)]
+        snippets = rng.sample(SNIPPETS, k=2)
+        return " ".join(words) + "\n\n" + "\n\n".join(snippets)
+
+    return [[make_text(20), make_text(150)] for _ in range(num_messages // 2)]
+
+
+def get_codecs():
+    codecs = {"pickle (SqliteDict)": Codec("pickle", "none")}
+    for serializer in ["json", "msgpack"]:
+        for compression in ["none", "zlib", "zstd"]:
+            if serializer == "msgpack" and db_utils.msgpack is None:
+                continue
+            if compression == "zstd" and db_utils.zstandard is None:
+                continue
+            codecs[f"{serializer}+{compression}"] = Codec(serializer, compression)
+    return codecs
+
+
+def run(num_messages=(2000, 5000), num_histories=20, repeat=5):
+    results = []
+    for n in num_messages:
+        history = make_history(n)
+        for name, codec in get_codecs().items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                blob = codec.encode(history)
+            encode_time = (time.perf_counter() - start) / repeat
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                codec.decode(blob)
+            decode_time = (time.perf_counter() - start) / repeat
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = Path(tmpdir) / "bench.sqlite"
+                store = StateStore(path, codec=codec)
+                for i in range(num_histories):
+                    store.set_many({f"user{i}::chat-chatbot": make_history(n, i)})
+                store.connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                store.close()
+                db_size = path.stat().st_size
+
+            results.append(
+                {
+                    "name": f"codec.{name}",
+                    "num_messages": n,
+                    "value_bytes": len(blob),
+                    "encode_ms": encode_time * 1000,
+                    "decode_ms": decode_time * 1000,
+                    "db_bytes": db_size,
+                    "num_histories": num_histories,
+                }
+            )
+    return results
+
+
+@click.command()
+@click.option("--num-messages", multiple=True, type=int, default=[2000, 5000])
+@click.option("--num-histories", default=20, help="Histories stored in the db.")
+def main(num_messages, num_histories):
+    print(json.dumps(run(num_messages, num_histories), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Compare opening a `SqliteDict` per call (the old `db_utils.get_db()` pattern) with
+the long-lived, pooled `StateStore`, and measure the throughput of
+`read_user_state` / `update_user_state` from several threads (as gradio's workers),
+with and without the memory cache.
+
+Usage: python benchmarks/bench_db.py [--ops 1000 --ops 10000 --threads 8]
+"""
+import sys
+import json
+import time
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from sqlitedict import SqliteDict
+
+sys.path.append(str(Path(__file__).parent.parent / "jet"))
+
+from utils import db_utils  # noqa: E402
+from utils.db_utils import Codec, StateStore  # noqa: E402
+
+VALUE = [["How are you?", "I am fine, thank you. " * 20]] * 4
+
+
+def bench_per_call(path, num_ops):
+    start = time.perf_counter()
+    for i in range(num_ops):
+        db = SqliteDict(path, autocommit=False, flag="c")
+        db[f"user::key{i % 100}"] = VALUE
+        db.commit()
+        db.close()
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(num_ops):
+        db = SqliteDict(path, autocommit=False, flag="c")
+        db.get(f"user::key{i % 100}")
+        db.close()
+    read_time = time.perf_counter() - start
+    return write_time, read_time
+
+
+def bench_pooled(path, num_ops):
+    store = StateStore(path)
+
+    start = time.perf_counter()
+    for i in range(num_ops):
+        store.set_many({f"user::key{i % 100}": VALUE})
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(num_ops):
+        store.get_many([f"user::key{i % 100}"])
+    read_time = time.perf_counter() - start
+
+    store.close()
+    return write_time, read_time
+
+
+def bench_user_state(path, num_ops, num_threads, cache_bytes):
+    codec = Codec(db_utils.DB_CODEC, db_utils.DB_COMPRESSION)
+    db_utils._STORE = StateStore(path, cache_bytes=cache_bytes, codec=codec)
+
+    def run_ops(fn):
+        ops_per_thread = num_ops // num_threads
+        start = time.perf_counter()
+        with ThreadPoolExecutor(num_threads) as executor:
+            futures = [
+                executor.submit(fn, t, ops_per_thread) for t in range(num_threads)
+            ]
+            for future in futures:
+                future.result()
+        return ops_per_thread * num_threads / (time.perf_counter() - start)
+
+    def write(t, n):
+        for i in range(n):
+            db_utils.update_user_state(f"user{t}", f"key{i % 100}", VALUE)
+
+    def read(t, n):
+        for i in range(n):
+            db_utils.read_user_state(f"user{t}", f"key{i % 100}")
+
+    write_ops_per_sec = run_ops(write)
+    read_ops_per_sec = run_ops(read)
+    db_utils._STORE.close()
+    db_utils._STORE = None
+    return write_ops_per_sec, read_ops_per_sec
+
+
+def run(ops=(1000, 10000), threads=(1, 8)):
+    results = []
+    for num_ops in ops:
+        for name, fn in [("per_call", bench_per_call), ("pooled", bench_pooled)]:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                write_time, read_time = fn(str(Path(tmpdir) / "bench.sqlite"), num_ops)
+            results.append(
+                {
+                    "name": f"db.{name}",
+                    "ops": num_ops,
+                    "write_ops_per_sec": num_ops / write_time,
+                    "read_ops_per_sec": num_ops / read_time,
+                }
+            )
+
+    for num_ops in ops:
+        for num_threads in threads:
+            for cache_bytes in [db_utils.DB_CACHE_BYTES, 0]:
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    path = str(Path(tmpdir) / "bench.sqlite")
+                    write_ops_per_sec, read_ops_per_sec = bench_user_state(
+                        path, num_ops, num_threads, cache_bytes
+                    )
+                results.append(
+                    {
+                        "name": "db.user_state",
+                        "ops": num_ops,
+                        "threads": num_threads,
+                        "cache": cache_bytes > 0,
+                        "write_ops_per_sec": write_ops_per_sec,
+                        "read_ops_per_sec": read_ops_per_sec,
+                    }
+                )
+    return results
+
+
+@click.command()
+@click.option("--ops", multiple=True, type=int, default=[1000, 10000])
+@click.option("--threads", multiple=True, type=int, default=[1, 8])
+def main(ops, threads):
+    print(json.dumps(run(ops, threads), indent=2))
+
+
+if __name__ == "__main__":
+    main()
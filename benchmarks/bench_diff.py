@@ -0,0 +1,137 @@
+"""
+Compare the word / character level diff of the writing tab (utils.diff_utils) with
+the previous difflib.Differ based implementation, on texts from 1 KB to 200 KB
+where a fraction of the words have been corrected.
+
+Usage: python benchmarks/bench_diff.py [--size 1000 --size 200000 --edit-rate 0.05]
+"""
+import re
+import sys
+import json
+import time
+import random
+import difflib
+from pathlib import Path
+
+import click
+
+sys.path.append(str(Path(__file__).parent.parent / "jet"))
+
+from utils.diff_utils import diff_texts  # noqa: E402
+
+
+def difflib_diff_texts(text1, text2, word_level=True):
+    d = difflib.Differ()
+
+    if word_level:
+        comp_results = d.compare(re.split(r"(\s+)", text1), re.split(r"(\s+)", text2))
+    else:
+        comp_results = d.compare(text1, text2)
+
+    ret_old = []
+    ret_new = []
+    for line in comp_results:
+        if line[0] in ("+", "-"):
+            ret = ret_new if line[0] == "+" else ret_old
+            ret.append((line[2:], line[0]))
+            if line[2:] == "\n":
+                ret.append((line[2:], line[0]))
+        elif line[0] == " ":
+            ret_new.append((line[2:], None))
+            ret_old.append((line[2:], None))
+
+    return ret_old, ret_new
+
+
+def make_texts(size, edit_rate, seed=0):
+    """
+    A text of about `size` characters (Zipf distributed words, sentences and
+    paragraphs), and a copy with a fraction `edit_rate` of its words replaced,
+    inserted or deleted.
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" if i > 50 else f"w{i}" for i in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+    words = []
+    length = 0
+    while length < size:
+        sentence = rng.choices(vocabulary, weights, k=rng.randint(5, 20))
+        words.extend(sentence[:-1])
+        words.append(sentence[-1] + ("." if rng.random() < 0.8 else ".\n\n"))
+        length += sum(len(word) + 1 for word in sentence)
+
+    edited = []
+    for word in words:
+        r = rng.random()
+        if r < edit_rate / 3:  # replaced
+            edited.append(rng.choices(vocabulary, weights)[0])
+        elif r < edit_rate * 2 / 3:  # inserted
+            edited.extend([word, rng.choices(vocabulary, weights)[0]])
+        elif r >= edit_rate:  # else deleted
+            edited.append(word)
+    return " ".join(words), " ".join(edited)
+
+
+def run(
+    sizes=(500, 1000, 10000, 50000, 200000),
+    edit_rate=0.05,
+    difflib_max_size=20000,
+    difflib_char_max_size=500,
+):
+    implementations = {"diff_utils": diff_texts, "difflib": difflib_diff_texts}
+
+    results = []
+    for size in sizes:
+        text1, text2 = make_texts(size, edit_rate)
+        for name, fn in implementations.items():
+            for word_level in [True, False]:
+                max_size = difflib_max_size if word_level else difflib_char_max_size
+                if name == "difflib" and size > max_size:
+                    continue
+                repeat = max(1, 20000 // size)
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    ret_old, ret_new = fn(text1, text2, word_level)
+                elapsed = (time.perf_counter() - start) / repeat
+
+                results.append(
+                    {
+                        "name": f"diff.{name}.{'word' if word_level else 'char'}",
+                        "size": len(text1),
+                        "edit_rate": edit_rate,
+                        "ms": elapsed * 1000,
+                        "spans": len(ret_old) + len(ret_new),
+                        "changed": sum(1 for _, label in ret_old + ret_new if label),
+                    }
+                )
+    return results
+
+
+@click.command()
+@click.option(
+    "--size",
+    "sizes",
+    multiple=True,
+    type=int,
+    default=[500, 1000, 10000, 50000, 200000],
+)
+@click.option("--edit-rate", default=0.05, help="Fraction of the words edited.")
+@click.option(
+    "--difflib-max-size",
+    default=20000,
+    help="Skip the word level difflib diff above this size (it is quadratic).",
+)
+@click.option(
+    "--difflib-char-max-size",
+    default=500,
+    help="Skip the character level difflib diff above this size (it takes minutes "
+    "on 1 KB texts).",
+)
+def main(sizes, edit_rate, difflib_max_size, difflib_char_max_size):
+    results = run(sizes, edit_rate, difflib_max_size, difflib_char_max_size)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Measure the import time of the modules of the app, each in a fresh interpreter
+(the best of --repeat runs), and check that importing `utils.chat_utils` stays
+fast: under --max-import-sec, and without importing langchain, openai or gradio,
+which are imported on first use. Exit with status 1 if the check fails.
+
+For the time of the construction of the app, run `python jet/web.py
+--profile-startup`.
+
+Usage: python benchmarks/bench_startup.py [--repeat 5 --max-import-sec 1.0]
+"""
+import sys
+import json
+import subprocess
+from pathlib import Path
+
+import click
+
+JET_DIR = Path(__file__).parent.parent / "jet"
+
+MODULES = [
+    "utils.chat_utils",
+    "utils.whisper_utils",
+    "utils.writing_utils",
+    "tabs",
+    "gradio",  # for reference, imported by the app anyway
+]
+# imported on first use only, see `utils.chat_utils`
+LAZY_MODULES = ["langchain", "openai", "gradio"]
+
+IMPORT_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+lazy = [name for name in {lazy_modules!r} if name in sys.modules]
+print(json.dumps({{"seconds": seconds, "lazy_imported": lazy}}))
+"""
+
+
+def measure_import(module, repeat=3):
+    """
+    Return the best import time of the module in seconds, and the modules of
+    LAZY_MODULES it imported.
+    """
+    script = IMPORT_SCRIPT.format(module=module, lazy_modules=LAZY_MODULES)
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", script],
+            cwd=JET_DIR,
+            text=True,
+            stderr=subprocess.DEVNULL,
+        )
+        runs.append(json.loads(output.splitlines()[-1]))
+    return min(run["seconds"] for run in runs), runs[0]["lazy_imported"]
+
+
+def run(modules=MODULES, repeat=3):
+    results = []
+    lazy_imported = {}
+    for module in modules:
+        seconds, lazy_imported[module] = measure_import(module, repeat)
+        results.append(
+            {"name": "startup.import", "module": module, "ms": seconds * 1000}
+        )
+    return results, lazy_imported
+
+
+def check_chat_utils(results, lazy_imported, max_import_sec):
+    """
+    Return the failures of the import of `utils.chat_utils`.
+    """
+    failures = []
+    for result in results:
+        if result["module"] == "utils.chat_utils":
+            if result["ms"] > max_import_sec * 1000:
+                failures.append(
+                    f"importing utils.chat_utils took {result['ms']:.0f} ms, "
+                    f"more than {max_import_sec} s"
+                )
+    if lazy_imported.get("utils.chat_utils"):
+        failures.append(
+            "importing utils.chat_utils imported "
+            + ", ".join(lazy_imported["utils.chat_utils"])
+        )
+    return failures
+
+
+@click.command()
+@click.option("--module", "modules", multiple=True, default=MODULES)
+@click.option("--repeat", default=3, help="Runs of each import, the best is kept.")
+@click.option(
+    "--max-import-sec",
+    default=1.0,
+    help="The upper bound of the import time of utils.chat_utils.",
+)
+@click.option("--check/--no-check", default=True)
+def main(modules, repeat, max_import_sec, check):
+    modules = list(modules)
+    if check and "utils.chat_utils" not in modules:
+        modules.insert(0, "utils.chat_utils")
+    results, lazy_imported = run(modules, repeat)
+    print(json.dumps(results, indent=2))
+    if check:
+        failures = check_chat_utils(results, lazy_imported, max_import_sec)
+        for failure in failures:
+            print(f"FAILED: {failure}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
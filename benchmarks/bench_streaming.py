@@ -0,0 +1,86 @@
+"""
+Measure the bytes sent to the browser and the server CPU time per streamed reply
+of `agenerate_new_text`, when every token is sent and when tokens are coalesced.
+
+The chat client is replaced with a fake one which emits tokens at a fixed rate,
+each yielded history is serialized as gradio would send it.
+
+Usage: python benchmarks/bench_streaming.py [--num-tokens 1000 --tokens-per-sec 100]
+"""
+import sys
+import json
+import time
+import asyncio
+from pathlib import Path
+
+import click
+
+sys.path.append(str(Path(__file__).parent.parent / "jet"))
+
+from utils import chat_utils  # noqa: E402
+
+
+class FakeChat:
+    def __init__(self, num_tokens, tokens_per_sec):
+        self.num_tokens = num_tokens
+        self.tokens_per_sec = tokens_per_sec
+
+    async def agenerate(self, messages, callbacks, **kwargs):
+        handler = callbacks[0]
+        for i in range(self.num_tokens):
+            await handler.on_llm_new_token(f"token{i} ")
+            await asyncio.sleep(1 / self.tokens_per_sec)
+
+
+async def stream_reply(history_size, stream_interval):
+    history = [["question " * 50, "answer " * 200] for _ in range(history_size)]
+    history.append(["new question", None])
+
+    num_yields = 0
+    num_bytes = 0
+    async for history in chat_utils.agenerate_new_text(
+        message=None,
+        history=history,
+        return_history=True,
+        stream_interval=stream_interval,
+    ):
+        num_yields += 1
+        num_bytes += len(json.dumps(history))
+    return num_yields, num_bytes
+
+
+def run(num_tokens=1000, tokens_per_sec=200, history_size=20, intervals=(0.0, 0.05)):
+    fake_chat = FakeChat(num_tokens, tokens_per_sec)
+    chat_utils.get_chat = lambda **kwargs: fake_chat
+    chat_utils.get_aiohttp_session = lambda: None
+
+    results = []
+    for interval in intervals:
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        num_yields, num_bytes = asyncio.run(stream_reply(history_size, interval))
+        results.append(
+            {
+                "name": "streaming.agenerate_new_text",
+                "stream_interval": interval,
+                "num_tokens": num_tokens,
+                "history_size": history_size,
+                "num_yields": num_yields,
+                "bytes_sent": num_bytes,
+                "cpu_sec": time.process_time() - cpu_start,
+                "wall_sec": time.perf_counter() - start,
+            }
+        )
+    return results
+
+
+@click.command()
+@click.option("--num-tokens", default=1000)
+@click.option("--tokens-per-sec", default=200)
+@click.option("--history-size", default=20, help="Number of previous messages.")
+def main(num_tokens, tokens_per_sec, history_size):
+    print(json.dumps(run(num_tokens, tokens_per_sec, history_size), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Compare two reports of benchmarks/run_all.py, e.g. of a branch and of main.
+
+The results are matched by suite, name and parameters. The metrics are the numeric
+fields of the results named "ms", "*_sec", "*_ms", "*_per_sec", "*_per_token",
+"*_per_message" or "*_bytes", and a few counts (see OUTPUT_KEYS); "*_per_sec" are
+better when higher, the others when lower.
+
+Usage: python benchmarks/compare.py old.json new.json [--threshold 0.1]
+"""
+import sys
+import json
+
+import click
+
+METRIC_SUFFIXES = ("_sec", "_ms", "_per_token", "_per_message", "_bytes")
+HIGHER_IS_BETTER_SUFFIXES = ("_per_sec",)
+# measured fields without a unit suffix
+OUTPUT_KEYS = {"ms", "num_yields", "bytes_sent", "spans", "changed"}
+
+
+def is_metric(key, value):
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return False
+    return key in OUTPUT_KEYS or key.endswith(
+        METRIC_SUFFIXES + HIGHER_IS_BETTER_SUFFIXES
+    )
+
+
+def index_results(report):
+    """
+    Return a dict (suite, name, parameters) -> metrics.
+    """
+    index = {}
+    for suite, results in report["suites"].items():
+        for result in results:
+            params = tuple(
+                (key, value)
+                for key, value in result.items()
+                if not is_metric(key, value) and key != "name"
+            )
+            metrics = {
+                key: value for key, value in result.items() if is_metric(key, value)
+            }
+            index[(suite, result["name"], params)] = metrics
+    return index
+
+
+def compare(old_report, new_report, threshold=0.1):
+    """
+    Return the list of (key, metric, old, new, relative change, regression).
+    """
+    old_index = index_results(old_report)
+    new_index = index_results(new_report)
+    rows = []
+    for key, new_metrics in new_index.items():
+        old_metrics = old_index.get(key, {})
+        for metric, new in new_metrics.items():
+            old = old_metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if metric.endswith(HIGHER_IS_BETTER_SUFFIXES):
+                regression = change < -threshold
+            else:
+                regression = change > threshold
+            rows.append((key, metric, old, new, change, regression))
+    return rows
+
+
+def format_key(key):
+    suite, name, params = key
+    params = " ".join(f"{k}={v}" for k, v in params)
+    return f"{name} {params}".strip()
+
+
+@click.command()
+@click.argument("old", type=click.File())
+@click.argument("new", type=click.File())
+@click.option("--threshold", default=0.1, help="Relative change to report.")
+def main(old, new, threshold):
+    old_report, new_report = json.load(old), json.load(new)
+    print(f"old: {old_report['commit']}  new: {new_report['commit']}")
+    rows = compare(old_report, new_report, threshold)
+    regressions = 0
+    for key, metric, old_value, new_value, change, regression in rows:
+        if abs(change) < threshold:
+            continue
+        regressions += regression
+        flag = "REGRESSION" if regression else "improvement"
+        print(
+            f"{flag:11}  {format_key(key)}  {metric}: "
+            f"{old_value:.4g} -> {new_value:.4g} ({change:+.0%})"
+        )
+    print(f"{len(rows)} metrics compared, {regressions} regressions")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
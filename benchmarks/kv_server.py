@@ -0,0 +1,124 @@
+"""
+A local stand-in for a redis server, to run the app (and benchmark it) with
+DB_BACKEND=redis without installing redis. It keeps the keys in memory and
+implements the few commands of `utils.kv_utils` (PING, AUTH, SELECT, GET, SET,
+MGET, MSET, DEL, EXISTS, DBSIZE, FLUSHDB), each answered after `--latency`
+seconds, as the round trip to a remote server. Each command runs at once on the
+event loop, so MSET is atomic as in redis.
+
+Usage: python benchmarks/kv_server.py [--port 6399 --latency 0.0005]
+
+then point the app at it, e.g. DB_BACKEND=redis DB_REDIS_URL=redis://127.0.0.1:6399
+"""
+import asyncio
+
+import click
+
+
+class KVServer:
+    def __init__(self, latency=0.0, password=None):
+        self.latency = latency
+        self.password = password
+        self.dbs = {}  # db index -> {key: value}
+        self.commands = 0
+
+    async def read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):  # inline command, e.g. from telnet
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    @staticmethod
+    def encode(reply):
+        if reply is None:
+            return b"$-1\r\n"
+        elif isinstance(reply, Exception):
+            return b"-ERR %s\r\n" % str(reply).encode()
+        elif isinstance(reply, str):
+            return b"+%s\r\n" % reply.encode()
+        elif isinstance(reply, int):
+            return b":%d\r\n" % reply
+        elif isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        return b"*%d\r\n" % len(reply) + b"".join(map(KVServer.encode, reply))
+
+    def execute(self, state, name, args):
+        db = self.dbs.setdefault(state["db"], {})
+        if name == "AUTH":
+            state["authenticated"] = args[-1].decode() == self.password
+            return "OK" if state["authenticated"] else ValueError("invalid password")
+        elif not state["authenticated"]:
+            return ValueError("NOAUTH authentication required")
+        elif name == "PING":
+            return "PONG"
+        elif name == "SELECT":
+            state["db"] = int(args[0])
+            return "OK"
+        elif name == "GET":
+            return db.get(args[0])
+        elif name == "SET":
+            db[args[0]] = args[1]
+            return "OK"
+        elif name == "MGET":
+            return [db.get(key) for key in args]
+        elif name == "MSET":
+            if not args or len(args) % 2:
+                return ValueError("wrong number of arguments for 'mset' command")
+            db.update(zip(args[::2], args[1::2]))
+            return "OK"
+        elif name == "DEL":
+            return sum(db.pop(key, None) is not None for key in args)
+        elif name == "EXISTS":
+            return sum(key in db for key in args)
+        elif name == "DBSIZE":
+            return len(db)
+        elif name == "FLUSHDB":
+            db.clear()
+            return "OK"
+        return ValueError(f"unknown command '{name}'")
+
+    async def handle(self, reader, writer):
+        state = {"db": 0, "authenticated": self.password is None}
+        try:
+            while True:
+                args = await self.read_command(reader)
+                if not args:
+                    break
+                name = args[0].decode().upper()
+                if name == "QUIT":
+                    writer.write(self.encode("OK"))
+                    break
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                self.commands += 1
+                writer.write(self.encode(self.execute(state, name, args[1:])))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=6399)
+@click.option("--latency", default=0.0, help="Seconds before each reply.")
+@click.option("--password", default=None, help="Require AUTH with this password.")
+def main(host, port, latency, password):
+    print(f"kv server on redis://{host}:{port}", flush=True)
+    asyncio.run(KVServer(latency, password).serve(host, port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,671 @@
+"""
+Load test the app end to end: launch `jet/web.py` against the local mock server
+(see mock_server.py), and drive simulated users through gradio's queue api (as the
+browser does) while the number of concurrent users ramps up.
+
+Each user logs in with their own account and loops over actions, with a random
+think time between them: a chat message in one of its --conversations
+conversations (switching to it or starting it first, then the write of the
+conversation, as the page does), a correction in the writing tab, or an audio
+transcription (upload and submit).
+
+For each app configuration (--max-threads, and --workers: more than one runs
+`jet/launch.py`, with the user states in --db-backend) and number of users,
+report the p50/p95/p99 time to first token (chat), completion latency and queue
+wait (from joining the queue to the start of processing) per action, the error
+rate, and the server's RSS and CPU (of all its processes).
+
+Usage: python benchmarks/load_test.py [--users 1 --users 10 --users 50
+    --max-threads 10 --max-threads 40 --workers 1 --workers 4]
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import wave
+import random
+import socket
+import asyncio
+import tempfile
+import subprocess
+from pathlib import Path
+
+import click
+import httpx
+import numpy as np
+
+BENCHMARKS_DIR = Path(__file__).parent
+JET_DIR = BENCHMARKS_DIR.parent / "jet"
+
+MODEL_NAME = "mock-model"
+PASSWORD = "load-test"
+WORDS = (
+    "the model answers questions about latency caches queues and streams while "
+    "users write long texts with several paragraphs"
+).split()
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_http(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise TimeoutError(f"{url} did not start in {timeout} s")
+
+
+def get_free_ports(num_ports):
+    """
+    Return the first of `num_ports` consecutive free ports.
+    """
+    while True:
+        port = get_free_port()
+        if port + num_ports <= 65536 and all(
+            is_port_free(port + i) for i in range(1, num_ports)
+        ):
+            return port
+
+
+def is_port_free(port):
+    with socket.socket() as sock:
+        try:
+            sock.bind(("127.0.0.1", port))
+            return True
+        except OSError:
+            return False
+
+
+def start_kv_server():
+    port = get_free_port()
+    process = subprocess.Popen(
+        [sys.executable, str(BENCHMARKS_DIR / "kv_server.py"), f"--port={port}"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError("the kv server did not start")
+            time.sleep(0.1)
+    return process, f"redis://127.0.0.1:{port}/0"
+
+
+def start_mock_server(tokens_per_sec, latency, num_tokens):
+    port = get_free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            str(BENCHMARKS_DIR / "mock_server.py"),
+            f"--port={port}",
+            f"--tokens-per-sec={tokens_per_sec}",
+            f"--latency={latency}",
+            f"--num-tokens={num_tokens}",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    wait_for_http(base_url)
+    return process, base_url
+
+
+def start_app(mock_url, max_threads, auth_file, db_name, workers=1, kv_url=None):
+    port = get_free_port()
+    env = {
+        **os.environ,
+        "OPENAI_API_TYPE": "openai",
+        "OPENAI_API_BASE": mock_url + "/v1",
+        "OPENAI_API_KEY": "mock",
+        "OPENAI_MODEL_NAME": MODEL_NAME,
+        "OPENAI_ALLOWED_MODELS": MODEL_NAME,
+        "OPENAI_RATE_LIMITS": "",
+        "OPENAI_WHISPER_API_TYPE": "openai",
+        "OPENAI_WHISPER_API_BASE": mock_url + "/v1",
+        "OPENAI_WHISPER_API_KEY": "mock",
+        "OPENAI_WHISPER_MODEL_NAME": "whisper-1",
+        "DB_NAME": db_name,
+        "GRADIO_SERVER_NAME": "127.0.0.1",
+        "GRADIO_SERVER_PORT": str(port),
+        "GRADIO_ANALYTICS_ENABLED": "False",
+    }
+    if kv_url is not None:
+        env.update({"DB_BACKEND": "redis", "DB_REDIS_URL": kv_url})
+    web_args = [
+        f"--max-threads={max_threads}",
+        f"--auth-file={auth_file}",
+        "--no-warmup",
+    ]
+    if workers > 1:
+        args = [
+            "launch.py",
+            f"--workers={workers}",
+            f"--port={port}",
+            f"--worker-base-port={get_free_ports(workers)}",
+            "--",
+            *web_args,
+        ]
+    else:
+        args = ["web.py", *web_args]
+    process = subprocess.Popen(
+        [sys.executable, *args],
+        cwd=JET_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    wait_for_http(base_url, timeout=120)
+    return process, base_url
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class ProcessSampler:
+    """
+    Sample the RSS and the CPU time of a process and of its descendants (the
+    workers of the launcher) from /proc (Linux only).
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.max_rss = 0
+
+    @staticmethod
+    def get_pids(pid):
+        pids = [pid]
+        for parent in pids:
+            try:
+                with open(f"/proc/{parent}/task/{parent}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+        return pids
+
+    @staticmethod
+    def read_process(pid):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{pid}/status") as f:
+                rss_line = next(line for line in f if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            return None, None
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        return cpu, int(rss_line.split()[1]) * 1024
+
+    def read(self):
+        samples = [self.read_process(pid) for pid in self.get_pids(self.pid)]
+        samples = [sample for sample in samples if sample[0] is not None]
+        if not samples:
+            return None, None
+        return sum(cpu for cpu, _ in samples), sum(rss for _, rss in samples)
+
+    async def run(self, interval=0.5):
+        while True:
+            _, rss = self.read()
+            self.max_rss = max(self.max_rss, rss or 0)
+            await asyncio.sleep(interval)
+
+
+def make_text(num_words, rng):
+    paragraphs = []
+    while num_words > 0:
+        size = min(num_words, rng.randint(40, 120))
+        paragraphs.append(" ".join(rng.choice(WORDS) for _ in range(size)) + ".")
+        num_words -= size
+    return "\n\n".join(paragraphs)
+
+
+def make_wav(seconds, sr=48000):
+    t = np.arange(int(seconds * sr)) / sr
+    signal = 0.3 * np.sin(2 * np.pi * 220 * t) * (np.sin(2 * np.pi * 0.5 * t) > 0)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes((signal * 32767).astype(np.int16).tobytes())
+    return buffer.getvalue()
+
+
+class AppSpec:
+    """
+    The event handlers of the app, found in its config.
+    """
+
+    def __init__(self, config):
+        components = {c["id"]: c for c in config["components"]}
+        dependencies = config["dependencies"]
+        # api name -> (fn index, input components as (type, elem_id))
+        self.functions = {}
+        self.then = {}  # api name -> api names of the events run after it
+        for fn_index, dependency in enumerate(dependencies):
+            api_name = dependency.get("api_name")
+            if api_name:
+                inputs = [
+                    (components[i]["type"], components[i]["props"].get("elem_id"))
+                    for i in dependency["inputs"]
+                ]
+                self.functions[api_name] = (fn_index, inputs)
+            trigger = dependency.get("trigger_after")
+            if api_name and trigger is not None:
+                trigger_name = dependencies[trigger].get("api_name")
+                self.then.setdefault(trigger_name, []).append(api_name)
+
+    def make_data(self, api_name, values):
+        """
+        The input data of an event, from `values` keyed by the elem_id suffix or
+        the type of the components.
+        """
+        _, inputs = self.functions[api_name]
+        data = []
+        for type, elem_id in inputs:
+            suffix = next(
+                (key for key in values if elem_id and elem_id.endswith(key)), type
+            )
+            data.append(values.get(suffix))
+        return data
+
+
+class EventResult:
+    def __init__(self, action):
+        self.action = action
+        self.join_time = time.perf_counter()
+        self.queue_wait = None
+        self.ttft = None
+        self.latency = None
+        self.error = None
+        self.output = None
+
+
+class User:
+    def __init__(self, base_url, username, spec, rng, options):
+        self.client = httpx.AsyncClient(base_url=base_url, timeout=300)
+        self.username = username
+        self.spec = spec
+        self.rng = rng
+        self.options = options
+        self.session_hash = uuid.uuid4().hex[:11]
+        self.conversations = []  # keys of the conversations
+        self.histories = {}  # conversation key -> history
+        self.active_conversation = None
+
+    async def login(self):
+        response = await self.client.post(
+            "/login", data={"username": self.username, "password": PASSWORD}
+        )
+        response.raise_for_status()
+
+    async def call(self, api_name, data, action=None):
+        """
+        Join the queue with an event and follow it to its completion, as the
+        browser does.
+        """
+        fn_index, _ = self.spec.functions[api_name]
+        result = EventResult(action or api_name)
+        params = {"fn_index": fn_index, "session_hash": self.session_hash}
+        try:
+            async with self.client.stream("GET", "/queue/join", params=params) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    message = json.loads(line[5:])
+                    now = time.perf_counter()
+                    if message["msg"] == "send_data":
+                        body = {
+                            **params,
+                            "event_id": message["event_id"],
+                            "data": data,
+                            "event_data": None,
+                        }
+                        await self.client.post("/queue/data", json=body)
+                    elif message["msg"] == "process_starts":
+                        result.queue_wait = now - result.join_time
+                    elif message["msg"] == "process_generating":
+                        if result.ttft is None:
+                            result.ttft = now - result.join_time
+                    elif message["msg"] == "process_completed":
+                        result.latency = now - result.join_time
+                        output = message.get("output") or {}
+                        if not message.get("success", False):
+                            result.error = output.get("error") or "failed"
+                        result.output = output.get("data")
+                        break
+                    elif message["msg"] == "queue_full":
+                        result.error = "queue full"
+                        break
+        except httpx.HTTPError as e:
+            result.error = repr(e)
+        if result.latency is None and result.error is None:
+            result.error = "stream closed"
+        return result
+
+    async def switch_conversation(self):
+        """
+        Switch to one of the conversations of the user, or start a new one.
+        Return the results of the events.
+        """
+        results = []
+        index = self.rng.randrange(self.options["conversations"])
+        if index >= len(self.conversations):
+            result = await self.call("make_conversation_key", [], "new_conversation")
+            results.append(result)
+            if result.error is not None or not result.output:
+                return results
+            key = result.output[0]
+            self.conversations.append(key)
+        else:
+            key = self.conversations[index]
+            if key == self.active_conversation:
+                return results
+        # the page then loads the history and the list of the conversations
+        self.active_conversation = key
+        results.append(
+            await self.call("load_conversation", [key, ""], "switch_conversation")
+        )
+        return results
+
+    async def chat(self):
+        results = await self.switch_conversation()
+        if any(result.error is not None for result in results):
+            return results
+        key = self.active_conversation
+        history = self.histories.get(key, [])[-self.options["max_history"] :]
+        history = history + [[make_text(self.rng.randint(5, 40), self.rng), None]]
+        values = {
+            "chat-chatbot": history,
+            "chat-active-conversation": key,
+            "chat-system-message": "You are a helpful assistant.",
+            "chat-model-name": MODEL_NAME,
+            "chat-temperature": 1.0,
+            "chat-max-tokens": self.options["reply_tokens"],
+            "chat-conversation-search": "",
+            "html": "",
+        }
+        data = self.spec.make_data("bot", values)
+        result = await self.call("bot", data, action="chat")
+        results.append(result)
+        if result.error is None and result.output:
+            self.histories[key] = result.output[0]
+            # the page writes the conversation after each reply
+            for then_name in self.spec.then.get("bot", []):
+                data = self.spec.make_data(then_name, values)
+                results.append(await self.call(then_name, data))
+        return results
+
+    async def writing(self):
+        text = make_text(self.options["writing_words"], self.rng)
+        return await self.call("submit", [text, "", False, False, None], "writing")
+
+    async def audio(self):
+        start = time.perf_counter()
+        files = {"files": ("recording.wav", self.options["wav"], "audio/wav")}
+        try:
+            response = await self.client.post("/upload", files=files)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            result = EventResult("audio")
+            result.error = repr(e)
+            return result
+        path = response.json()[0]
+        file_data = {
+            "path": path,
+            "url": None,
+            "size": len(self.options["wav"]),
+            "orig_name": "recording.wav",
+            "mime_type": "audio/wav",
+        }
+        result = await self.call("submit_audio", [file_data, "", False], "audio")
+        if result.latency is not None:
+            result.latency = time.perf_counter() - start
+        return result
+
+    async def run(self, deadline, results):
+        await self.login()
+        actions, weights = zip(*self.options["mix"].items())
+        while time.monotonic() < deadline:
+            action = self.rng.choices(actions, weights)[0]
+            result = await getattr(self, action)()
+            results += result if isinstance(result, list) else [result]
+            await asyncio.sleep(self.rng.expovariate(1 / self.options["think_time"]))
+        await self.client.aclose()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def summarize(results, duration):
+    summary = {
+        "requests": len(results),
+        "errors": sum(r.error is not None for r in results),
+        "throughput_per_sec": len(results) / duration,
+    }
+    summary["error_rate"] = summary["errors"] / max(1, len(results))
+    for action in sorted({r.action for r in results}):
+        done = [r for r in results if r.action == action and r.error is None]
+        metrics = {
+            "ttft": [r.ttft for r in done if r.ttft is not None],
+            "latency": [r.latency for r in done],
+            "queue_wait": [r.queue_wait for r in done if r.queue_wait is not None],
+        }
+        if action != "chat":
+            del metrics["ttft"]
+        for metric, values in metrics.items():
+            for q in [50, 95, 99]:
+                summary[f"{action}_{metric}_p{q}_sec"] = percentile(values, q)
+    errors = sorted({r.error for r in results if r.error is not None})
+    summary["error_examples"] = [error[:200] for error in errors[:3]]
+    return summary
+
+
+async def run_stage(base_url, spec, num_users, duration, pid, options, seed):
+    sampler = ProcessSampler(pid)
+    cpu_start, _ = sampler.read()
+    sampler_task = asyncio.create_task(sampler.run())
+
+    results = []
+    start = time.monotonic()
+    deadline = start + duration
+    users = [
+        User(base_url, f"user{i}", spec, random.Random(seed + i), options)
+        for i in range(num_users)
+    ]
+    outcomes = await asyncio.gather(
+        *[user.run(deadline, results) for user in users], return_exceptions=True
+    )
+    elapsed = time.monotonic() - start
+
+    sampler_task.cancel()
+    cpu_end, _ = sampler.read()
+    summary = summarize(results, elapsed)
+    summary["user_failures"] = sum(isinstance(o, Exception) for o in outcomes)
+    summary["server_cpu_percent"] = 100 * (cpu_end - cpu_start) / elapsed
+    summary["server_max_rss_bytes"] = sampler.max_rss
+    return summary
+
+
+def run(
+    users=(1, 10, 50),
+    max_threads=(10,),
+    duration=30.0,
+    options=None,
+    mock_options=None,
+    workers=(1,),
+    db_backend="sqlite",
+):
+    mock_process, mock_url = start_mock_server(**mock_options)
+    kv_process, kv_url = None, None
+    results = []
+    try:
+        if db_backend == "redis":
+            kv_process, kv_url = start_kv_server()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            auth_file = Path(tmpdir) / "auth.txt"
+            auth_file.write_text(
+                "".join(f"user{i}:{PASSWORD}\n" for i in range(max(users)))
+            )
+            for threads in max_threads:
+                for num_workers in workers:
+                    results += run_app_config(
+                        mock_url,
+                        threads,
+                        auth_file,
+                        users,
+                        duration,
+                        options,
+                        num_workers,
+                        kv_url,
+                    )
+    finally:
+        stop_process(mock_process)
+        if kv_process is not None:
+            stop_process(kv_process)
+    return results
+
+
+def run_app_config(
+    mock_url, threads, auth_file, users, duration, options, workers=1, kv_url=None
+):
+    db_name = f"load-test-{uuid.uuid4().hex[:8]}"
+    app_process, base_url = start_app(
+        mock_url, threads, auth_file, db_name, workers, kv_url
+    )
+    results = []
+    try:
+        with httpx.Client(base_url=base_url) as client:
+            client.post("/login", data={"username": "user0", "password": PASSWORD})
+            spec = AppSpec(client.get("/config").json())
+        for num_users in users:
+            click.echo(
+                f"threads={threads} workers={workers} users={num_users}...", err=True
+            )
+            summary = asyncio.run(
+                run_stage(
+                    base_url, spec, num_users, duration, app_process.pid, options, 0
+                )
+            )
+            results.append(
+                {
+                    "name": "load.stage",
+                    "max_threads": threads,
+                    "workers": workers,
+                    "db_backend": "redis" if kv_url else "sqlite",
+                    "users": num_users,
+                    **summary,
+                }
+            )
+    finally:
+        stop_process(app_process)
+        for path in (JET_DIR / "data").glob(f"{db_name}.sqlite*"):
+            path.unlink()
+    return results
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        action, _, weight = item.partition("=")
+        mix[action.strip()] = float(weight or 1)
+    assert set(mix) <= {"chat", "writing", "audio"}, mix
+    return mix
+
+
+@click.command()
+@click.option("--users", multiple=True, type=int, default=[1, 10, 50])
+@click.option("--max-threads", multiple=True, type=int, default=[10])
+@click.option(
+    "--workers",
+    multiple=True,
+    type=int,
+    default=[1],
+    help="App processes, more than one are run behind jet/launch.py.",
+)
+@click.option(
+    "--db-backend",
+    type=click.Choice(["sqlite", "redis"]),
+    default="sqlite",
+    help="The backend of the user states, redis is the local kv_server.py.",
+)
+@click.option("--duration", default=30.0, help="Seconds of each stage.")
+@click.option("--think-time", default=2.0, help="Mean seconds between actions.")
+@click.option("--mix", default="chat=0.7,writing=0.2,audio=0.1")
+@click.option("--reply-tokens", default=200)
+@click.option("--max-history", default=10, help="Previous messages sent.")
+@click.option("--conversations", default=5, help="Conversations of each user.")
+@click.option("--writing-words", default=300)
+@click.option("--audio-seconds", default=20.0)
+@click.option("--tokens-per-sec", default=50.0, help="Of the mock server.")
+@click.option("--latency", default=0.5, help="First token latency of the mock.")
+@click.option("--output", default="-", type=click.File("w"))
+def main(
+    users,
+    max_threads,
+    workers,
+    db_backend,
+    duration,
+    think_time,
+    mix,
+    reply_tokens,
+    max_history,
+    conversations,
+    writing_words,
+    audio_seconds,
+    tokens_per_sec,
+    latency,
+    output,
+):
+    options = {
+        "mix": parse_mix(mix),
+        "think_time": think_time,
+        "reply_tokens": reply_tokens,
+        "max_history": max_history,
+        "conversations": conversations,
+        "writing_words": writing_words,
+        "wav": make_wav(audio_seconds),
+    }
+    mock_options = {
+        "tokens_per_sec": tokens_per_sec,
+        "latency": latency,
+        "num_tokens": reply_tokens,
+    }
+    results = run(
+        sorted(users),
+        max_threads,
+        duration,
+        options,
+        mock_options,
+        workers,
+        db_backend,
+    )
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
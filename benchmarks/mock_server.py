@@ -0,0 +1,184 @@
+"""
+A local mock of the OpenAI (and Azure OpenAI) chat completions and audio
+transcriptions apis, to benchmark the app without an api key or quota.
+
+The chat completions stream `--num-tokens` tokens (at most the `max_tokens` of the
+request) at `--tokens-per-sec`, after `--latency` seconds. The transcriptions
+answer after `--transcribe-latency` seconds plus `--transcribe-rtf` times the
+duration of the (wav or flac) audio.
+
+Usage: python benchmarks/mock_server.py [--port 8910 --tokens-per-sec 50]
+
+then point the app at it, e.g. OPENAI_API_TYPE=openai
+OPENAI_API_BASE=http://127.0.0.1:8910/v1 OPENAI_API_KEY=mock
+"""
+import io
+import json
+import time
+import wave
+import asyncio
+import threading
+
+import click
+from aiohttp import web
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+
+class MockConfig:
+    def __init__(
+        self,
+        tokens_per_sec=50.0,
+        latency=0.5,
+        num_tokens=200,
+        transcribe_latency=0.5,
+        transcribe_rtf=0.05,
+    ):
+        self.tokens_per_sec = tokens_per_sec
+        self.latency = latency
+        self.num_tokens = num_tokens
+        self.transcribe_latency = transcribe_latency
+        self.transcribe_rtf = transcribe_rtf
+
+        self.requests = 0
+        self.transcriptions = 0
+
+
+def make_chunk(model, content=None, finish_reason=None):
+    delta = {} if content is None else {"content": content}
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def get_audio_seconds(blob):
+    try:
+        with wave.open(io.BytesIO(blob)) as f:
+            return f.getnframes() / f.getframerate()
+    except (wave.Error, EOFError):
+        pass
+    if soundfile is not None:
+        try:
+            return soundfile.info(io.BytesIO(blob)).duration
+        except RuntimeError:
+            pass
+    return 0.0
+
+
+async def chat_completions(request):
+    config = request.app["config"]
+    config.requests += 1
+    body = await request.json()
+    model = body.get("model") or request.match_info.get("deployment", "mock")
+    num_tokens = min(config.num_tokens, body.get("max_tokens") or config.num_tokens)
+    await asyncio.sleep(config.latency)
+
+    tokens = [f"tok{i} " for i in range(num_tokens)]
+    if not body.get("stream"):
+        await asyncio.sleep(num_tokens / config.tokens_per_sec)
+        message = {"role": "assistant", "content": "".join(tokens)}
+        return web.json_response(
+            {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": 0,
+                    "completion_tokens": num_tokens,
+                    "total_tokens": num_tokens,
+                },
+            }
+        )
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    start = time.monotonic()
+    for i, token in enumerate(tokens):
+        # paced on the start time, so the rate does not drift with the overhead
+        delay = start + i / config.tokens_per_sec - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        chunk = make_chunk(model, token)
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+    chunk = make_chunk(model, finish_reason="stop")
+    await response.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode())
+    return response
+
+
+async def audio_transcriptions(request):
+    config = request.app["config"]
+    config.transcriptions += 1
+    blob = b""
+    async for part in await request.multipart():
+        if part.name == "file":
+            blob = await part.read()
+    seconds = get_audio_seconds(blob)
+    await asyncio.sleep(config.transcribe_latency + config.transcribe_rtf * seconds)
+    return web.json_response({"text": f"mock transcript of {seconds:.1f} s."})
+
+
+def make_app(config):
+    app = web.Application(client_max_size=64 * 2**20)
+    app["config"] = config
+    for prefix in ["/v1", "/openai/deployments/{deployment}"]:
+        app.router.add_post(prefix + "/chat/completions", chat_completions)
+        app.router.add_post(prefix + "/audio/transcriptions", audio_transcriptions)
+    return app
+
+
+def start_mock_server(config=None, host="127.0.0.1", port=0):
+    """
+    Run the mock server in a background thread, return its base url (e.g.
+    "http://127.0.0.1:8910") and its config, which may be changed while running.
+    """
+    config = config or MockConfig()
+    started = threading.Event()
+    address = {}
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(make_app(config), access_log=None)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, host, port)
+        loop.run_until_complete(site.start())
+        address["port"] = site._server.sockets[0].getsockname()[1]
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+    return f"http://{host}:{address['port']}", config
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8910)
+@click.option("--tokens-per-sec", default=50.0)
+@click.option("--latency", default=0.5, help="Seconds to the first token.")
+@click.option("--num-tokens", default=200, help="Tokens of each reply.")
+@click.option("--transcribe-latency", default=0.5)
+@click.option(
+    "--transcribe-rtf",
+    default=0.05,
+    help="Transcription seconds per second of audio.",
+)
+def main(
+    host, port, tokens_per_sec, latency, num_tokens, transcribe_latency, transcribe_rtf
+):
+    config = MockConfig(
+        tokens_per_sec, latency, num_tokens, transcribe_latency, transcribe_rtf
+    )
+    web.run_app(make_app(config), host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
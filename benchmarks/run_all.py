@@ -0,0 +1,74 @@
+"""
+Run the benchmarks, each in its own process, and write their results with the
+commit they ran on to a JSON file, to compare commits with benchmarks/compare.py.
+
+Usage: python benchmarks/run_all.py [--suite chat --suite diff] --output results.json
+"""
+import sys
+import json
+import datetime
+import platform
+import subprocess
+from pathlib import Path
+
+import click
+
+BENCHMARKS_DIR = Path(__file__).parent
+
+# suite -> command line, with sizes that keep the whole run in a few minutes
+SUITES = {
+    "chat": ["bench_chat.py", "--num-tokens", "2000"],
+    "streaming": ["bench_streaming.py"],
+    "diff": ["bench_diff.py"],
+    "db": ["bench_db.py", "--ops", "10000"],
+    "codec": ["bench_codec.py", "--num-messages", "2000"],
+    "audio": ["bench_audio.py", "--seconds", "10", "--seconds", "300"],
+    "startup": ["bench_startup.py", "--no-check"],
+    "backends": ["bench_backends.py", "--ops", "2000"],
+}
+
+
+def git(*args):
+    try:
+        return subprocess.check_output(
+            ["git", *args], cwd=BENCHMARKS_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(name):
+    script, *args = SUITES[name]
+    output = subprocess.check_output(
+        [sys.executable, str(BENCHMARKS_DIR / script), *args], text=True
+    )
+    return json.loads(output)
+
+
+@click.command()
+@click.option(
+    "--suite",
+    "suites",
+    multiple=True,
+    type=click.Choice(list(SUITES)),
+    help="The suites to run, all by default.",
+)
+@click.option("--output", default="-", type=click.File("w"))
+def main(suites, output):
+    report = {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "suites": {},
+    }
+    for name in suites or SUITES:
+        click.echo(f"running {name}", err=True)
+        report["suites"][name] = run_suite(name)
+    json.dump(report, output, indent=2)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Run several workers of the app (each a `web.py` process) behind a reverse proxy
+with sticky sessions, to use more than one CPU core (and GIL).
+
+The proxy sends the first request of a browser to the least busy worker and sets
+a `jet-worker` cookie, so the later requests of the browser (the login, the
+config, the queue events) go to the same worker. This is required: each worker
+keeps its own login tokens, queue and write-behind buffers in memory. If the
+worker of a session stops, the session moves to another one (and the user logs
+in again). Workers that exit are restarted.
+
+The workers share the state of the users: the conversations and the caches in
+the state db (one SQLite file in WAL mode, so all the workers run on this host),
+and the user states in the backend set by DB_BACKEND. Only the user states move
+to redis with DB_BACKEND=redis, the rest stays in the state db (see README for
+the consistency guarantees).
+
+Usage: python jet/launch.py --workers 4 --port 7860 [-- web.py options]
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import subprocess
+from pathlib import Path
+
+import click
+import httpx
+import uvicorn
+from starlette.routing import Route
+from utils.config_utils import load_config
+from starlette.responses import Response, StreamingResponse
+from starlette.applications import Starlette
+
+load_config()
+
+WEB_PY = Path(__file__).parent / "web.py"
+WORKER_COOKIE = "jet-worker"
+HTTP_METHODS = ["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"]
+# not forwarded, they only apply to a single connection
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
+class Worker:
+    def __init__(self, index, port, web_args):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.web_args = web_args
+        self.process = None
+        self.ready = False  # serving requests
+        self.active_requests = 0  # including the open event streams
+        self.sessions = 0  # sent to this worker since it started
+
+    def start(self):
+        env = {
+            **os.environ,
+            "GRADIO_SERVER_NAME": "127.0.0.1",
+            "GRADIO_SERVER_PORT": str(self.port),
+        }
+        self.process = subprocess.Popen(
+            [sys.executable, str(WEB_PY), *self.web_args], env=env
+        )
+        self.ready = False
+        self.sessions = 0
+        logging.info("started worker %d (pid %d)", self.index, self.process.pid)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def is_available(self):
+        return self.ready and self.is_alive()
+
+    def wait_ready(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and self.is_alive():
+            try:
+                httpx.get(self.url, timeout=1)
+                self.ready = True
+                return True
+            except httpx.TransportError:
+                time.sleep(0.2)
+        return False
+
+    def stop(self, timeout=10):
+        if not self.is_alive():
+            return
+        # the workers flush their buffered user states on SIGTERM
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class StickyRouter:
+    """
+    Pick the worker of each request by the `jet-worker` cookie, or the least
+    busy one for new sessions (and the sessions of stopped workers): the one with
+    the fewest requests in progress, then with the fewest sessions.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30, read=None),  # event streams are long
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+        )
+
+    def pick(self, request):
+        index = request.cookies.get(WORKER_COOKIE, "")
+        if index.isdigit() and int(index) < len(self.workers):
+            worker = self.workers[int(index)]
+            if worker.is_available():
+                return worker, False
+        available = [worker for worker in self.workers if worker.is_available()]
+        if not available:
+            return None, False
+        worker = min(
+            available, key=lambda worker: (worker.active_requests, worker.sessions)
+        )
+        worker.sessions += 1
+        return worker, True
+
+    async def proxy(self, request):
+        worker, new_session = self.pick(request)
+        if worker is None:
+            return Response("no worker available", status_code=503)
+
+        headers = [
+            (name, value)
+            for name, value in request.headers.items()
+            if name not in HOP_BY_HOP_HEADERS
+        ]
+        headers += [
+            ("x-forwarded-for", request.client.host if request.client else ""),
+            ("x-forwarded-proto", request.url.scheme),
+        ]
+        upstream_request = self.client.build_request(
+            request.method,
+            worker.url + request.url.path,
+            params=request.url.query,
+            headers=headers,
+            content=await request.body(),
+        )
+        worker.active_requests += 1
+        try:
+            upstream = await self.client.send(upstream_request, stream=True)
+        except httpx.TransportError as e:
+            worker.active_requests -= 1
+            logging.warning("worker %d failed: %r", worker.index, e)
+            return Response("bad gateway", status_code=502)
+
+        async def stream():
+            try:
+                async for chunk in upstream.aiter_raw():
+                    yield chunk
+            finally:
+                worker.active_requests -= 1
+                await upstream.aclose()
+
+        response = StreamingResponse(stream(), status_code=upstream.status_code)
+        # raw, to keep the repeated headers (set-cookie)
+        response.raw_headers = [
+            (name.encode("latin-1"), value.encode("latin-1"))
+            for name, value in upstream.headers.multi_items()
+            if name not in HOP_BY_HOP_HEADERS
+        ]
+        if new_session:
+            response.set_cookie(WORKER_COOKIE, str(worker.index), samesite="lax")
+        return response
+
+
+def supervise(workers, stopping, startup_timeout, interval=1.0):
+    """
+    Restart the workers that have exited, until `stopping` is set. The sessions
+    of a worker move to the others until it serves requests again.
+    """
+    while not stopping.wait(interval):
+        for worker in workers:
+            if not worker.is_alive():
+                logging.warning(
+                    "worker %d exited with %s, restarting",
+                    worker.index,
+                    worker.process.returncode,
+                )
+                worker.start()
+                worker.wait_ready(startup_timeout)
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.option("--workers", "num_workers", default=2, help="The number of workers.")
+@click.option("--host", default="127.0.0.1", help="The host of the proxy.")
+@click.option("--port", default=7860, help="The port of the proxy.")
+@click.option(
+    "--worker-base-port",
+    default=7870,
+    help="The port of the first worker, the others use the next ones.",
+)
+@click.option(
+    "--startup-timeout",
+    default=120.0,
+    help="Seconds to wait for the workers to serve requests.",
+)
+@click.argument("web_args", nargs=-1, type=click.UNPROCESSED)
+def main(num_workers, host, port, worker_base_port, startup_timeout, web_args):
+    workers = [
+        Worker(i, worker_base_port + i, list(web_args)) for i in range(num_workers)
+    ]
+    stopping = threading.Event()
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            if not worker.wait_ready(startup_timeout):
+                raise click.ClickException(f"worker {worker.index} did not start")
+        threading.Thread(
+            target=supervise, args=(workers, stopping, startup_timeout), daemon=True
+        ).start()
+
+        router = StickyRouter(workers)
+        app = Starlette(
+            routes=[Route("/{path:path}", router.proxy, methods=HTTP_METHODS)]
+        )
+        logging.info("serving %d workers on http://%s:%d", num_workers, host, port)
+        uvicorn.run(app, host=host, port=port, log_level="warning")
+    finally:
+        stopping.set()
+        for worker in workers:
+            worker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,36 @@
 import ast
+import html
+import time
+import uuid
 import logging
 
-import dotenv
 import gradio as gr
-
-dotenv.load_dotenv()
-logging.basicConfig(level=logging.INFO)
-
 from utils.chat_utils import (
     get_all_models,
     get_current_model,
     agenerate_new_text,
     get_chat_system_message,
 )
-from utils.persist_utils import persist
+from utils.persist_utils import (
+    persist,
+    save_user_state,
+    flush_user_state,
+    load_user_states,
+)
+from utils.conversation_utils import list_conversations, delete_conversation
+
+from .layout import make_tab_block
+
+
+def make_conversation_key():
+    return f"conversation-{uuid.uuid4().hex}"
+
+
+def format_conversation(conversation):
+    updated_at = time.strftime(
+        "%Y-%m-%d %H:%M", time.localtime(conversation["updated_at"])
+    )
+    return f"{conversation['title'] or 'Untitled'} ({updated_at})"
 
 
 def create_chat_tab(tab_id=""):
@@ -85,89 +102,200 @@ def create_chat_tab(tab_id=""):
             )
         return model_status, model_name, temperature, max_tokens, model_parameters_reset
 
-    with gr.Blocks() as chat_tab:
-        with gr.Accordion("Inspect & Edit", open=True, visible=False) as edit_accordion:
-            edit_index = gr.Textbox(
-                value="",
-                interactive=False,
-                label="Message Index",
-                visible=False,
-            )
-            edit_content = gr.Code(
-                lines=2,
-                language="markdown",
-                label="Message Content",
-            )
-            with gr.Row():
-                edit_done = gr.Button(value="Update", variant="primary", size="sm")
-                edit_discard = gr.Button(
-                    value="Discard", variant="secondary", size="sm"
-                )
-
-        chatbot_status = gr.HTML()
-        chatbot = persist(
-            gr.Chatbot(
-                height=500,
-                container=False,
-                bubble_full_width=False,
-                latex_delimiters=[
-                    {"left": "$$", "right": "$$", "display": True},
-                    {"left": "$", "right": "$", "display": False},
-                ],
-                elem_id=tab_id + "chat-chatbot",
-            )
-        )
-        msg = persist(
+    with make_tab_block() as chat_tab:
+        # the key of the active conversation, a new one on the first visit
+        active_conversation = persist(
             gr.Textbox(
-                label="Your Message",
-                autofocus=True,
-                lines=2,
-                placeholder="Hi!",
-                elem_id=tab_id + "chat-msg",
-            )
+                value=make_conversation_key,
+                visible=False,
+                elem_id=tab_id + "chat-active-conversation",
+            ),
+            mode="manual",
         )
-
-        submit_btn = gr.Button(value="Submit", variant="primary")
         with gr.Row():
-            retry_btn = gr.Button(value="Retry", variant="secondary", size="sm")
-            undo_btn = gr.Button(value="Undo", variant="secondary", size="sm")
-            clear_btn = gr.Button(value="Clear", variant="secondary", size="sm")
-
-        with gr.Accordion("System Message", open=False):
-            system_message = persist(
-                gr.Textbox(
-                    value=get_chat_system_message,
-                    placeholder="You are ChatGPT.",
-                    lines=4,
-                    label="System Message",
+            with gr.Column(scale=1, min_width=200):
+                new_conversation_btn = gr.Button(
+                    value="New Chat", variant="primary", size="sm"
+                )
+                conversation_search = gr.Textbox(
+                    placeholder="Search",
                     show_label=False,
-                    elem_id=tab_id + "chat-system-message",
+                    container=False,
+                    elem_id=tab_id + "chat-conversation-search",
+                )
+                conversation_list = gr.Radio(
+                    choices=[],
+                    label="Conversations",
+                    elem_id=tab_id + "chat-conversation-list",
+                )
+                delete_conversation_btn = gr.Button(
+                    value="Delete", variant="stop", size="sm"
+                )
+            with gr.Column(scale=4):
+                with gr.Accordion(
+                    "Inspect & Edit", open=True, visible=False
+                ) as edit_accordion:
+                    edit_index = gr.Textbox(
+                        value="",
+                        interactive=False,
+                        label="Message Index",
+                        visible=False,
+                    )
+                    edit_content = gr.Code(
+                        lines=2,
+                        language="markdown",
+                        label="Message Content",
+                    )
+                    with gr.Row():
+                        edit_done = gr.Button(
+                            value="Update", variant="primary", size="sm"
+                        )
+                        edit_discard = gr.Button(
+                            value="Discard", variant="secondary", size="sm"
+                        )
+
+                chatbot_status = gr.HTML()
+                # the history of the active conversation, saved by the handlers
+                chatbot = gr.Chatbot(
+                    height=500,
+                    container=False,
+                    bubble_full_width=False,
+                    latex_delimiters=[
+                        {"left": "$$", "right": "$$", "display": True},
+                        {"left": "$", "right": "$", "display": False},
+                    ],
+                    elem_id=tab_id + "chat-chatbot",
+                )
+                msg = persist(
+                    gr.Textbox(
+                        label="Your Message",
+                        autofocus=True,
+                        lines=2,
+                        placeholder="Hi!",
+                        elem_id=tab_id + "chat-msg",
+                    )
                 )
+
+                submit_btn = gr.Button(value="Submit", variant="primary")
+                with gr.Row():
+                    retry_btn = gr.Button(value="Retry", variant="secondary", size="sm")
+                    undo_btn = gr.Button(value="Undo", variant="secondary", size="sm")
+                    clear_btn = gr.Button(value="Clear", variant="secondary", size="sm")
+
+                with gr.Accordion("System Message", open=False):
+                    system_message = persist(
+                        gr.Textbox(
+                            value=get_chat_system_message,
+                            placeholder="You are ChatGPT.",
+                            lines=4,
+                            label="System Message",
+                            show_label=False,
+                            elem_id=tab_id + "chat-system-message",
+                        )
+                    )
+                    system_message_reset_btn = gr.Button(
+                        value="Reset",
+                        variant="secondary",
+                        size="sm",
+                    )
+                with gr.Column():
+                    (
+                        model_status,
+                        model_name,
+                        temperature,
+                        max_tokens,
+                        model_parameters_reset,
+                    ) = model_parameters()
+
+        def save_history(key, history, request):
+            # buffered, written at the end of the stream or after a few seconds
+            save_user_state(
+                request.username, key, history, "conversation", write_behind=True
             )
-            system_message_reset_btn = gr.Button(
-                value="Reset",
-                variant="secondary",
-                size="sm",
+
+        def make_conversation_list(username, query, key):
+            conversations = list_conversations(username, query)
+            return gr.Radio(
+                choices=[(format_conversation(c), c["key"]) for c in conversations],
+                value=key if any(c["key"] == key for c in conversations) else None,
             )
-        with gr.Column():
-            (
-                model_status,
-                model_name,
-                temperature,
-                max_tokens,
-                model_parameters_reset,
-            ) = model_parameters()
-
-        def user(user_message, history):
-            return "", history + [[user_message, None]]
+
+        def load_conversation(key, query, request: gr.Request):
+            # only the history of the active conversation is read
+            histories = load_user_states(request.username, [key], "conversation")
+            conversations = make_conversation_list(request.username, query, key)
+            return histories.get(key) or [], conversations
+
+        def select_conversation(key):
+            return key
+
+        def search_conversations(query, key, request: gr.Request):
+            return make_conversation_list(request.username, query, key)
+
+        def flush_conversation(key, query, request: gr.Request):
+            flush_user_state(request.username, key)
+            return make_conversation_list(request.username, query, key)
+
+        def remove_conversation(key, request: gr.Request):
+            flush_user_state(request.username, key)
+            delete_conversation(request.username, key)
+            # switch to the most recent conversation left
+            conversations = list_conversations(request.username, limit=1)
+            if conversations:
+                return conversations[0]["key"]
+            return make_conversation_key()
+
+        def user(user_message, history, key, request: gr.Request):
+            history = history + [[user_message, None]]
+            save_history(key, history, request)
+            # the conversation stays active after a reload
+            save_user_state(request.username, active_conversation.elem_id, key)
+            return "", history
+
+        def make_chatbot_status(model_status, info):
+            context_status = ""
+            if info:
+                context_status = f"""
+                <small>
+                <b>Context:</b> {info["prompt_tokens"]} / {info["budget"]} tokens
+                </small>
+                """
+                if info["dropped_messages"]:
+                    context_status += f"""
+                    <small>
+                    <b>Dropped:</b> {info["dropped_messages"]} earliest messages
+                    ({info["dropped_tokens"]} tokens) to fit the context
+                    </small>
+                    """
+                if info["cut_tokens"]:
+                    context_status += f"""
+                    <small>
+                    <b>Cut:</b> {info["cut_tokens"]} tokens of the last message
+                    </small>
+                    """
+                if info.get("queue_wait", 0) >= 0.1:
+                    context_status += f"""
+                    <small>
+                    <b>Queued:</b> {info["queue_wait"]:.1f} s for the rate limits
+                    </small>
+                    """
+                if info.get("error"):
+                    context_status += f"""
+                    <small><b>Error:</b> {html.escape(info["error"])}</small>
+                    """
+            return model_status + context_status
 
         async def bot(
             history,
+            key: str,
             system_message: str,
             model_name: str,
             temperature: float,
             max_tokens: int,
+            model_status: str,
+            request: gr.Request,
         ):
+            info = {}
             async for history in agenerate_new_text(
                 message=None,
                 history=history,
@@ -176,8 +304,14 @@ def create_chat_tab(tab_id=""):
                 system_message=system_message,
                 temperature=temperature,
                 max_tokens=max_tokens,
+                info=info,
+                username=request.username or request.session_hash,
             ):
-                yield history
+                save_history(key, history, request)
+                yield history, make_chatbot_status(model_status, info)
+            if info.get("error"):
+                # nothing streamed after the error
+                yield history, make_chatbot_status(model_status, info)
 
         def load_message_to_edit_area(event: gr.SelectData):
             logging.info("Select Event: value: %r index: %r", event.value, event.index)
@@ -188,13 +322,14 @@ def create_chat_tab(tab_id=""):
             edit_accordion_update = gr.Accordion(visible=True)
             return repr(index), text, edit_accordion_update
 
-        def update_history(index, content, history):
+        def update_history(index, content, history, key, request: gr.Request):
             # index maybe repr(index), to array
             if type(index) == str:
                 index = ast.literal_eval(index)
 
             # update the history
             history[index[0]][index[1]] = content
+            save_history(key, history, request)
 
             # update the layout
             edit_accordion_update = gr.Accordion(visible=False)
@@ -207,55 +342,110 @@ def create_chat_tab(tab_id=""):
 
             return edit_accordion_update
 
-        async def retry(history, system_message, model_name, temperature, max_tokens):
+        async def retry(
+            history,
+            key,
+            system_message,
+            model_name,
+            temperature,
+            max_tokens,
+            model_status,
+            request: gr.Request,
+        ):
             if history:
                 history[-1][1] = None
-                yield history
-                async for history in agenerate_new_text(
-                    message=None,
-                    history=history,
-                    return_history=True,
-                    system_message=system_message,
-                    model_name=model_name,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
+                yield history, model_status
+                async for outputs in bot(
+                    history,
+                    key,
+                    system_message,
+                    model_name,
+                    temperature,
+                    max_tokens,
+                    model_status,
+                    request,
                 ):
-                    yield history
+                    yield outputs
             else:
-                yield history
+                yield history, model_status
 
-        def undo(history):
+        def undo(history, key, request: gr.Request):
             last_human_message = None
             if history:
                 last_human_message = history[-1][0]
                 history = history[:-1]
+                save_history(key, history, request)
             return history, last_human_message
 
-        def clear():
+        def clear(key, request: gr.Request):
+            save_history(key, [], request)
             return (
                 [],  # history
                 "",  # message
                 get_chat_system_message(),  # system_message
             )
 
-        gr.on(
+        chat_inputs = [
+            chatbot,
+            active_conversation,
+            system_message,
+            model_name,
+            temperature,
+            max_tokens,
+            model_status,
+        ]
+        bot_event = gr.on(
             [msg.submit, submit_btn.click],
             user,
-            inputs=[msg, chatbot],
+            inputs=[msg, chatbot, active_conversation],
             outputs=[msg, chatbot],
         ).then(
             bot,
-            inputs=[chatbot, system_message, model_name, temperature, max_tokens],
-            outputs=[chatbot],
+            inputs=chat_inputs,
+            outputs=[chatbot, chatbot_status],
+        )
+        bot_event.then(
+            flush_conversation,
+            [active_conversation, conversation_search],
+            [conversation_list],
+            queue=False,
         )
 
-        retry_btn.click(
-            retry,
-            [chatbot, system_message, model_name, temperature, max_tokens],
-            [chatbot],
+        retry_event = retry_btn.click(retry, chat_inputs, [chatbot, chatbot_status])
+        retry_event.then(
+            flush_conversation,
+            [active_conversation, conversation_search],
+            [conversation_list],
+            queue=False,
+        )
+        undo_btn.click(undo, [chatbot, active_conversation], [chatbot, msg])
+        clear_btn.click(clear, [active_conversation], [chatbot, msg, system_message])
+
+        # switching conversations stops the reply being streamed, and loads the
+        # history of the new active conversation
+        active_conversation.change(
+            load_conversation,
+            [active_conversation, conversation_search],
+            [chatbot, conversation_list],
+            queue=False,
+        )
+        for event, fn, inputs in [
+            (conversation_list.input, select_conversation, [conversation_list]),
+            (new_conversation_btn.click, make_conversation_key, []),
+            (delete_conversation_btn.click, remove_conversation, [active_conversation]),
+        ]:
+            event(
+                fn,
+                inputs,
+                [active_conversation],
+                cancels=[bot_event, retry_event],
+            ).then(**active_conversation.save_session_kwargs)
+        conversation_search.change(
+            search_conversations,
+            [conversation_search, active_conversation],
+            [conversation_list],
+            queue=False,
         )
-        undo_btn.click(undo, [chatbot], [chatbot, msg])
-        clear_btn.click(clear, [], [chatbot, msg, system_message])
 
         chatbot.select(
             load_message_to_edit_area,
@@ -264,7 +454,7 @@ def create_chat_tab(tab_id=""):
         )
         edit_done.click(
             update_history,
-            [edit_index, edit_content, chatbot],
+            [edit_index, edit_content, chatbot, active_conversation],
             [chatbot, edit_accordion],
         )
         edit_discard.click(discard_update_history, [], [edit_accordion])
@@ -0,0 +1,15 @@
+import gradio as gr
+from gradio.context import Context
+
+
+def make_tab_block():
+    """
+    The block containing a tab: a column when built inside an open gr.Blocks (the
+    tab is then built in place, without a `render`), otherwise a gr.Blocks.
+
+    A gr.Blocks creates its own fastapi app, which takes most of the time of the
+    construction of a tab.
+    """
+    if Context.block is not None:
+        return gr.Column()
+    return gr.Blocks()
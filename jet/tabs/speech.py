@@ -1,9 +1,13 @@
+import asyncio
+
 import gradio as gr
-from utils.whisper_utils import transcribe_audio_data
+from utils.whisper_utils import atranscribe_audio_data, get_transcript_cache_stats
+
+from .layout import make_tab_block
 
 
 def create_speech_tab(tab_id=""):
-    with gr.Blocks() as speech_tab:
+    with make_tab_block() as speech_tab:
         with gr.Row():
             with gr.Column():
                 audio_input = gr.Audio(
@@ -15,6 +19,9 @@ def create_speech_tab(tab_id=""):
             with gr.Column():
                 audio_output = gr.Text(label="Audio Output", lines=4, interactive=True)
 
+        audio_status = gr.HTML()
+        use_cache = gr.Checkbox(label="Reuse Cached Transcripts", value=True)
+
         submit_btn = gr.Button(value="Submit", variant="primary")
         clear_btn = gr.Button(value="Clear", variant="secondary")
 
@@ -37,16 +44,34 @@ def create_speech_tab(tab_id=""):
                 label="Whisper Prompt Examples",
             )
 
-        def submit_audio(audio, whisper_prompt):
+        def make_audio_status():
+            stats = get_transcript_cache_stats()
+            return f"""
+            <small>
+            <b>Cache Hit Rate:</b> {stats["hit_rate"]:.0%}
+            ({stats["hits"]} / {stats["requests"]})
+            <b>Cached Transcripts:</b> {stats["entries"]}
+            ({stats["bytes"] / 1024:.0f} / {stats["max_bytes"] / 1024:.0f} KB)
+            </small>
+            """
+
+        async def submit_audio(audio, whisper_prompt, use_cache):
             sr, data = audio
-            transcript = transcribe_audio_data(sr, data, whisper_prompt)
-            return transcript
+            try:
+                transcript = await atranscribe_audio_data(
+                    sr, data, whisper_prompt, use_cache=use_cache
+                )
+            except asyncio.TimeoutError:
+                raise gr.Error("The transcription timed out, please try again.")
+            return transcript, await asyncio.to_thread(make_audio_status)
 
         def clear_audio():
             return None
 
         submit_btn.click(
-            submit_audio, inputs=[audio_input, whisper_prompt], outputs=[audio_output]
+            submit_audio,
+            inputs=[audio_input, whisper_prompt, use_cache],
+            outputs=[audio_output, audio_status],
         )
         clear_btn.click(clear_audio, inputs=[], outputs=[audio_input])
 
@@ -1,43 +1,26 @@
-import re
-import difflib
-import logging
+import asyncio
 
-import dotenv
 import gradio as gr
 from prompts import WRITING_REFINE_SYSTEM_MESSAGE, WRITING_CORRECT_SYSTEM_MESSAGE
-from utils.chat_utils import generate_new_messages
+from utils.chat_utils import get_response_cache_stats
+from utils.diff_utils import DIFF_DEBOUNCE_MIN_CHARS, Debouncer, diff_texts
+from utils.writing_utils import acorrect_text
 
-dotenv.load_dotenv()
-logging.basicConfig(level=logging.INFO)
+from .layout import make_tab_block
 
 
 def create_writing_tab(tab_id=""):
-    with gr.Blocks() as writing_tab:
-
-        def text_to_tokens(text):
-            return re.split(r"(\s+)", text)
-
-        def diff_texts(text1, text2, word_level=True):
-            d = difflib.Differ()
-
-            if word_level:
-                comp_results = d.compare(text_to_tokens(text1), text_to_tokens(text2))
-            else:
-                comp_results = d.compare(text1, text2)
-
-            ret_old = []
-            ret_new = []
-            for line in comp_results:
-                if line[0] in ("+", "-"):
-                    ret = ret_new if line[0] == "+" else ret_old
-                    ret.append((line[2:], line[0]))
-                    if line[2:] == "\n":
-                        ret.append((line[2:], line[0]))
-                elif line[0] == " ":
-                    ret_new.append((line[2:], None))
-                    ret_old.append((line[2:], None))
-
-            return ret_old, ret_new
+    with make_tab_block() as writing_tab:
+        diff_debouncer = Debouncer()
+
+        async def update_diff(text1, text2, word_level, request: gr.Request):
+            # keystrokes and streamed outputs trigger many diffs, only compute the
+            # last one of long texts, off the event loop
+            if len(text1) + len(text2) > DIFF_DEBOUNCE_MIN_CHARS:
+                if not await diff_debouncer.wait(request.session_hash):
+                    return gr.update(), gr.update()
+                return await asyncio.to_thread(diff_texts, text1, text2, word_level)
+            return diff_texts(text1, text2, word_level)
 
         input = gr.Textbox(lines=4, label="Input", show_copy_button=True)
 
@@ -46,7 +29,13 @@ def create_writing_tab(tab_id=""):
             refine_btn = gr.Button(value="Refine")
 
         output = gr.Textbox(lines=4, label="Output", show_copy_button=True)
-        word_level = gr.Checkbox(label="Word Level Diff", value=True)
+        output_status = gr.HTML()
+        with gr.Row():
+            word_level = gr.Checkbox(label="Word Level Diff", value=True)
+            use_cache = gr.Checkbox(label="Reuse Cached Responses", value=False)
+            only_edited = gr.Checkbox(label="Only Resend Edited Paragraphs", value=True)
+        # the corrections of the paragraphs in this session
+        corrections = gr.State({})
         with gr.Row():
             diff_input = gr.HighlightedText(
                 value="",  # workaround for https://github.com/gradio-app/gradio/issues/5584
@@ -74,24 +63,62 @@ def create_writing_tab(tab_id=""):
             label="System Message (Refine)",
         )
 
-        def submit(input, system_message):
-            new_messages = generate_new_messages(
-                input, [], system_message=system_message
-            )
-            for new_message in new_messages:
-                output_value = new_message.content
-                return output_value
+        def make_output_status(info, stats=None):
+            output_status = f"""
+            <small>
+            <b>Chunks:</b> {info["done"]} / {info["chunks"]}
+            <b>Unchanged:</b> {info["reused"]}
+            <b>Cached:</b> {info["cached"]}
+            </small>
+            """
+            if info["failed"]:
+                output_status += f"""
+                <small><b>Failed (kept as is):</b> {info["failed"]}</small>
+                """
+            if stats is not None:
+                output_status += f"""
+                <small>
+                <b>Cache Hit Rate:</b> {stats["hit_rate"]:.0%}
+                ({stats["hits"]} / {stats["requests"]})
+                </small>
+                """
+            return output_status
+
+        async def submit(
+            input,
+            system_message,
+            use_cache,
+            only_edited,
+            corrections,
+            request: gr.Request,
+        ):
+            output_value, info = "", None
+            async for output_value, info in acorrect_text(
+                input,
+                system_message,
+                use_cache=use_cache,
+                corrections=corrections if only_edited else None,
+                username=request.username or request.session_hash,
+            ):
+                yield output_value, make_output_status(info), corrections
+            if use_cache and info is not None:
+                # counts the whole cache table, once at the end, off the event loop
+                stats = await asyncio.to_thread(get_response_cache_stats)
+                yield output_value, make_output_status(info, stats), corrections
 
         diff_in_args = [input, output, word_level]
         diff_out_args = [diff_input, diff_output]
-        input.change(diff_texts, diff_in_args, diff_out_args, queue=False)
-        output.change(diff_texts, diff_in_args, diff_out_args, queue=False)
-        word_level.change(diff_texts, diff_in_args, diff_out_args, queue=False)
+        diff_kwargs = {"queue": False, "trigger_mode": "always_last"}
+        input.change(update_diff, diff_in_args, diff_out_args, **diff_kwargs)
+        output.change(update_diff, diff_in_args, diff_out_args, **diff_kwargs)
+        word_level.change(update_diff, diff_in_args, diff_out_args, **diff_kwargs)
 
         # deault: correct
-        input.submit(submit, [input, correct_system_message], [output], queue=False)
-        correct_btn.click(
-            submit, [input, correct_system_message], [output], queue=False
-        )
-        refine_btn.click(submit, [input, refine_system_message], [output], queue=False)
+        submit_args = [use_cache, only_edited, corrections]
+        correct_args = [input, correct_system_message, *submit_args]
+        refine_args = [input, refine_system_message, *submit_args]
+        submit_outputs = [output, output_status, corrections]
+        input.submit(submit, correct_args, submit_outputs)
+        correct_btn.click(submit, correct_args, submit_outputs)
+        refine_btn.click(submit, refine_args, submit_outputs)
     return writing_tab
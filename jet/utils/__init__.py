@@ -1 +1,11 @@
-from . import chat_utils, persist_utils, whisper_utils
+import importlib
+
+# the submodules are imported on first access (e.g. `utils.chat_utils`), so that
+# importing one of them does not import the others (and gradio)
+__all__ = ["chat_utils", "persist_utils", "whisper_utils"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
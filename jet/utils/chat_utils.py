@@ -1,16 +1,87 @@
 import os
+import json
+import time
 import asyncio
+import hashlib
 import logging
 import datetime
+import functools
+import threading
 
-import dotenv
+import aiohttp
+import requests
 from prompts import CHAT_SYSTEM_MESSAGE
-from langchain.schema import AIMessage, HumanMessage, SystemMessage
-from langchain.callbacks import AsyncIteratorCallbackHandler
-from langchain.chat_models import ChatOpenAI, AzureChatOpenAI
-
-dotenv.load_dotenv()
-logging.basicConfig(level=logging.INFO)
+from utils.db_utils import LRUCache, DiskCache, get_store
+from utils.route_utils import arun_routed, get_endpoints, pick_endpoint
+from utils.config_utils import load_config
+from utils.metrics_utils import (
+    CHAT_TOKENS,
+    CHAT_QUEUE_WAIT,
+    CHAT_ACTIVE_STREAMS,
+    CHAT_STREAM_SECONDS,
+    CHAT_TOKENS_PER_SECOND,
+    CHAT_TIME_TO_FIRST_TOKEN,
+)
+from utils.schedule_utils import get_scheduler
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+load_config()
+
+# langchain and openai are imported on first use, they take most of the import time
+# of the app, see benchmarks/bench_startup.py
+
+# max number of (keep-alive) connections to the api, shared by all the chats
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "50"))
+OPENAI_KEEPALIVE_TIMEOUT = float(os.getenv("OPENAI_KEEPALIVE_TIMEOUT", "60"))
+
+# streamed replies are sent at most every CHAT_STREAM_INTERVAL seconds (0: every
+# token), or as soon as CHAT_STREAM_MIN_CHARS characters are buffered (0: never)
+CHAT_STREAM_INTERVAL = float(os.getenv("CHAT_STREAM_INTERVAL", "0.05"))
+CHAT_STREAM_MIN_CHARS = int(os.getenv("CHAT_STREAM_MIN_CHARS", "0"))
+
+# context sizes (in tokens) of the models, matched by the longest prefix, and
+# overridden by OPENAI_MODEL_CONTEXT_SIZES, e.g. "gpt-4=8192,my-deployment=32768"
+MODEL_CONTEXT_SIZES = {
+    "gpt-35-turbo": 4096,
+    "gpt-35-turbo-16k": 16384,
+    "gpt-35-turbo-1106": 16385,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106": 128000,
+    "gpt-4-turbo": 128000,
+}
+# the context size of the other models (with a warning)
+DEFAULT_CONTEXT_SIZE = int(os.getenv("OPENAI_DEFAULT_CONTEXT_SIZE", "4096"))
+# tokens kept for the reply when max_tokens is 0 (inf)
+CHAT_REPLY_RESERVED_TOKENS = int(os.getenv("CHAT_REPLY_RESERVED_TOKENS", "1024"))
+# max tokens of the prompt (0: the context size of the model)
+CHAT_CONTEXT_BUDGET = int(os.getenv("CHAT_CONTEXT_BUDGET", "0"))
+# the last message is never cut below CHAT_MIN_MESSAGE_TOKENS tokens: requests
+# which do not fit fail instead
+CHAT_MIN_MESSAGE_TOKENS = int(os.getenv("CHAT_MIN_MESSAGE_TOKENS", "256"))
+# the token counts of at most TOKEN_COUNTS_MAX_ENTRIES texts are memoized
+TOKEN_COUNTS_MAX_ENTRIES = 65536
+
+# cache of the responses, used by default only when the temperature is at most
+# CHAT_CACHE_MAX_TEMPERATURE (deterministic requests), otherwise on opt-in
+CHAT_CACHE_MAX_TEMPERATURE = float(os.getenv("CHAT_CACHE_MAX_TEMPERATURE", "0"))
+CHAT_CACHE_MEMORY_BYTES = int(os.getenv("CHAT_CACHE_MEMORY_BYTES", str(16 * 2**20)))
+CHAT_CACHE_DISK_BYTES = int(os.getenv("CHAT_CACHE_DISK_BYTES", str(256 * 2**20)))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", str(7 * 24 * 3600)))
+
+_CHAT_CLIENTS = {}
+# the token counts of the texts, see `count_tokens`
+_TOKEN_COUNTS = LRUCache(TOKEN_COUNTS_MAX_ENTRIES)
+_CHAT_CLIENTS_LOCK = threading.Lock()
+_AIOHTTP_SESSIONS = {}  # event loop -> aiohttp.ClientSession
+_REQUESTS_SESSION = None
 
 
 def get_current_model(model_name=None):
@@ -20,32 +91,342 @@ def get_current_model(model_name=None):
 
 
 def get_all_models():
+    # the items may be followed by their endpoints, see `route_utils.parse_endpoints`
     openai_allowed_models = os.getenv("OPENAI_ALLOWED_MODELS", "")
-    return list(set(openai_allowed_models.split(",") + [get_current_model()]))
+    models = [item.partition("=")[0] for item in openai_allowed_models.split(",")]
+    return list(set(models + [get_current_model()]))
+
+
+def get_requests_session():
+    """
+    The session used by the synchronous api calls, shared by all the threads.
+    """
+    import openai
+
+    global _REQUESTS_SESSION
+    with _CHAT_CLIENTS_LOCK:
+        if _REQUESTS_SESSION is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=OPENAI_POOL_SIZE,
+                pool_maxsize=OPENAI_POOL_SIZE,
+                max_retries=2,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _REQUESTS_SESSION = session
+            openai.requestssession = session
+    return _REQUESTS_SESSION
+
+
+def get_aiohttp_session():
+    """
+    The session used by the asynchronous api calls in the current event loop.
+    """
+    loop = asyncio.get_running_loop()
+    session = _AIOHTTP_SESSIONS.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=OPENAI_POOL_SIZE, keepalive_timeout=OPENAI_KEEPALIVE_TIMEOUT
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _AIOHTTP_SESSIONS[loop] = session
+    return session
+
+
+def get_chat(model_name=None, streaming=False, endpoint=None):
+    """
+    Get the chat client of the model, clients are created once and reused.
+
+    endpoint: the endpoint serving the model, see `route_utils.get_endpoints`, by
+    default the least loaded one. The streaming clients are not retried by
+    langchain, the calls are retried on the other endpoints by
+    `route_utils.arun_routed` instead.
 
+    The per request parameters (e.g. temperature) are passed to each call, see
+    `get_request_params`.
+    """
+    from langchain.chat_models import ChatOpenAI, AzureChatOpenAI
 
-def get_chat(**kwargs):
     openai_api_type = os.environ.get("OPENAI_API_TYPE", "openai")
+    model = get_current_model(model_name)
+    if endpoint is None:
+        endpoint = pick_endpoint(model)
+    openai_api_base = endpoint.api_base or os.environ.get("OPENAI_API_BASE")
+
+    client_key = (
+        openai_api_type,
+        openai_api_base,
+        endpoint.api_key,
+        endpoint.deployment,
+        model,
+        streaming,
+    )
+    with _CHAT_CLIENTS_LOCK:
+        chat = _CHAT_CLIENTS.get(client_key)
+        if chat is None:
+            kwargs = {"streaming": streaming}
+            if streaming:
+                kwargs["max_retries"] = 0
+            if endpoint.api_base:
+                kwargs["openai_api_base"] = endpoint.api_base
+            if endpoint.api_key:
+                kwargs["openai_api_key"] = endpoint.api_key
+            if openai_api_type == "azure":
+                deployment_name = endpoint.deployment or model
+                chat = AzureChatOpenAI(deployment_name=deployment_name, **kwargs)
+            else:
+                chat = ChatOpenAI(model=endpoint.deployment or model, **kwargs)
+            _CHAT_CLIENTS[client_key] = chat
+    return chat
+
+
+def get_request_params(temperature=1.0, max_tokens=0):
+    return {
+        "temperature": temperature,
+        "max_tokens": max_tokens if max_tokens > 0 else None,
+    }
+
+
+def warmup_chat_clients(timeout=5.0):
+    """
+    Create the clients of all the models and endpoints and open a connection to
+    the apis, so the first request does not pay for them.
+    """
+    import openai
+
+    api_bases = {os.environ.get("OPENAI_API_BASE", openai.api_base)}
+    for model_name in get_all_models():
+        for endpoint in get_endpoints(model_name):
+            if endpoint.api_base:
+                api_bases.add(endpoint.api_base)
+            for streaming in [False, True]:
+                try:
+                    get_chat(model_name, streaming=streaming, endpoint=endpoint)
+                except Exception as e:
+                    logging.warning(
+                        "failed to create the chat of %r: %r", endpoint.name, e
+                    )
+
+    for openai_api_base in api_bases:
+        try:
+            # any response is fine, it only opens a keep-alive connection
+            get_requests_session().head(openai_api_base, timeout=timeout)
+        except requests.RequestException as e:
+            logging.warning("failed to connect to %r: %r", openai_api_base, e)
+
+
+def get_context_size(model_name=None):
+    model = get_current_model(model_name)
+    context_sizes = dict(MODEL_CONTEXT_SIZES)
+    for item in os.getenv("OPENAI_MODEL_CONTEXT_SIZES", "").split(","):
+        if "=" in item:
+            name, size = item.split("=", 1)
+            context_sizes[name.strip()] = int(size)
+
+    prefixes = [name for name in context_sizes if model.startswith(name)]
+    if not prefixes:
+        return get_default_context_size(model)
+    return context_sizes[max(prefixes, key=len)]
+
+
+@functools.lru_cache(maxsize=None)
+def get_default_context_size(model):
+    # once per model, the prompts may be cut more than needed
+    logging.warning(
+        "unknown context size of model %r, assume %d tokens, "
+        "see OPENAI_MODEL_CONTEXT_SIZES",
+        model,
+        DEFAULT_CONTEXT_SIZE,
+    )
+    return DEFAULT_CONTEXT_SIZE
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    if tiktoken is None:
+        return None
+    # the encoding of all the chat models
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text):
+    """
+    Count the tokens of a text, memoized by a hash of the content (the texts are
+    not kept) since the same messages are counted again at every turn of a
+    conversation.
+    """
+    key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    num_tokens = _TOKEN_COUNTS.get(key)
+    if num_tokens is None:
+        num_tokens = encode_and_count_tokens(text)
+        # size 1: the cache is bounded by its number of entries
+        _TOKEN_COUNTS.put(key, num_tokens, 1)
+    return num_tokens
 
-    if "max_tokens" in kwargs:
-        max_tokens = kwargs["max_tokens"]
-        max_tokens = max_tokens if max_tokens > 0 else None
-        kwargs["max_tokens"] = max_tokens
 
-    model_name = None
-    if "model_name" in kwargs:
-        model_name = kwargs["model_name"]
+def encode_and_count_tokens(text):
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # estimate: ~4 characters per token, but ~1 token per CJK character
+    num_ascii = sum(1 for c in text if ord(c) < 128)
+    return (num_ascii + 3) // 4 + (len(text) - num_ascii)
 
-    if openai_api_type == "azure":
-        if "deployment_name" not in kwargs:
-            kwargs["deployment_name"] = get_current_model(model_name)
-        chat = AzureChatOpenAI(**kwargs)
-        return chat
-    else:
-        if "model" not in kwargs:
-            kwargs["model"] = get_current_model(model_name)
-        chat = ChatOpenAI(**kwargs)
-        return chat
+
+def count_message_tokens(message):
+    # each message is wrapped with ~4 tokens (role, separators)
+    return count_tokens(message.content) + 4
+
+
+class ContextLengthError(ValueError):
+    """
+    The prompt does not fit the context of the model, see `fit_messages_to_context`.
+    """
+
+    def __init__(self, message, info):
+        super().__init__(message)
+        self.info = info
+
+
+def fit_messages_to_context(messages, model_name=None, max_tokens=0):
+    """
+    Drop the oldest messages (but never the system message and the last message)
+    until the prompt fits the context of the model, leaving room for the reply.
+    If the last message alone does not fit, its beginning is cut, down to
+    CHAT_MIN_MESSAGE_TOKENS tokens. The reply gets at most the rest of the context.
+
+    Return the messages kept, and a dict of info about what was dropped, with the
+    tokens left for the reply ("reply_tokens"). Raise `ContextLengthError` if the
+    prompt does not fit even so (e.g. with a long system message).
+    """
+    from langchain.schema import SystemMessage
+
+    system_messages = [m for m in messages if isinstance(m, SystemMessage)]
+    other_messages = [m for m in messages if not isinstance(m, SystemMessage)]
+    num_tokens = [count_message_tokens(m) for m in other_messages]
+    total_tokens = sum(count_message_tokens(m) for m in system_messages)
+
+    # the system messages and the last message cut to its minimum
+    min_prompt_tokens = total_tokens
+    if num_tokens:
+        min_prompt_tokens += min(num_tokens[-1], CHAT_MIN_MESSAGE_TOKENS + 4)
+
+    context_size = get_context_size(model_name)
+    reply_tokens = max_tokens if max_tokens > 0 else CHAT_REPLY_RESERVED_TOKENS
+    # every reply is primed with 3 tokens
+    reply_tokens = min(reply_tokens, context_size - 3 - min_prompt_tokens)
+    budget = context_size - reply_tokens
+    if CHAT_CONTEXT_BUDGET > 0:
+        budget = min(budget, CHAT_CONTEXT_BUDGET)
+    budget -= 3
+
+    # keep the newest messages which fit
+    num_kept = 0
+    for tokens in reversed(num_tokens):
+        if num_kept > 0 and total_tokens + tokens > budget:
+            break
+        total_tokens += tokens
+        num_kept += 1
+
+    info = {
+        "context_size": context_size,
+        "budget": budget,
+        "reply_tokens": reply_tokens,
+        "prompt_tokens": total_tokens,
+        "dropped_messages": len(other_messages) - num_kept,
+        "dropped_tokens": sum(num_tokens[: len(other_messages) - num_kept]),
+        "cut_tokens": 0,
+    }
+    if reply_tokens <= 0 or min_prompt_tokens > budget:
+        raise ContextLengthError(
+            f"the prompt does not fit the context of {context_size} tokens: the "
+            f"system message and the last message need at least {min_prompt_tokens} "
+            f"tokens, the budget of the prompt is {budget} tokens",
+            info,
+        )
+
+    kept_messages = other_messages[len(other_messages) - num_kept :]
+    if kept_messages and total_tokens > budget:
+        last_message = kept_messages[-1]
+        num_cut_tokens = total_tokens - budget
+        # the estimate of the cut length is coarse, but the content stays readable
+        cut_ratio = min(1.0, num_cut_tokens / max(1, num_tokens[-1]))
+        cut_length = int(len(last_message.content) * cut_ratio)
+        kept_messages[-1] = last_message.__class__(
+            content=last_message.content[cut_length:]
+        )
+        info["prompt_tokens"] -= num_cut_tokens
+        info["cut_tokens"] = num_cut_tokens
+
+    return system_messages + kept_messages, info
+
+
+class ResponseCache:
+    """
+    Cache the responses of the model by request: an in-memory LRU tier in front of
+    an on-disk tier (in the state db) with a time-to-live.
+    """
+
+    def __init__(self, memory_bytes, disk_bytes, ttl):
+        self.memory = LRUCache(memory_bytes)
+        self.disk = DiskCache(get_store(), "responses", max_bytes=disk_bytes, ttl=ttl)
+
+    @staticmethod
+    def make_key(messages, model_name, temperature, max_tokens):
+        normalized_messages = [
+            (
+                m.type,
+                "\n".join(line.rstrip() for line in m.content.strip().splitlines()),
+            )
+            for m in messages
+        ]
+        request = [normalized_messages, model_name, temperature, max_tokens]
+        request = json.dumps(request, ensure_ascii=False)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        content = self.memory.get(key)
+        if content is None:
+            content = self.disk.get(key)
+            if content is not None:
+                self.memory.put(key, content, len(content))
+        return content
+
+    def put(self, key, content):
+        self.memory.put(key, content, len(content))
+        self.disk.put(key, content)
+
+    def stats(self):
+        memory_stats = self.memory.stats()
+        disk_stats = self.disk.stats()
+        # every memory miss is looked up on disk
+        num_requests = memory_stats["hits"] + memory_stats["misses"]
+        num_hits = memory_stats["hits"] + disk_stats["hits"]
+        return {
+            "requests": num_requests,
+            "hits": num_hits,
+            "hit_rate": num_hits / num_requests if num_requests else 0.0,
+            "memory": memory_stats,
+            "disk": disk_stats,
+        }
+
+
+_RESPONSE_CACHE = None
+
+
+def get_response_cache():
+    global _RESPONSE_CACHE
+    with _CHAT_CLIENTS_LOCK:
+        if _RESPONSE_CACHE is None:
+            _RESPONSE_CACHE = ResponseCache(
+                CHAT_CACHE_MEMORY_BYTES, CHAT_CACHE_DISK_BYTES, CHAT_CACHE_TTL
+            )
+    return _RESPONSE_CACHE
+
+
+def get_response_cache_stats():
+    return get_response_cache().stats()
 
 
 def get_chat_system_message():
@@ -60,6 +441,8 @@ def make_langchain_history(gradio_history, message=None, system_message=None):
     """
     Make a history in the format of langchain from gradio history
     """
+    from langchain.schema import AIMessage, HumanMessage, SystemMessage
+
     history_langchain_format = []
 
     # append the system message
@@ -82,21 +465,73 @@ def make_langchain_history(gradio_history, message=None, system_message=None):
     return history_langchain_format
 
 
-def generate_new_messages(
-    message, history, system_message=None, temperature=1.0, max_tokens=0
-):
-    chat = get_chat(temperature=temperature, max_tokens=max_tokens)
-    history_langchain_format = make_langchain_history(
-        gradio_history=history, message=message, system_message=system_message
-    )
+async def coalesce_tokens(tokens, interval=0.0, min_chars=0):
+    """
+    Buffer the tokens of an async iterator and yield them joined in chunks: at most
+    every `interval` seconds, or when `min_chars` characters are buffered. The
+    buffered tokens are yielded when the interval has passed even if no new token
+    arrives, and the tail is yielded as soon as the iterator is exhausted.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = tokens.__aiter__()
+
+    buffer = []
+    num_chars = 0
+    last_yield_time = loop.time()
+    next_token = None
+    try:
+        while True:
+            if next_token is None:
+                next_token = asyncio.ensure_future(iterator.__anext__())
+
+            timeout = None
+            if buffer:
+                timeout = max(0.0, last_yield_time + interval - loop.time())
+            # do not cancel `next_token` on timeout, it would close the iterator
+            done, _ = await asyncio.wait([next_token], timeout=timeout)
+
+            if done:
+                try:
+                    token = next_token.result()
+                except StopAsyncIteration:
+                    next_token = None
+                    break
+                next_token = None
+                buffer.append(token)
+                num_chars += len(token)
+
+            if buffer and (
+                loop.time() - last_yield_time >= interval
+                or (min_chars and num_chars >= min_chars)
+            ):
+                yield "".join(buffer)
+                buffer.clear()
+                num_chars = 0
+                last_yield_time = loop.time()
+    finally:
+        if next_token is not None:
+            next_token.cancel()
+
+    if buffer:
+        yield "".join(buffer)
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_callback_handler_class():
+    """
+    The class of the callback handlers passing the streamed tokens to `on_token`,
+    defined on first use since its base class is langchain's.
+    """
+    from langchain.callbacks.base import AsyncCallbackHandler
 
-    # log the actual history
-    logging.info("History: %r", history_langchain_format)
+    class TokenCallbackHandler(AsyncCallbackHandler):
+        def __init__(self, on_token):
+            self.on_token = on_token
 
-    response = chat(history_langchain_format)
+        async def on_llm_new_token(self, token, **kwargs):
+            await self.on_token(token)
 
-    new_messages = [response]
-    return new_messages
+    return TokenCallbackHandler
 
 
 async def agenerate_new_text(
@@ -107,48 +542,166 @@ async def agenerate_new_text(
     system_message=None,
     temperature=1.0,
     max_tokens=0,
+    stream_interval=None,
+    stream_min_chars=None,
+    info=None,
+    username=None,
+    use_cache=None,
 ):
+    """
+    info: if given, it is updated with the info of the context, see
+    `fit_messages_to_context`, the seconds waited for the rate limits of the model
+    ("queue_wait"), whether the reply is a cached one ("cached"), and the error of
+    the api call if any ("error"). The prompts
+    which do not fit the context are reported there too (nothing is yielded),
+    otherwise they raise `ContextLengthError`.
+
+    max_tokens: at most the tokens left by the prompt in the context
+
+    username: the requests are scheduled fairly between users, see
+    `schedule_utils.ModelScheduler`
+
+    use_cache: reuse the reply of the same request (yielded at once), and cache the
+    complete replies, by default only when the temperature is at most
+    CHAT_CACHE_MAX_TEMPERATURE
+
+    The call is routed to the endpoints of the model, retried and hedged, see
+    `route_utils.arun_routed`.
+    """
+    import openai
+    from langchain.callbacks import AsyncIteratorCallbackHandler
+
     messages = make_langchain_history(
         gradio_history=history, message=message, system_message=system_message
     )
+    try:
+        messages, context_info = fit_messages_to_context(
+            messages, model_name=model_name, max_tokens=max_tokens
+        )
+    except ContextLengthError as e:
+        if info is None:
+            raise
+        logging.warning("Context: %s", e)
+        info.update(e.info, error=str(e))
+        return
+    if info is not None:
+        info.update(context_info)
+    if max_tokens > 0:
+        max_tokens = context_info["reply_tokens"]
 
     if return_history:
         # append pending bot message
         history[-1][1] = ""
 
+    model = get_current_model(model_name)
+    if use_cache is None:
+        use_cache = temperature <= CHAT_CACHE_MAX_TEMPERATURE
+    cache_key = None
+    if use_cache:
+        cache = get_response_cache()
+        cache_key = cache.make_key(messages, model, temperature, max_tokens)
+        # the disk tier of the cache is a sqlite table, off the event loop
+        content = await asyncio.to_thread(cache.get, cache_key)
+        if info is not None:
+            info["cached"] = content is not None
+        if content is not None:
+            logging.info("Cache hit: %s", cache_key)
+            if return_history:
+                history[-1][1] = content
+                yield history
+            else:
+                yield content
+            return
+
+    # wait for the rate limits of the model, the max tokens count as well
+    scheduler = get_scheduler(model)
+    queue_wait = await scheduler.acquire(
+        username, context_info["prompt_tokens"] + max_tokens
+    )
+    CHAT_QUEUE_WAIT.observe(queue_wait, model)
+    if info is not None:
+        info["queue_wait"] = queue_wait
+
     # log the actual history
     logging.info("Messages: %r", messages)
 
     handler = AsyncIteratorCallbackHandler()
+    start_time = time.perf_counter()
+    first_token_time = None
+    num_tokens = 0
+    error = None
+
+    async def on_token(token):
+        nonlocal first_token_time, num_tokens
+        if first_token_time is None:
+            first_token_time = time.perf_counter()
+        num_tokens += 1
+        await handler.on_llm_new_token(token)
+
+    def observe_stream():
+        end_time = time.perf_counter()
+        CHAT_STREAM_SECONDS.observe(end_time - start_time, model)
+        CHAT_TOKENS.inc(model, amount=num_tokens)
+        if first_token_time is not None:
+            CHAT_TIME_TO_FIRST_TOKEN.observe(first_token_time - start_time, model)
+            if num_tokens > 1 and end_time > first_token_time:
+                CHAT_TOKENS_PER_SECOND.observe(
+                    (num_tokens - 1) / (end_time - first_token_time), model
+                )
 
     async def wrap_done(fn, event: asyncio.Event):
         """Wrap an awaitable with a event to signal when it's done or an exception is raised."""
+        nonlocal error
+        CHAT_ACTIVE_STREAMS.inc(model)
         try:
             await fn
         except Exception as e:
+            error = e
             logging.error("Exception: %r", e)
+            if isinstance(e, openai.error.RateLimitError):
+                scheduler.pause()
+            if info is not None:
+                info["error"] = str(e) or repr(e)
         finally:
+            CHAT_ACTIVE_STREAMS.dec(model)
+            observe_stream()
             event.set()  # Signal the aiter to stop.
 
-    chat = get_chat(
-        streaming=True,
-        callbacks=[handler],
-        model_name=model_name,
-        temperature=temperature,
-        max_tokens=max_tokens,
-    )
+    async def run_attempt(endpoint, on_token):
+        chat = get_chat(model_name=model_name, streaming=True, endpoint=endpoint)
+        await chat.agenerate(
+            messages=[messages],
+            callbacks=[get_token_callback_handler_class()(on_token)],
+            **get_request_params(temperature=temperature, max_tokens=max_tokens),
+        )
+
+    # the task copies the context, so the api calls use the shared session
+    openai.aiosession.set(get_aiohttp_session())
     task = asyncio.create_task(
-        wrap_done(chat.agenerate(messages=[messages]), handler.done)
+        wrap_done(
+            arun_routed(model, run_attempt, on_token),
+            handler.done,
+        )
     )
 
+    if stream_interval is None:
+        stream_interval = CHAT_STREAM_INTERVAL
+    if stream_min_chars is None:
+        stream_min_chars = CHAT_STREAM_MIN_CHARS
+
     content = ""
-    async for token in handler.aiter():
-        content += token
+    async for chunk in coalesce_tokens(
+        handler.aiter(), interval=stream_interval, min_chars=stream_min_chars
+    ):
+        content += chunk
         if return_history:
             # only update the bot message in the last item
-            history[-1][1] += token
+            history[-1][1] = content
             yield history
         else:
             yield content
 
     await task
+    # only the complete replies, not the ones cut by an error
+    if cache_key is not None and error is None and content.strip():
+        await asyncio.to_thread(cache.put, cache_key, content)
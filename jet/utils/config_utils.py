@@ -0,0 +1,21 @@
+import logging
+import threading
+
+import dotenv
+
+_LOADED = False
+_LOCK = threading.Lock()
+
+
+def load_config():
+    """
+    Load the .env file (without overriding the environment) and configure the
+    logging, once per process. Called by each module before reading its settings.
+    """
+    global _LOADED
+    with _LOCK:
+        if _LOADED:
+            return
+        dotenv.load_dotenv()
+        logging.basicConfig(level=logging.INFO)
+        _LOADED = True
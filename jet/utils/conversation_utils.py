@@ -0,0 +1,410 @@
+import os
+import json
+import time
+import logging
+import threading
+
+import click
+from utils.db_utils import get_store, encode_key_db, read_user_states
+
+# max number of conversations listed (the most recently updated ones), older ones
+# are found by searching their titles
+CONVERSATION_LIST_LIMIT = int(os.getenv("CONVERSATION_LIST_LIMIT", "100"))
+
+
+def encode_message(message):
+    return json.dumps(message, ensure_ascii=False)
+
+
+def decode_message(message):
+    return json.loads(message)
+
+
+def make_title(history, max_length=50):
+    for human, _ in history:
+        if isinstance(human, str) and human.strip():
+            title = " ".join(human.split())
+            if len(title) > max_length:
+                title = title[: max_length - 3] + "..."
+            return title
+    return ""
+
+
+class ConversationStore:
+    """
+    Store the chat histories as rows: one row per conversation and one row per
+    message pair (`[human, ai]` in the gradio Chatbot format).
+
+    Saving a history only writes the message rows that have changed since the
+    last save, e.g. only the last one when a reply is streamed into it. To find
+    them, the hashes of the saved rows of each conversation are kept in memory,
+    with the version of the conversation they were read or written at. Each save
+    increments the version, so when another process (a worker sharing the db) has
+    saved the conversation since, its rows are read again.
+
+    Deleted conversations are recorded (their keys are never reused), so a late
+    save, e.g. of a reply still streamed into it, does not create them again.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+        # (username, key) -> (conversation_id, version, row hashes)
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+        with self.store.transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "id INTEGER PRIMARY KEY, "
+                "username TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "title TEXT NOT NULL DEFAULT '', "
+                "num_messages INTEGER NOT NULL DEFAULT 0, "
+                "created_at REAL NOT NULL, "
+                "updated_at REAL NOT NULL, "
+                "UNIQUE (username, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "conversation_id INTEGER NOT NULL, "
+                "idx INTEGER NOT NULL, "
+                "human TEXT, "
+                "ai TEXT, "
+                "PRIMARY KEY (conversation_id, idx)) WITHOUT ROWID"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS conversations_username_updated_at "
+                "ON conversations (username, updated_at)"
+            )
+            # the users whose pickled histories have been migrated, see
+            # `migrate_user_histories`
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS migrated_users ("
+                "username TEXT PRIMARY KEY, migrated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS deleted_conversations ("
+                "username TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "deleted_at REAL NOT NULL, "
+                "PRIMARY KEY (username, key)) WITHOUT ROWID"
+            )
+            columns = [
+                row[1] for row in conn.execute("PRAGMA table_info(conversations)")
+            ]
+            if "version" not in columns:
+                conn.execute(
+                    "ALTER TABLE conversations "
+                    "ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+                )
+
+    def load_histories(self, username, keys):
+        """
+        Return a dict of the histories of the given conversations (in the gradio
+        Chatbot format), missing conversations are omitted.
+        """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+
+        conn = self.store.connect()
+        placeholders = ",".join("?" * len(keys))
+        conversations = {}  # key -> (id, version)
+        # in one read transaction, so the messages match the versions
+        conn.execute("BEGIN")
+        try:
+            rows = conn.execute(
+                "SELECT key, id, version FROM conversations "
+                f"WHERE username = ? AND key IN ({placeholders})",
+                [username, *keys],
+            )
+            for key, conversation_id, version in rows:
+                conversations[key] = (conversation_id, version)
+            histories = {key: [] for key in conversations}
+            hashes = {key: [] for key in conversations}
+
+            if conversations:
+                keys_by_id = {id: key for key, (id, _) in conversations.items()}
+                placeholders = ",".join("?" * len(keys_by_id))
+                rows = conn.execute(
+                    "SELECT conversation_id, human, ai FROM messages "
+                    f"WHERE conversation_id IN ({placeholders}) "
+                    "ORDER BY conversation_id, idx",
+                    list(keys_by_id),
+                )
+                for conversation_id, human, ai in rows:
+                    key = keys_by_id[conversation_id]
+                    histories[key].append([decode_message(human), decode_message(ai)])
+                    hashes[key].append(hash((human, ai)))
+        finally:
+            conn.execute("COMMIT")
+
+        with self._lock:
+            for key, (conversation_id, version) in conversations.items():
+                snapshot = self._snapshots.get((username, key))
+                # unless a concurrent save has already written a newer one
+                if (
+                    snapshot is None
+                    or snapshot[0] != conversation_id
+                    or snapshot[1] <= version
+                ):
+                    self._snapshots[(username, key)] = (
+                        conversation_id,
+                        version,
+                        hashes[key],
+                    )
+        return histories
+
+    def save_histories(self, username, mapping):
+        """
+        Save the histories of many conversations of a user in one transaction.
+        """
+        if not mapping:
+            return
+
+        now = time.time()
+        with self._lock, self.store.transaction() as conn:
+            for key, history in mapping.items():
+                history = history or []
+                rows = [(encode_message(h), encode_message(a)) for h, a in history]
+                row_hashes = [hash(row) for row in rows]
+
+                snapshot = self._snapshots.get((username, key))
+                if snapshot is None or not self._is_current(
+                    conn, username, key, snapshot
+                ):
+                    if self._is_deleted(conn, username, key):
+                        logging.info(
+                            "conversation %r of %r is deleted, not saved", key, username
+                        )
+                        continue
+                    snapshot = self._read_snapshot(conn, username, key, now)
+                conversation_id, version, saved_hashes = snapshot
+
+                changed = [
+                    (conversation_id, idx, *row)
+                    for idx, row in enumerate(rows)
+                    if idx >= len(saved_hashes) or saved_hashes[idx] != row_hashes[idx]
+                ]
+                conn.executemany(
+                    "REPLACE INTO messages (conversation_id, idx, human, ai) "
+                    "VALUES (?, ?, ?, ?)",
+                    changed,
+                )
+                if len(saved_hashes) > len(rows):
+                    conn.execute(
+                        "DELETE FROM messages WHERE conversation_id = ? AND idx >= ?",
+                        (conversation_id, len(rows)),
+                    )
+                conn.execute(
+                    "UPDATE conversations SET num_messages = ?, updated_at = ?, "
+                    "version = version + 1, "
+                    "title = CASE WHEN title = '' THEN ? ELSE title END "
+                    "WHERE id = ?",
+                    (len(rows), now, make_title(history), conversation_id),
+                )
+                self._snapshots[(username, key)] = (
+                    conversation_id,
+                    version + 1,
+                    row_hashes,
+                )
+
+    def list_conversations(self, username, query="", limit=CONVERSATION_LIST_LIMIT):
+        """
+        Return the non empty conversations of a user, the most recently updated
+        first, as dicts of key, title, num_messages, created_at and updated_at.
+
+        query: only the conversations whose title contains it (case insensitive)
+        """
+        rows = self.store.connect().execute(
+            "SELECT key, title, num_messages, created_at, updated_at "
+            "FROM conversations WHERE username = ? AND num_messages > 0 "
+            "AND (? = '' OR instr(lower(title), lower(?)) > 0) "
+            "ORDER BY updated_at DESC LIMIT ?",
+            (username, query, query, limit),
+        )
+        names = ["key", "title", "num_messages", "created_at", "updated_at"]
+        return [dict(zip(names, row)) for row in rows]
+
+    def delete_conversation(self, username, key):
+        with self._lock, self.store.transaction() as conn:
+            row = conn.execute(
+                "SELECT id FROM conversations WHERE username = ? AND key = ?",
+                (username, key),
+            ).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM messages WHERE conversation_id = ?", row)
+                conn.execute("DELETE FROM conversations WHERE id = ?", row)
+            conn.execute(
+                "INSERT OR REPLACE INTO deleted_conversations "
+                "(username, key, deleted_at) VALUES (?, ?, ?)",
+                (username, key, time.time()),
+            )
+            self._snapshots.pop((username, key), None)
+
+    @staticmethod
+    def _is_current(conn, username, key, snapshot):
+        """
+        Whether the conversation has not been saved (or deleted) by another
+        process since the snapshot.
+        """
+        row = conn.execute(
+            "SELECT id, version FROM conversations WHERE username = ? AND key = ?",
+            (username, key),
+        ).fetchone()
+        return row is not None and tuple(row) == snapshot[:2]
+
+    @staticmethod
+    def _is_deleted(conn, username, key):
+        row = conn.execute(
+            "SELECT 1 FROM deleted_conversations WHERE username = ? AND key = ?",
+            (username, key),
+        ).fetchone()
+        return row is not None
+
+    def _read_snapshot(self, conn, username, key, now):
+        conn.execute(
+            "INSERT OR IGNORE INTO conversations "
+            "(username, key, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (username, key, now, now),
+        )
+        conversation_id, version = conn.execute(
+            "SELECT id, version FROM conversations WHERE username = ? AND key = ?",
+            (username, key),
+        ).fetchone()
+        rows = conn.execute(
+            "SELECT human, ai FROM messages WHERE conversation_id = ? ORDER BY idx",
+            (conversation_id,),
+        )
+        return conversation_id, version, [hash(tuple(row)) for row in rows]
+
+
+_CONVERSATION_STORE = None
+_CONVERSATION_STORE_LOCK = threading.Lock()
+_MIGRATED_USERS = set()
+
+
+def get_conversation_store():
+    global _CONVERSATION_STORE
+    if _CONVERSATION_STORE is None:
+        with _CONVERSATION_STORE_LOCK:
+            if _CONVERSATION_STORE is None:
+                _CONVERSATION_STORE = ConversationStore(get_store())
+    return _CONVERSATION_STORE
+
+
+def load_histories(username, keys):
+    """
+    Load the histories of many conversations of a user in one query.
+
+    The conversations that have not been migrated yet are loaded from the pickled
+    histories of the user state, and migrated.
+    """
+    histories = get_conversation_store().load_histories(username, keys)
+
+    missing_keys = [key for key in keys if key not in histories]
+    legacy_histories = {
+        key: history
+        for key, history in read_user_states(username, missing_keys).items()
+        if isinstance(history, list)
+    }
+    if legacy_histories:
+        logging.info(
+            "migrating conversations %r of %r", list(legacy_histories), username
+        )
+        get_conversation_store().save_histories(username, legacy_histories)
+        histories.update(legacy_histories)
+    return histories
+
+
+def save_histories(username, mapping):
+    get_conversation_store().save_histories(username, mapping)
+
+
+def list_conversations(username, query="", limit=CONVERSATION_LIST_LIMIT):
+    if username not in _MIGRATED_USERS:
+        migrate_user_histories(username)
+    return get_conversation_store().list_conversations(username, query, limit)
+
+
+def delete_conversation(username, key):
+    get_conversation_store().delete_conversation(username, key)
+
+
+def migrate_user_histories(username, key_suffix="chat-chatbot"):
+    """
+    Migrate the pickled histories of a user, stored in the user state (whose keys
+    end with `key_suffix`, e.g. of the former chat tabs), to the conversation
+    store, so they are listed. The user states are kept.
+
+    Done once per user: the migrated users are recorded in the db, so the
+    conversations deleted afterwards are not migrated again.
+    Return the number of conversations migrated.
+    """
+    conversation_store = get_conversation_store()
+    store = conversation_store.store
+    conn = store.connect()
+    if conn.execute(
+        "SELECT 1 FROM migrated_users WHERE username = ?", (username,)
+    ).fetchone():
+        _MIGRATED_USERS.add(username)
+        return 0
+
+    # the keys of the user, by a range of the primary key
+    prefix = encode_key_db(username, "")
+    rows = conn.execute(
+        f'SELECT key FROM "{store.tablename}" WHERE key >= ? AND key < ?',
+        (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)),
+    )
+    keys = [key_db[len(prefix) :] for (key_db,) in rows if key_db.endswith(key_suffix)]
+
+    num_migrated = 0
+    if keys:
+        migrated = conversation_store.load_histories(username, keys)
+        legacy_keys = [encode_key_db(username, k) for k in keys if k not in migrated]
+        histories = {
+            key_db[len(prefix) :]: history
+            for key_db, history in store.get_many(legacy_keys).items()
+            if isinstance(history, list)
+        }
+        if histories:
+            logging.info("migrating conversations %r of %r", list(histories), username)
+            save_histories(username, histories)
+            num_migrated = len(histories)
+
+    with store.transaction() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO migrated_users (username, migrated_at) "
+            "VALUES (?, ?)",
+            (username, time.time()),
+        )
+    _MIGRATED_USERS.add(username)
+    return num_migrated
+
+
+def migrate_user_states(key_suffix="chat-chatbot"):
+    """
+    Migrate the pickled histories of all the users, see `migrate_user_histories`.
+    """
+    store = get_store()
+    rows = store.connect().execute(f'SELECT key FROM "{store.tablename}"')
+    usernames = {key_db.split("::", 1)[0] for (key_db,) in rows if "::" in key_db}
+    return sum(
+        migrate_user_histories(username, key_suffix) for username in sorted(usernames)
+    )
+
+
+@click.command()
+@click.option(
+    "--key-suffix",
+    default="chat-chatbot",
+    help="The suffix of the user state keys of the histories to migrate.",
+)
+def main(key_suffix):
+    num_migrated = migrate_user_states(key_suffix=key_suffix)
+    print(f"migrated {num_migrated} conversations")
+
+
+if __name__ == "__main__":
+    main()
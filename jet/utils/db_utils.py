@@ -1,11 +1,47 @@
 import os
+import abc
+import json
+import time
+import zlib
+import pickle
+import logging
+import sqlite3
+import threading
 import contextlib
+import collections
 from pathlib import Path
 
-import dotenv
-from sqlitedict import SqliteDict
+from utils.config_utils import load_config
+from utils.metrics_utils import STATE_STORE_BYTES, STATE_STORE_SECONDS
 
-dotenv.load_dotenv()
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+load_config()
+
+# max number of host parameters in a single query for old sqlite versions
+SQLITE_MAX_VARIABLES = 900
+
+DB_CACHE_BYTES = int(os.getenv("DB_CACHE_BYTES", str(64 * 1024 * 1024)))
+DB_CODEC = os.getenv("DB_CODEC", "json")
+DB_COMPRESSION = os.getenv("DB_COMPRESSION", "zlib")
+DB_COMPRESS_MIN_BYTES = int(os.getenv("DB_COMPRESS_MIN_BYTES", "1024"))
+# the backend of the user states only: "sqlite" (the state db) or "redis" (a redis
+# compatible server at DB_REDIS_URL). The conversations and the caches always stay
+# in the state db, so the workers must run on the same host either way
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite")
 
 
 def get_db_path():
@@ -17,26 +53,593 @@ def get_db_path():
     return db_path
 
 
-@contextlib.contextmanager
-def get_db():
-    db_path = get_db_path()
-    db = SqliteDict(db_path, autocommit=False, flag="c")
-    yield db
-    db.close()
+class Codec:
+    """
+    Encode the values as a header followed by the (optionally compressed) payload.
+
+    The header is `CODEC_MAGIC`, the format version and the ids of the serializer
+    and of the compression, so values stay readable when the settings change.
+    Values without the header are pickles written by `SqliteDict`.
+
+    serializer: "json" (tuples are loaded as lists), "msgpack" or "pickle"
+    compression: "zlib", "zstd" or "none", only used for payloads of at least
+    `compress_min_bytes` bytes
+    """
+
+    MAGIC = b"JT"
+    VERSION = b"\x01"
+
+    SERIALIZERS = {"json": b"j", "msgpack": b"m", "pickle": b"p"}
+    COMPRESSIONS = {"none": b"-", "zlib": b"z", "zstd": b"s"}
+
+    def __init__(self, serializer="json", compression="zlib", compress_min_bytes=1024):
+        assert serializer in self.SERIALIZERS, f"unknown serializer {serializer}"
+        assert compression in self.COMPRESSIONS, f"unknown compression {compression}"
+        if serializer == "msgpack" and msgpack is None:
+            raise ImportError("please install msgpack to use the msgpack serializer")
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("please install zstandard to use the zstd compression")
+
+        self.serializer = serializer
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes
+
+    @staticmethod
+    def serialize(serializer, value):
+        if serializer == "json":
+            if orjson is not None:
+                return orjson.dumps(value)
+            return json.dumps(value, ensure_ascii=False).encode("utf-8")
+        elif serializer == "msgpack":
+            return msgpack.packb(value)
+        else:
+            return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def deserialize(serializer, payload):
+        if serializer == "json":
+            return orjson.loads(payload) if orjson is not None else json.loads(payload)
+        elif serializer == "msgpack":
+            return msgpack.unpackb(payload)
+        else:
+            return pickle.loads(payload)
+
+    @staticmethod
+    def compress(compression, payload):
+        if compression == "zlib":
+            # level 1: ~5x faster than the default level, slightly bigger output
+            return zlib.compress(payload, 1)
+        elif compression == "zstd":
+            return zstandard.ZstdCompressor().compress(payload)
+        return payload
+
+    @staticmethod
+    def decompress(compression, payload):
+        if compression == "zlib":
+            return zlib.decompress(payload)
+        elif compression == "zstd":
+            return zstandard.ZstdDecompressor().decompress(payload)
+        return payload
+
+    def encode(self, value):
+        serializer = self.serializer
+        try:
+            payload = self.serialize(serializer, value)
+        except (TypeError, ValueError, OverflowError) as e:
+            # e.g. objects or non-str dict keys
+            logging.warning(
+                "can not serialize %r with %s, fallback to pickle: %r",
+                type(value),
+                serializer,
+                e,
+            )
+            serializer = "pickle"
+            payload = self.serialize(serializer, value)
+
+        compression = "none"
+        if self.compression != "none" and len(payload) >= self.compress_min_bytes:
+            compression = self.compression
+            payload = self.compress(compression, payload)
+
+        header = (
+            self.MAGIC
+            + self.VERSION
+            + self.SERIALIZERS[serializer]
+            + self.COMPRESSIONS[compression]
+        )
+        return header + payload
+
+    def decode(self, blob):
+        blob = bytes(blob)
+        if not blob.startswith(self.MAGIC):
+            return pickle.loads(blob)  # written by SqliteDict
+
+        version, serializer_id, compression_id = blob[2:3], blob[3:4], blob[4:5]
+        assert version == self.VERSION, f"unknown format version {version!r}"
+        serializer = _find_key(self.SERIALIZERS, serializer_id)
+        compression = _find_key(self.COMPRESSIONS, compression_id)
+        payload = self.decompress(compression, blob[5:])
+        return self.deserialize(serializer, payload)
+
+
+def _find_key(mapping, value):
+    for k, v in mapping.items():
+        if v == value:
+            return k
+    raise ValueError(f"unknown id {value!r}")
+
+
+class LRUCache:
+    """
+    A thread-safe LRU cache bounded by the total size (in bytes) of its values.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._items = collections.OrderedDict()  # key -> (value, size)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._total_bytes -= evicted_size
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._total_bytes = 0
+
+    def _discard(self, key):
+        if key in self._items:
+            _, size = self._items.pop(key)
+            self._total_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._items),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class StateBackend(abc.ABC):
+    """
+    The interface of the key-value stores of the user states, behind
+    `read_user_states` and `update_user_states` (see `get_state_backend`).
+
+    Keys are str, values are anything `Codec` encodes. A `set_many` is atomic:
+    concurrent readers, in this process or another one, see all of its items or
+    none of them. Concurrent writes of the same key are applied in some order, the
+    last one wins.
+    """
+
+    @abc.abstractmethod
+    def get_many(self, keys):
+        """
+        Return a dict with the values of the given keys, missing keys are omitted.
+        """
+
+    @abc.abstractmethod
+    def set_many(self, mapping):
+        """
+        Write all items of `mapping` at once.
+        """
+
+    def close(self):
+        pass
+
+
+class StateStore(StateBackend):
+    """
+    A long-lived key-value store on a single SQLite file in WAL mode.
+
+    It uses the same table layout as `SqliteDict`, and `Codec` reads its pickled
+    values, so existing db files stay readable. Each thread lazily opens (and then
+    reuses) its own connection, so it is safe to share one store across gradio's
+    worker threads, and many processes can share the file.
+
+    Encoded values are cached in memory (read-through and write-through). Each
+    write also increments a generation number in the db, so when a read or a write
+    finds that another process has written since, the cache is cleared.
+    """
+
+    def __init__(self, path, tablename="unnamed", cache_bytes=0, codec=None):
+        self.path = str(path)
+        self.tablename = tablename
+        self.generation_tablename = f"{tablename}_generation"
+        self.codec = codec if codec is not None else Codec()
+        self.cache = LRUCache(cache_bytes) if cache_bytes > 0 else None
+        # to not cache values read while a write is in progress
+        self._write_seq = 0
+        self._writes_in_progress = 0
+        # the last generation seen, the cache holds no value older than it
+        self._generation = 0
+        self._write_seq_lock = threading.Lock()
+
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+        with self.transaction() as conn:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.tablename}" '
+                "(key TEXT PRIMARY KEY, value BLOB)"
+            )
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.generation_tablename}" '
+                "(id INTEGER PRIMARY KEY CHECK (id = 0), generation INTEGER NOT NULL)"
+            )
+            conn.execute(
+                f'INSERT OR IGNORE INTO "{self.generation_tablename}" '
+                "(id, generation) VALUES (0, 0)"
+            )
+            self._generation = self._read_generation(conn)
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit mode, transactions are managed explicitly
+            conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA cache_size=-16000")  # 16 MiB
+            conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def encode(self, value):
+        return sqlite3.Binary(self.codec.encode(value))
+
+    def decode(self, blob):
+        return self.codec.decode(blob)
+
+    def _read_generation(self, conn):
+        (generation,) = conn.execute(
+            f'SELECT generation FROM "{self.generation_tablename}" WHERE id = 0'
+        ).fetchone()
+        return generation
+
+    def _observe_generation(self, generation, own_write=False):
+        """
+        Clear the cache if `generation` shows writes of other processes. Must be
+        called with `_write_seq_lock` held.
+        """
+        # the writes of this store are serialized by the write lock of the db, so
+        # the generation of one of them directly follows the last one seen
+        last_own_generation = self._generation + 1 if own_write else self._generation
+        if generation > last_own_generation:
+            # also prevents the reads in progress from caching older values
+            self._write_seq += 1
+            self.cache.clear()
+        self._generation = max(self._generation, generation)
+
+    def get_many(self, keys):
+        """
+        Return a dict with the values of the given keys, missing keys are omitted.
+        """
+        start = time.perf_counter()
+        keys = list(dict.fromkeys(keys))
+
+        blobs = {}
+        if self.cache is not None:
+            generation = self._read_generation(self.connect())
+            with self._write_seq_lock:
+                self._observe_generation(generation)
+            missing_keys = []
+            for key in keys:
+                blob = self.cache.get(key, _MISSING)
+                if blob is _MISSING:
+                    missing_keys.append(key)
+                elif blob is not None:  # None: known to be absent
+                    blobs[key] = blob
+        else:
+            missing_keys = keys
+
+        if missing_keys:
+            with self._write_seq_lock:
+                write_seq = self._write_seq
+                cacheable = self._writes_in_progress == 0
+            conn = self.connect()
+
+            read_blobs = {}
+            for i in range(0, len(missing_keys), SQLITE_MAX_VARIABLES):
+                batch = missing_keys[i : i + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f'SELECT key, value FROM "{self.tablename}" '
+                    f"WHERE key IN ({placeholders})",
+                    batch,
+                )
+                for key, blob in rows:
+                    read_blobs[key] = bytes(blob)
+            blobs.update(read_blobs)
+
+            if self.cache is not None and cacheable:
+                # under the lock, so no write starts between the check and the puts
+                with self._write_seq_lock:
+                    if write_seq == self._write_seq:
+                        for key in missing_keys:
+                            blob = read_blobs.get(key)
+                            self.cache.put(key, blob, len(key) + len(blob or b""))
+
+        STATE_STORE_SECONDS.observe(time.perf_counter() - start, self.tablename, "read")
+        STATE_STORE_BYTES.observe(
+            sum(len(blob) for blob in blobs.values()), self.tablename, "read"
+        )
+        return {key: self.decode(blob) for key, blob in blobs.items()}
+
+    def set_many(self, mapping):
+        """
+        Write all items of `mapping` in a single transaction.
+        """
+        start = time.perf_counter()
+        rows = [(key, self.encode(value)) for key, value in mapping.items()]
+        if not rows:
+            return
+        with self._write_seq_lock:
+            self._write_seq += 1
+            self._writes_in_progress += 1
+        try:
+            with self.transaction() as conn:
+                conn.executemany(
+                    f'REPLACE INTO "{self.tablename}" (key, value) VALUES (?, ?)', rows
+                )
+                conn.execute(
+                    f'UPDATE "{self.generation_tablename}" '
+                    "SET generation = generation + 1 WHERE id = 0"
+                )
+                if self.cache is not None:
+                    generation = self._read_generation(conn)
+                    with self._write_seq_lock:
+                        self._observe_generation(generation, own_write=True)
+                    # update the cache while holding the write lock of the db, so
+                    # concurrent writes update it in the same order as the db
+                    for key, blob in rows:
+                        self.cache.put(key, bytes(blob), len(key) + len(blob))
+        except BaseException:
+            if self.cache is not None:
+                with self._write_seq_lock:
+                    # the generation seen may not have been committed, forget it
+                    self._write_seq += 1
+                    self.cache.clear()
+                    self._generation = -1
+            raise
+        finally:
+            with self._write_seq_lock:
+                self._write_seq += 1
+                self._writes_in_progress -= 1
+        STATE_STORE_SECONDS.observe(
+            time.perf_counter() - start, self.tablename, "write"
+        )
+        STATE_STORE_BYTES.observe(
+            sum(len(blob) for _, blob in rows), self.tablename, "write"
+        )
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class DiskCache:
+    """
+    A cache in a table of the state db, with a time-to-live and a max total size.
+    When the size is exceeded, the least recently used entries are evicted.
+    """
+
+    def __init__(self, store, name, max_bytes, ttl):
+        self.store = store
+        self.tablename = f"cache_{name}"
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        with self.store.transaction() as conn:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.tablename}" ('
+                "key TEXT PRIMARY KEY, "
+                "value BLOB NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "accessed_at REAL NOT NULL)"
+            )
+            conn.execute(
+                f'CREATE INDEX IF NOT EXISTS "{self.tablename}_accessed_at" '
+                f'ON "{self.tablename}" (accessed_at)'
+            )
+
+    def get(self, key, default=None):
+        now = time.time()
+        row = (
+            self.store.connect()
+            .execute(
+                f'SELECT value FROM "{self.tablename}" '
+                "WHERE key = ? AND created_at >= ?",
+                (key, now - self.ttl),
+            )
+            .fetchone()
+        )
+        if row is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        with self.store.transaction() as conn:
+            conn.execute(
+                f'UPDATE "{self.tablename}" SET accessed_at = ? WHERE key = ?',
+                (now, key),
+            )
+        return self.store.decode(row[0])
+
+    def put(self, key, value):
+        blob = self.store.encode(value)
+        size = len(key) + len(blob)
+        if size > self.max_bytes:
+            return
+
+        now = time.time()
+        with self.store.transaction() as conn:
+            conn.execute(
+                f'REPLACE INTO "{self.tablename}" '
+                "(key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, blob, size, now, now),
+            )
+            conn.execute(
+                f'DELETE FROM "{self.tablename}" WHERE created_at < ?',
+                (now - self.ttl,),
+            )
+            (total_bytes,) = conn.execute(
+                f'SELECT COALESCE(SUM(size), 0) FROM "{self.tablename}"'
+            ).fetchone()
+            if total_bytes > self.max_bytes:
+                rows = conn.execute(
+                    f'SELECT key, size FROM "{self.tablename}" ORDER BY accessed_at'
+                )
+                evicted_keys = []
+                for evicted_key, evicted_size in rows:
+                    if total_bytes <= self.max_bytes:
+                        break
+                    evicted_keys.append((evicted_key,))
+                    total_bytes -= evicted_size
+                conn.executemany(
+                    f'DELETE FROM "{self.tablename}" WHERE key = ?', evicted_keys
+                )
+                self.evictions += len(evicted_keys)
+
+    def stats(self):
+        (entries, total_bytes) = (
+            self.store.connect()
+            .execute(f'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM "{self.tablename}"')
+            .fetchone()
+        )
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+_MISSING = object()
+_STORE = None
+_STATE_BACKEND = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_store():
+    global _STORE
+    if _STORE is None:
+        with _STORE_LOCK:
+            if _STORE is None:
+                codec = Codec(DB_CODEC, DB_COMPRESSION, DB_COMPRESS_MIN_BYTES)
+                _STORE = StateStore(
+                    get_db_path(), cache_bytes=DB_CACHE_BYTES, codec=codec
+                )
+    return _STORE
+
+
+def get_state_backend():
+    """
+    Return the backend of the user states, by DB_BACKEND: the state db itself
+    (`get_store`), or a `kv_utils.RedisStateStore`. Only the user states use it:
+    the conversations (`conversation_utils`) and the caches (`DiskCache`) are
+    always kept in the local state db.
+    """
+    global _STATE_BACKEND
+    if DB_BACKEND == "sqlite":
+        return get_store()
+    if _STATE_BACKEND is None:
+        with _STORE_LOCK:
+            if _STATE_BACKEND is None:
+                if DB_BACKEND != "redis":
+                    raise ValueError(f"unknown state backend {DB_BACKEND!r}")
+                from utils.kv_utils import get_redis_state_store
+
+                _STATE_BACKEND = get_redis_state_store()
+    return _STATE_BACKEND
+
+
+def get_cache_stats():
+    cache = get_store().cache
+    return cache.stats() if cache is not None else None
 
 
 def encode_key_db(username, key):
     return f"{username}::{key}"
 
 
+def read_user_states(username, keys):
+    """
+    Read many keys of a user in one query, return a dict of the keys found.
+    """
+    keys_db = {encode_key_db(username, key): key for key in keys}
+    states = get_state_backend().get_many(keys_db)
+    return {keys_db[key_db]: value for key_db, value in states.items()}
+
+
+def update_user_states(username, mapping):
+    """
+    Write many keys of a user in one transaction.
+    """
+    get_state_backend().set_many(
+        {encode_key_db(username, key): value for key, value in mapping.items()}
+    )
+
+
 def read_user_state(username, key=None, default=None):
-    with get_db() as db:
-        key_db = encode_key_db(username, key)
-        return db.get(key_db, default)
+    return read_user_states(username, [key]).get(key, default)
 
 
 def update_user_state(username, key, value):
-    with get_db() as db:
-        key_db = encode_key_db(username, key)
-        db[key_db] = value
-        db.commit()
+    update_user_states(username, {key: value})
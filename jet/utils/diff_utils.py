@@ -0,0 +1,294 @@
+import os
+import re
+import bisect
+import asyncio
+
+from utils.config_utils import load_config
+
+load_config()
+
+# beyond this many edits between two anchors, the region is reported as replaced
+# instead of searching further (the Myers diff is O(ND))
+DIFF_MAX_COST = int(os.getenv("DIFF_MAX_COST", "2000"))
+
+ANCHOR_WIDTHS = (1, 2, 4, 8)
+
+# the diffs of texts longer than DIFF_DEBOUNCE_MIN_CHARS wait DIFF_DEBOUNCE_INTERVAL
+# seconds, and are dropped if a newer diff is requested in the meantime
+DIFF_DEBOUNCE_INTERVAL = float(os.getenv("DIFF_DEBOUNCE_INTERVAL", "0.3"))
+DIFF_DEBOUNCE_MIN_CHARS = int(os.getenv("DIFF_DEBOUNCE_MIN_CHARS", "5000"))
+
+
+def text_to_tokens(text):
+    return re.split(r"(\s+)", text)
+
+
+def intern_tokens(tokens1, tokens2):
+    """
+    Map the tokens to integer ids, equal tokens get equal ids.
+    """
+    ids = {}
+    ids1 = [ids.setdefault(token, len(ids)) for token in tokens1]
+    ids2 = [ids.setdefault(token, len(ids)) for token in tokens2]
+    return ids1, ids2
+
+
+def myers_opcodes(a, b, a_lo, a_hi, b_lo, b_hi, max_cost=DIFF_MAX_COST):
+    """
+    Return the shortest edit script of a[a_lo:a_hi] -> b[b_lo:b_hi] (Myers, O(ND))
+    as opcodes (tag, i1, i2, j1, j2), with tag in "equal", "delete" and "insert".
+
+    When more than `max_cost` edits are needed, the region is reported as deleted
+    and inserted.
+    """
+    n, m = a_hi - a_lo, b_hi - b_lo
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+
+    for d in range(min(n + m, max_cost) + 1):
+        # the furthest x of each diagonal k after d - 1 edits, at index k + d
+        trace.append(v[offset - d : offset + d + 1])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m, a_lo, b_lo)
+
+    return [("delete", a_lo, a_hi, b_lo, b_lo), ("insert", a_hi, a_hi, b_lo, b_hi)]
+
+
+def _backtrack(trace, n, m, a_lo, b_lo):
+    opcodes = []
+    x, y = n, m
+    for d in range(len(trace) - 1, 0, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1 + d] < v[k + 1 + d]):
+            prev_k = k + 1  # insertion
+            mid_x = v[prev_k + d]
+        else:
+            prev_k = k - 1  # deletion
+            mid_x = v[prev_k + d] + 1
+        mid_y = mid_x - k
+
+        if x > mid_x:
+            opcodes.append(("equal", a_lo + mid_x, a_lo + x, b_lo + mid_y, b_lo + y))
+        x, y = v[prev_k + d], v[prev_k + d] - prev_k
+        if prev_k == k + 1:
+            opcodes.append(("insert", a_lo + x, a_lo + x, b_lo + y, b_lo + mid_y))
+        else:
+            opcodes.append(("delete", a_lo + x, a_lo + mid_x, b_lo + y, b_lo + y))
+
+    if x > 0:
+        opcodes.append(("equal", a_lo, a_lo + x, b_lo, b_lo + y))
+    opcodes.reverse()
+    return opcodes
+
+
+def patience_anchors(a, b, a_lo, a_hi, b_lo, b_hi, width=1):
+    """
+    Return the longest increasing sequence of (i, j) such that the `width` items
+    at a[i] and b[j] are equal and occur exactly once in both a[a_lo:a_hi] and
+    b[b_lo:b_hi].
+    """
+    if width == 1:
+        keys_a = ((a[i], i) for i in range(a_lo, a_hi))
+        keys_b = ((b[j], j) for j in range(b_lo, b_hi))
+    else:
+        keys_a = ((tuple(a[i : i + width]), i) for i in range(a_lo, a_hi - width + 1))
+        keys_b = ((tuple(b[j : j + width]), j) for j in range(b_lo, b_hi - width + 1))
+
+    unique_a = {}
+    for key, i in keys_a:
+        unique_a[key] = -1 if key in unique_a else i
+    unique_b = {}
+    for key, j in keys_b:
+        if key in unique_a:
+            unique_b[key] = -1 if key in unique_b else j
+
+    matches = [
+        (i, unique_b[key])
+        for key, i in unique_a.items()
+        if i >= 0 and unique_b.get(key, -1) >= 0
+    ]
+    if not matches:
+        return []
+    matches.sort()
+
+    # patience sorting: the tops of the piles, and the back pointers
+    tops = []
+    top_indices = []
+    prev = [-1] * len(matches)
+    for index, (_, j) in enumerate(matches):
+        pile = bisect.bisect_left(tops, j)
+        if pile > 0:
+            prev[index] = top_indices[pile - 1]
+        if pile == len(tops):
+            tops.append(j)
+            top_indices.append(index)
+        else:
+            tops[pile] = j
+            top_indices[pile] = index
+
+    anchors = []
+    index = top_indices[-1]
+    while index >= 0:
+        anchors.append(matches[index])
+        index = prev[index]
+    anchors.reverse()
+    return anchors
+
+
+def diff_opcodes(a, b, max_cost=DIFF_MAX_COST):
+    """
+    Diff two sequences of hashable items (e.g. interned tokens) with the patience
+    diff: match the items unique in both sequences (or else the unique runs of 2,
+    4 or 8 items), and diff the regions between them recursively, falling back to
+    the Myers diff when there are none.
+
+    Return opcodes (tag, i1, i2, j1, j2), with tag in "equal", "delete" and
+    "insert".
+    """
+    opcodes = []
+    # the regions to diff ("diff", ...) and the opcodes to emit, in reverse order
+    stack = [("diff", 0, len(a), 0, len(b))]
+    while stack:
+        item = stack.pop()
+        if item[0] != "diff":
+            opcodes.append(item)
+            continue
+        _, a_lo, a_hi, b_lo, b_hi = item
+
+        # common prefix and suffix
+        start_a, start_b = a_lo, b_lo
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            a_lo += 1
+            b_lo += 1
+        opcodes.append(("equal", start_a, a_lo, start_b, b_lo))
+        end_a, end_b = a_hi, b_hi
+        while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+        suffix = ("equal", a_hi, end_a, b_hi, end_b)
+
+        if a_lo == a_hi or b_lo == b_hi:
+            opcodes.append(("delete", a_lo, a_hi, b_lo, b_lo))
+            opcodes.append(("insert", a_hi, a_hi, b_lo, b_hi))
+            opcodes.append(suffix)
+            continue
+
+        for width in ANCHOR_WIDTHS:
+            anchors = patience_anchors(a, b, a_lo, a_hi, b_lo, b_hi, width)
+            if anchors:
+                break
+        if not anchors:
+            opcodes.extend(myers_opcodes(a, b, a_lo, a_hi, b_lo, b_hi, max_cost))
+            opcodes.append(suffix)
+            continue
+
+        items = []
+        for i, j in anchors:
+            if i < a_lo or j < b_lo:  # overlaps the previous anchor
+                continue
+            items.append(("diff", a_lo, i, b_lo, j))
+            items.append(("equal", i, i + width, j, j + width))
+            a_lo, b_lo = i + width, j + width
+        items.append(("diff", a_lo, a_hi, b_lo, b_hi))
+        items.append(suffix)
+        stack.extend(reversed(items))
+
+    return merge_opcodes(opcodes)
+
+
+def merge_opcodes(opcodes):
+    merged = []
+    for opcode in opcodes:
+        tag, i1, i2, j1, j2 = opcode
+        if i1 == i2 and j1 == j2:
+            continue
+        if merged and merged[-1][0] == tag:
+            last = merged[-1]
+            merged[-1] = (tag, last[1], i2, last[3], j2)
+        else:
+            merged.append(opcode)
+    return merged
+
+
+def append_changed(ret, tokens, sign):
+    for token in tokens:
+        ret.append((token, sign))
+        if token == "\n":
+            ret.append((token, sign))
+
+
+def diff_texts(text1, text2, word_level=True, max_cost=DIFF_MAX_COST):
+    """
+    Diff two texts by words (and whitespaces) or by characters, return the spans
+    of the old and the new texts for `gr.HighlightedText`: lists of (text, label)
+    with label "-" (removed from the old text), "+" (added to the new text) or
+    None (unchanged).
+
+    The character level diff refines the changed regions of the word level diff.
+    """
+    tokens1, tokens2 = text_to_tokens(text1), text_to_tokens(text2)
+    ids1, ids2 = intern_tokens(tokens1, tokens2)
+    opcodes = diff_opcodes(ids1, ids2, max_cost)
+    opcodes.append(("equal", len(ids1), len(ids1), len(ids2), len(ids2)))
+
+    ret_old = []
+    ret_new = []
+    changed = None  # the start (i1, j1) of the current changed region
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag != "equal":
+            changed = changed or (i1, j1)
+            continue
+
+        if changed:
+            old_tokens, new_tokens = tokens1[changed[0] : i1], tokens2[changed[1] : j1]
+            if word_level:
+                append_changed(ret_old, old_tokens, "-")
+                append_changed(ret_new, new_tokens, "+")
+            else:
+                old, new = "".join(old_tokens), "".join(new_tokens)
+                for tag, c1, c2, d1, d2 in diff_opcodes(old, new, max_cost):
+                    if tag == "equal":
+                        ret_old.append((old[c1:c2], None))
+                        ret_new.append((new[d1:d2], None))
+                    else:
+                        append_changed(ret_old, old[c1:c2], "-")
+                        append_changed(ret_new, new[d1:d2], "+")
+            changed = None
+
+        for token in tokens1[i1:i2]:
+            ret_old.append((token, None))
+            ret_new.append((token, None))
+    return ret_old, ret_new
+
+
+class Debouncer:
+    """
+    Debounce the calls per key (e.g. per gradio session): `await wait(key)` waits
+    `interval` seconds, and returns False if it has been superseded by a newer call
+    with the same key in the meantime.
+    """
+
+    def __init__(self, interval=DIFF_DEBOUNCE_INTERVAL):
+        self.interval = interval
+        self._generations = {}
+
+    async def wait(self, key):
+        generation = self._generations.get(key, 0) + 1
+        self._generations[key] = generation
+        await asyncio.sleep(self.interval)
+        if self._generations.get(key) != generation:
+            return False
+        del self._generations[key]
+        return True
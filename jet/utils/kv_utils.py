@@ -0,0 +1,208 @@
+import os
+import time
+import socket
+import threading
+from urllib.parse import unquote, urlparse
+
+from utils.db_utils import (
+    DB_CODEC,
+    DB_COMPRESSION,
+    DB_COMPRESS_MIN_BYTES,
+    Codec,
+    StateBackend,
+)
+from utils.config_utils import load_config
+from utils.metrics_utils import STATE_STORE_BYTES, STATE_STORE_SECONDS
+
+load_config()
+
+DB_REDIS_URL = os.getenv("DB_REDIS_URL", "redis://127.0.0.1:6379/0")
+# prepended to the keys, so many apps (or dbs of one app) can share a server
+DB_REDIS_PREFIX = os.getenv("DB_REDIS_PREFIX", f"jet:{os.getenv('DB_NAME', 'data')}:")
+DB_REDIS_TIMEOUT = float(os.getenv("DB_REDIS_TIMEOUT", "10"))
+
+# max number of keys in a single MGET / MSET
+REDIS_MAX_KEYS = 1000
+
+
+class RedisError(Exception):
+    """
+    An error reply of the server.
+    """
+
+
+class RedisConnection:
+    """
+    A minimal client of the redis protocol (RESP2) over a single socket, enough
+    for the commands of `RedisStateStore`. Not thread-safe.
+    """
+
+    def __init__(self, host, port, db=0, password=None, timeout=DB_REDIS_TIMEOUT):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", db)
+
+    @staticmethod
+    def pack(*args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode("utf-8")
+            elif isinstance(arg, int):
+                arg = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def read_reply(self):
+        line = self.file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed by the server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        elif kind == b"-":
+            raise RedisError(rest.decode())
+        elif kind == b":":
+            return int(rest)
+        elif kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.file.read(length + 2)
+            if len(data) < length + 2:
+                raise ConnectionError("connection closed by the server")
+            return data[:-2]
+        elif kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise ConnectionError(f"invalid reply {line!r}")
+
+    def execute(self, *args):
+        self.sock.sendall(self.pack(*args))
+        return self.read_reply()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def parse_redis_url(url):
+    """
+    Return the connection kwargs of a `redis://[:password@]host[:port][/db]` url.
+    """
+    parsed = urlparse(url)
+    assert parsed.scheme == "redis", f"unsupported redis url {url}"
+    return {
+        "host": parsed.hostname or "127.0.0.1",
+        "port": parsed.port or 6379,
+        "db": int(parsed.path.lstrip("/") or 0),
+        "password": unquote(parsed.password) if parsed.password else None,
+    }
+
+
+class RedisStateStore(StateBackend):
+    """
+    A key-value store of the user states on a redis compatible server, shared by
+    the workers of the app. It holds only the user states: the conversations and
+    the caches stay in the local state db.
+
+    Each thread lazily opens (and then reuses) its own connection. A `set_many` is
+    a single MSET (atomic) when it has at most REDIS_MAX_KEYS items. Values are
+    encoded by `Codec`, and not cached in memory: every read goes to the server,
+    so writes of the other workers are seen as soon as they are done.
+    """
+
+    tablename = "redis"  # the label of the metrics
+
+    def __init__(self, url=DB_REDIS_URL, prefix=DB_REDIS_PREFIX, codec=None):
+        self.url = url
+        self.prefix = prefix
+        self.codec = codec if codec is not None else Codec()
+        self.connection_kwargs = parse_redis_url(url)
+
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+        self.execute("PING")
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = RedisConnection(**self.connection_kwargs)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def execute(self, *args):
+        """
+        Run a command, reconnecting (once) if the connection has been lost, e.g.
+        by a restart of the server. The commands used are idempotent.
+        """
+        try:
+            return self.connect().execute(*args)
+        except (ConnectionError, socket.timeout):
+            self._discard_connection()
+            return self.connect().execute(*args)
+
+    def _discard_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            with self._lock:
+                self._connections.remove(conn)
+            conn.close()
+
+    def get_many(self, keys):
+        start = time.perf_counter()
+        keys = list(dict.fromkeys(keys))
+
+        blobs = {}
+        for i in range(0, len(keys), REDIS_MAX_KEYS):
+            batch = keys[i : i + REDIS_MAX_KEYS]
+            values = self.execute("MGET", *[self.prefix + key for key in batch])
+            blobs.update((k, v) for k, v in zip(batch, values) if v is not None)
+
+        STATE_STORE_SECONDS.observe(time.perf_counter() - start, self.tablename, "read")
+        STATE_STORE_BYTES.observe(
+            sum(len(blob) for blob in blobs.values()), self.tablename, "read"
+        )
+        return {key: self.codec.decode(blob) for key, blob in blobs.items()}
+
+    def set_many(self, mapping):
+        start = time.perf_counter()
+        items = [
+            (self.prefix + key, self.codec.encode(v)) for key, v in mapping.items()
+        ]
+        if not items:
+            return
+        for i in range(0, len(items), REDIS_MAX_KEYS):
+            self.execute(
+                "MSET", *[arg for item in items[i : i + REDIS_MAX_KEYS] for arg in item]
+            )
+
+        STATE_STORE_SECONDS.observe(
+            time.perf_counter() - start, self.tablename, "write"
+        )
+        STATE_STORE_BYTES.observe(
+            sum(len(blob) for _, blob in items), self.tablename, "write"
+        )
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+def get_redis_state_store():
+    codec = Codec(DB_CODEC, DB_COMPRESSION, DB_COMPRESS_MIN_BYTES)
+    return RedisStateStore(DB_REDIS_URL, DB_REDIS_PREFIX, codec=codec)
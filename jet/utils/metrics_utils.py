@@ -0,0 +1,246 @@
+import time
+import bisect
+import threading
+
+# buckets (upper bounds) of the histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+BYTES_BUCKETS = tuple(2**i for i in range(6, 26, 2))  # 64 B .. 16 MiB
+
+_METRICS = []  # in the order of definition
+_COLLECTORS = []  # called before each render, e.g. to set gauges
+_LOCK = threading.Lock()
+
+
+class Metric:
+    """
+    A metric with a fixed set of labels, rendered in the Prometheus text format.
+    The values are updated under a single lock, the updates are a few additions.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        with _LOCK:
+            _METRICS.append(self)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with _LOCK:
+            values = {
+                key: self.copy_value(value) for key, value in self._values.items()
+            }
+        for key, value in values.items():
+            lines += self.render_value(key, value)
+        return lines
+
+    def copy_value(self, value):
+        return value
+
+    def render_value(self, key, value):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with _LOCK:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labels):
+        with _LOCK:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with _LOCK:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with _LOCK:
+            counts = self._values.get(labels)
+            if counts is None:
+                # one count per bucket, then +Inf and the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def copy_value(self, value):
+        return list(value)
+
+    def render_value(self, key, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), value):
+            cumulative += count
+            labels = format_labels(self.labelnames + ("le",), key + (bound,))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {value[-1]}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Timer:
+    """
+    Observe the seconds spent in a `with` block.
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    labels = ",".join(
+        f'{name}="{escape_label(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + labels + "}"
+
+
+def escape_label(value):
+    value = str(value)
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def register_collector(fn):
+    """
+    Call `fn()` before each render, e.g. to set gauges sampled on demand.
+    """
+    _COLLECTORS.append(fn)
+    return fn
+
+
+def render_metrics():
+    for fn in _COLLECTORS:
+        fn()
+    lines = []
+    for metric in list(_METRICS):
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# chat
+CHAT_TIME_TO_FIRST_TOKEN = Histogram(
+    "jet_chat_time_to_first_token_seconds",
+    "Seconds from the api call to the first streamed token.",
+    ["model"],
+)
+CHAT_TOKENS_PER_SECOND = Histogram(
+    "jet_chat_tokens_per_second",
+    "Streamed tokens per second after the first token.",
+    ["model"],
+    buckets=RATE_BUCKETS,
+)
+CHAT_STREAM_SECONDS = Histogram(
+    "jet_chat_stream_seconds",
+    "Seconds from the api call to the end of the stream.",
+    ["model"],
+)
+CHAT_TOKENS = Counter("jet_chat_streamed_tokens_total", "Streamed tokens.", ["model"])
+CHAT_ACTIVE_STREAMS = Gauge(
+    "jet_chat_active_streams", "Streams in progress.", ["model"]
+)
+CHAT_QUEUE_WAIT = Histogram(
+    "jet_chat_queue_wait_seconds",
+    "Seconds waited for the rate limits of the model.",
+    ["model"],
+)
+
+# whisper
+WHISPER_SECONDS = Histogram(
+    "jet_whisper_seconds", "Seconds of the Whisper api calls.", ["model"]
+)
+
+# upstream errors, of each attempt
+UPSTREAM_ERRORS = Counter(
+    "jet_upstream_errors_total",
+    "Failed api calls.",
+    ["service", "model", "error"],
+)
+
+# state db
+STATE_STORE_SECONDS = Histogram(
+    "jet_state_store_seconds",
+    "Seconds of the reads and writes of the state db.",
+    ["table", "op"],
+)
+STATE_STORE_BYTES = Histogram(
+    "jet_state_store_bytes",
+    "Encoded bytes read from and written to the state db.",
+    ["table", "op"],
+    buckets=BYTES_BUCKETS,
+)
+
+# gradio queue, sampled on render, see `register_queue_metrics`
+GRADIO_QUEUE_SIZE = Gauge("jet_gradio_queue_size", "Events waiting in the queue.")
+GRADIO_ACTIVE_JOBS = Gauge("jet_gradio_active_jobs", "Events being processed.")
+GRADIO_QUEUE_WAIT = Gauge(
+    "jet_gradio_queue_estimated_wait_seconds",
+    "Gradio's estimation of the wait of a new event.",
+)
+
+
+def register_queue_metrics(demo):
+    """
+    Sample the size and the estimated wait of the queue of a launched demo.
+    """
+
+    def collect():
+        queue = getattr(demo, "_queue", None)
+        if queue is None:
+            return
+        GRADIO_QUEUE_SIZE.set(len(queue.event_queue))
+        GRADIO_ACTIVE_JOBS.set(queue.get_active_worker_count())
+        GRADIO_QUEUE_WAIT.set(queue.queue_duration or 0)
+
+    register_collector(collect)
+
+
+def mount_metrics(app, path="/metrics"):
+    """
+    Serve the metrics in the Prometheus text format on a fastapi app.
+    """
+    from fastapi.responses import PlainTextResponse
+
+    def metrics():
+        return PlainTextResponse(
+            render_metrics(), media_type="text/plain; version=0.0.4"
+        )
+
+    app.add_api_route(path, metrics, methods=["GET"])
@@ -1,20 +1,198 @@
+import os
+import atexit
 import logging
+import threading
 from typing import Literal
 
 import gradio as gr
-from utils.db_utils import read_user_state, update_user_state
+from utils.db_utils import read_user_states, update_user_states
+from utils.config_utils import load_config
+from utils.conversation_utils import load_histories, save_histories
+
+load_config()
+
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "2.0"))
+PERSIST_FLUSH_MAX_UPDATES = int(os.getenv("PERSIST_FLUSH_MAX_UPDATES", "2000"))
 
 _REGISTERED_COMPONENTS = {}
+_PENDING_HYDRATION = []  # (elem_id, component, default_fn, storage)
+
+# storage -> (read_fn(username, keys) -> dict, write_fn(username, mapping))
+_STORAGES = {
+    # pickled values in the user state
+    "state": (read_user_states, update_user_states),
+    # chat histories (of gradio.Chatbot) in the conversation store
+    "conversation": (load_histories, save_histories),
+}
+
+
+class WriteBehindBuffer:
+    """
+    Coalesce frequent saves of the same (username, key) into a single write.
+
+    Values are kept in memory and marked dirty; they are written to the db when
+    `interval` seconds have passed, when `max_updates` saves have been buffered,
+    when `flush` is called explicitly (e.g. at the end of a stream), and at exit.
+    `put` never writes to the db itself, it wakes up the background thread.
+    """
+
+    def __init__(
+        self,
+        interval=PERSIST_FLUSH_INTERVAL,
+        max_updates=PERSIST_FLUSH_MAX_UPDATES,
+        write_fn=update_user_states,
+    ):
+        self.interval = interval
+        self.max_updates = max_updates
+        self.write_fn = write_fn
+
+        self._dirty = {}  # (username, key) -> value
+        self._flushing = {}  # values being written, still served by `get`
+        self._num_updates = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def put(self, username, key, value):
+        with self._lock:
+            self._dirty[(username, key)] = value
+            self._num_updates += 1
+            self._ensure_thread()
+            if self._num_updates >= self.max_updates:
+                self._wakeup.set()
+
+    def write(self, username, key, value):
+        """
+        Write a value to the db now, in place of its buffered value if any (which
+        would otherwise overwrite it when flushed).
+        """
+        # after the flushes in progress, which may write an older value
+        with self._flush_lock:
+            with self._lock:
+                self._dirty.pop((username, key), None)
+            self.write_fn(username, {key: value})
+
+    def get(self, username, key, default=None):
+        with self._lock:
+            if (username, key) in self._dirty:
+                return self._dirty[(username, key)]
+            return self._flushing.get((username, key), default)
+
+    def has(self, username, key):
+        with self._lock:
+            return (username, key) in self._dirty or (username, key) in self._flushing
+
+    def flush(self, username=None, key=None):
+        """
+        Write the dirty values to the db, optionally only the ones of `username` / `key`.
+        Return the number of values written.
+        """
+        # the flush lock keeps the writes of concurrent flushes in order
+        with self._flush_lock:
+            with self._lock:
+                items = [
+                    (k, v)
+                    for k, v in self._dirty.items()
+                    if (username is None or k[0] == username)
+                    and (key is None or k[1] == key)
+                ]
+                for k, v in items:
+                    del self._dirty[k]
+                    self._flushing[k] = v
+                if not self._dirty:
+                    self._num_updates = 0
+
+            # one transaction per user
+            mappings = {}
+            for (item_username, item_key), value in items:
+                mappings.setdefault(item_username, {})[item_key] = value
+
+            failed = []
+            for item_username, mapping in mappings.items():
+                try:
+                    self.write_fn(item_username, mapping)
+                except Exception as e:
+                    logging.error("failed to flush states of %r: %r", item_username, e)
+                    failed.extend(((item_username, k), v) for k, v in mapping.items())
+
+            with self._lock:
+                for k, _ in items:
+                    self._flushing.pop(k, None)
+                # keep the failed values dirty unless they have been overwritten
+                for k, v in failed:
+                    self._dirty.setdefault(k, v)
+            return len(items) - len(failed)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="persist-write-behind", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+_WRITE_BEHIND_BUFFERS = {
+    storage: WriteBehindBuffer(write_fn=write_fn)
+    for storage, (_, write_fn) in _STORAGES.items()
+}
+for _buffer in _WRITE_BEHIND_BUFFERS.values():
+    atexit.register(_buffer.flush)
+
+
+def flush_user_state(username=None, key=None):
+    return sum(
+        buffer.flush(username=username, key=key)
+        for buffer in _WRITE_BEHIND_BUFFERS.values()
+    )
+
+
+def load_user_states(username, keys, storage="state"):
+    """
+    Read the states of many keys, the values buffered for writing take precedence.
+    """
+    read_fn, _ = _STORAGES[storage]
+    buffer = _WRITE_BEHIND_BUFFERS[storage]
+
+    states = {}
+    missing_keys = []
+    for key in keys:
+        if buffer.has(username, key):
+            states[key] = buffer.get(username, key)
+        else:
+            missing_keys.append(key)
+    states.update(read_fn(username, missing_keys))
+    return states
+
+
+def save_user_state(username, key, value, storage="state", write_behind=False):
+    """
+    Save the state of a key, see `persist` for `write_behind`.
+    """
+    if write_behind:
+        _WRITE_BEHIND_BUFFERS[storage].put(username, key, value)
+    else:
+        _WRITE_BEHIND_BUFFERS[storage].write(username, key, value)
 
 
 def make_component_persist(
     root_block: gr.Blocks,
     component: gr.components.Component,
     mode,
+    write_behind=False,
+    storage="state",
 ):
     """
     NOTE: please call this function before exiting **any** `with` blocks of `gradio.Blocks()`
     """
+    assert storage in _STORAGES, f"unknown storage {storage}"
+    assert root_block is not None, "please call this function in gradio.Blocks()"
     assert isinstance(
         component, gr.components.Component
     ), f"component {component} is not a gradio component, it is a {type(component)}"
@@ -37,7 +215,7 @@ def make_component_persist(
     default behavior: load_fn will be called when the component is loaded
     """
 
-    replace_load_fn = False
+    default_fn = None
     if hasattr(component, "load_event_to_attach") and component.load_event_to_attach:
         load_fn, every = component.load_event_to_attach
         if every:
@@ -52,25 +230,20 @@ def make_component_persist(
                 elem_id,
             )
 
-            def new_fn(request: gr.Request):
-                default_value = load_fn()
-                state = read_user_state(
-                    request.username, key=elem_id, default=default_value
-                )
-                return state
+            # load_fn is called by the hydration event when there is no saved state
+            default_fn = load_fn
+            component.load_event_to_attach = None
 
-            replace_load_fn = True
-            component.load_event_to_attach = (new_fn, None)
+    # the component is loaded by the single hydration event, see `hydrate`
+    _PENDING_HYDRATION.append((elem_id, component, default_fn, storage))
 
-    def load_session(request: gr.Request):
-        state = read_user_state(request.username, key=elem_id)
-        return state
+    buffer = _WRITE_BEHIND_BUFFERS[storage]
 
     def save_session(value, request: gr.Request):
-        update_user_state(request.username, key=elem_id, value=value)
+        save_user_state(request.username, elem_id, value, storage, write_behind)
 
-    if not replace_load_fn:
-        root_block.load(load_session, inputs=[], outputs=[component], queue=False)
+    def flush_session(request: gr.Request):
+        buffer.flush(username=request.username, key=elem_id)
 
     if mode == "change":
         component.change(save_session, inputs=[component], outputs=[], queue=False)
@@ -86,12 +259,75 @@ def make_component_persist(
     else:
         raise ValueError(f"unknown mode {mode}")
 
+    # attach it (e.g. with `.then(**component.flush_session_kwargs)`) at the end of
+    # a stream, so the final value is written without waiting for the interval
+    component.flush_session_kwargs = {
+        "fn": flush_session,
+        "inputs": [],
+        "outputs": [],
+        "queue": False,
+    }
+
     return component
 
 
-def persist(comp, mode: Literal["change", "input", "manual"] = "change"):
+def persist(
+    comp,
+    mode: Literal["change", "input", "manual"] = "change",
+    write_behind: bool = False,
+    storage: Literal["state", "conversation"] = "state",
+):
     """
     NOTE: please call this function before exiting **any** `with` blocks of `gradio.Blocks()`
+
+    write_behind: buffer the saved values in memory and write them to the db in
+    batches, for components that change very frequently (e.g. streamed chatbots)
+    storage: "conversation" stores the value of a gradio.Chatbot message by message
     """
     root_block = gr.context.Context.root_block
-    return make_component_persist(root_block, comp, mode)
+    return make_component_persist(
+        root_block, comp, mode, write_behind=write_behind, storage=storage
+    )
+
+
+def hydrate(root_block: gr.Blocks = None):
+    """
+    Load all the persisted components rendered in `root_block` with a single load
+    event, which reads all their states with one query per storage.
+
+    NOTE: please call this function in the `with` block of the root `gradio.Blocks()`,
+    after all the persisted components have been created and rendered
+    """
+    global _PENDING_HYDRATION
+    if root_block is None:
+        root_block = gr.context.Context.root_block
+
+    entries, pending = [], []
+    for entry in _PENDING_HYDRATION:
+        rendered = entry[1]._id in root_block.blocks
+        (entries if rendered else pending).append(entry)
+    _PENDING_HYDRATION = pending
+    if not entries:
+        return
+
+    def load_sessions(request: gr.Request):
+        keys = {}
+        for elem_id, _, _, storage in entries:
+            keys.setdefault(storage, []).append(elem_id)
+        states = {
+            storage: load_user_states(request.username, storage_keys, storage)
+            for storage, storage_keys in keys.items()
+        }
+
+        values = []
+        for elem_id, _, default_fn, storage in entries:
+            if elem_id in states[storage]:
+                values.append(states[storage][elem_id])
+            elif default_fn is not None:
+                values.append(default_fn())
+            else:
+                values.append(gr.update())  # keep the initial value
+        return values
+
+    components = [component for _, component, _, _ in entries]
+    root_block.load(load_sessions, inputs=[], outputs=components, queue=False)
@@ -0,0 +1,38 @@
+import sys
+import time
+import contextlib
+
+
+class StartupProfiler:
+    """
+    Time the steps of the startup (imports, construction of the tabs, launch), with
+    the number of modules imported by each step. Steps may be nested.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.steps = []  # [name, depth, seconds, number of modules imported]
+        self.depth = 0
+
+    @contextlib.contextmanager
+    def step(self, name):
+        step = [name, self.depth, None, None]
+        self.steps.append(step)
+        self.depth += 1
+        start = time.perf_counter()
+        num_modules = len(sys.modules)
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            step[2] = time.perf_counter() - start
+            step[3] = len(sys.modules) - num_modules
+
+    def report(self):
+        lines = [f"{'step':<40} {'seconds':>8} {'modules':>8}"]
+        for name, depth, seconds, num_modules in self.steps:
+            name = "  " * depth + name
+            lines.append(f"{name:<40} {seconds or 0:>8.3f} {num_modules or 0:>8}")
+        total = time.perf_counter() - self.start
+        lines.append(f"{'total':<40} {total:>8.3f} {len(sys.modules):>8}")
+        return "\n".join(lines)
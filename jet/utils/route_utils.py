@@ -0,0 +1,326 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import collections
+
+import aiohttp
+from utils.config_utils import load_config
+from utils.metrics_utils import UPSTREAM_ERRORS
+
+load_config()
+
+# a failed call (before its first token) is retried up to ROUTER_MAX_RETRIES times
+# on the other endpoints of the model, after a jittered exponential backoff
+ROUTER_MAX_RETRIES = int(os.getenv("ROUTER_MAX_RETRIES", "3"))
+ROUTER_BACKOFF = float(os.getenv("ROUTER_BACKOFF", "0.5"))
+ROUTER_MAX_BACKOFF = float(os.getenv("ROUTER_MAX_BACKOFF", "8"))
+# an endpoint failing with a retryable error is avoided for ROUTER_COOLDOWN seconds,
+# doubled for each consecutive failure
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", "5"))
+ROUTER_MAX_COOLDOWN = float(os.getenv("ROUTER_MAX_COOLDOWN", "120"))
+# when the first token takes longer than this percentile of the endpoint's times to
+# first token, the same call is sent to another endpoint, and the first to answer
+# wins (0: disabled)
+ROUTER_HEDGE_PERCENTILE = float(os.getenv("ROUTER_HEDGE_PERCENTILE", "0"))
+ROUTER_HEDGE_MIN_SAMPLES = int(os.getenv("ROUTER_HEDGE_MIN_SAMPLES", "20"))
+
+# weight of the last call in the moving averages of the latency and error rate
+EWMA_ALPHA = 0.2
+# assumed time to first token of an endpoint without calls yet
+DEFAULT_LATENCY = 1.0
+TTFT_SAMPLES = 200
+
+_ENDPOINTS = {}  # (model, api_base, api_key, deployment) -> Endpoint
+_ENDPOINTS_LOCK = threading.Lock()
+
+
+class Endpoint:
+    """
+    An api endpoint (base url, key and deployment) serving a model, with the
+    statistics of its recent calls.
+    """
+
+    def __init__(self, model, api_base=None, api_key=None, deployment=None):
+        self.model = model
+        self.api_base = api_base
+        self.api_key = api_key
+        self.deployment = deployment
+
+        self.in_flight = 0
+        self.latency = None  # moving average of the time to first token
+        self.error_rate = 0.0  # moving average of the failures
+        self.ttfts = collections.deque(maxlen=TTFT_SAMPLES)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.calls = 0
+        self.failures = 0
+
+    @property
+    def name(self):
+        return f"{self.model}@{self.api_base or 'default'}"
+
+    def is_healthy(self, now=None):
+        return (now or time.monotonic()) >= self.cooldown_until
+
+    def get_load(self):
+        latency = DEFAULT_LATENCY if self.latency is None else self.latency
+        return (self.in_flight + 1) * latency * (1 + 4 * self.error_rate)
+
+    def record_success(self, ttft):
+        self.calls += 1
+        self.ttfts.append(ttft)
+        if self.latency is None:
+            self.latency = ttft
+        self.latency += EWMA_ALPHA * (ttft - self.latency)
+        self.error_rate *= 1 - EWMA_ALPHA
+        self.consecutive_failures = 0
+
+    def record_failure(self, error):
+        self.calls += 1
+        self.failures += 1
+        self.error_rate += EWMA_ALPHA * (1 - self.error_rate)
+        if is_retryable(error):
+            self.consecutive_failures += 1
+            cooldown = ROUTER_COOLDOWN * 2 ** (self.consecutive_failures - 1)
+            self.cooldown_until = time.monotonic() + min(cooldown, ROUTER_MAX_COOLDOWN)
+
+    def get_hedge_delay(self, percentile=None):
+        """
+        The time to first token after which the call is hedged, None if hedging is
+        disabled or there are not enough samples yet.
+        """
+        percentile = ROUTER_HEDGE_PERCENTILE if percentile is None else percentile
+        if percentile <= 0 or len(self.ttfts) < ROUTER_HEDGE_MIN_SAMPLES:
+            return None
+        ttfts = sorted(self.ttfts)
+        return ttfts[min(len(ttfts) - 1, int(len(ttfts) * percentile / 100))]
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "in_flight": self.in_flight,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "calls": self.calls,
+            "failures": self.failures,
+            "healthy": self.is_healthy(),
+        }
+
+
+def resolve_secret(value):
+    # "$NAME" reads the environment variable NAME
+    if value and value.startswith("$"):
+        return os.getenv(value[1:])
+    return value or None
+
+
+def parse_endpoints(text):
+    """
+    Parse OPENAI_ALLOWED_MODELS: a comma separated list of models, each optionally
+    followed by its endpoints, e.g.
+    "gpt-4=https://a.example.com|$KEY_A|gpt4;https://b.example.com|$KEY_B,gpt-35-turbo"
+    where an endpoint is "api_base|api_key|deployment" (the key and the deployment
+    are optional, the key may be "$ENV_VAR").
+
+    Return a dict model -> list of (api_base, api_key, deployment).
+    """
+    endpoints = {}
+    for item in text.split(","):
+        model, _, specs = item.partition("=")
+        model = model.strip()
+        if not model:
+            continue
+        endpoints[model] = []
+        for spec in specs.split(";"):
+            if spec.strip():
+                api_base, api_key, deployment = (spec.split("|") + [None, None])[:3]
+                endpoints[model].append(
+                    (api_base.strip(), resolve_secret(api_key), deployment or None)
+                )
+    return endpoints
+
+
+def get_endpoints(model):
+    """
+    The endpoints of a model, the default one (from the OPENAI_API_* environment
+    variables) if none is configured.
+    """
+    specs = parse_endpoints(os.getenv("OPENAI_ALLOWED_MODELS", "")).get(model)
+    specs = specs or [(None, None, None)]
+    with _ENDPOINTS_LOCK:
+        endpoints = []
+        for spec in specs:
+            key = (model, *spec)
+            if key not in _ENDPOINTS:
+                _ENDPOINTS[key] = Endpoint(model, *spec)
+            endpoints.append(_ENDPOINTS[key])
+    return endpoints
+
+
+def pick_endpoint(model, exclude=(), healthy_only=False):
+    """
+    The least loaded healthy endpoint of a model, not in `exclude` if possible.
+    Without any healthy endpoint, the one recovering the soonest (None if
+    `healthy_only`).
+    """
+    endpoints = get_endpoints(model)
+    candidates = [e for e in endpoints if e not in exclude] or endpoints
+    now = time.monotonic()
+    healthy = [e for e in candidates if e.is_healthy(now)]
+    if healthy:
+        return min(healthy, key=lambda e: e.get_load())
+    if healthy_only:
+        return None
+    return min(candidates, key=lambda e: e.cooldown_until)
+
+
+def get_endpoint_stats():
+    with _ENDPOINTS_LOCK:
+        return [endpoint.stats() for endpoint in _ENDPOINTS.values()]
+
+
+def is_retryable(error):
+    """
+    Rate limits, server errors, timeouts and connection errors.
+    """
+    import openai
+
+    if isinstance(
+        error,
+        (
+            openai.error.RateLimitError,
+            openai.error.ServiceUnavailableError,
+            openai.error.Timeout,
+            openai.error.APIConnectionError,
+            openai.error.TryAgain,
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+        ),
+    ):
+        return True
+    if isinstance(error, openai.error.OpenAIError):
+        return (error.http_status or 0) >= 500
+    return False
+
+
+def get_backoff(retry):
+    # full jitter
+    return random.uniform(0, min(ROUTER_MAX_BACKOFF, ROUTER_BACKOFF * 2**retry))
+
+
+class _Attempt:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started_at = time.monotonic()
+        self.ttft = None
+        self.task = None
+
+
+async def arun_routed(model, run_attempt, on_token, max_retries=ROUTER_MAX_RETRIES):
+    """
+    Run a streamed call on the endpoints of a model.
+
+    `run_attempt(endpoint, on_token)` runs the call on an endpoint, and awaits
+    `on_token(token)` for each streamed token. The tokens of the attempt that
+    streams first are forwarded to `on_token`, the other attempts are cancelled.
+
+    An attempt failing before its first token is retried on another endpoint (if
+    the error is retryable), and a slow attempt may be hedged, see
+    ROUTER_HEDGE_PERCENTILE. Errors after the first token are raised.
+
+    Return the endpoint of the winning attempt.
+    """
+    winner = None
+    decided = asyncio.Event()
+    attempts = []
+
+    def start_attempt(endpoint):
+        attempt = _Attempt(endpoint)
+
+        async def forward_token(token):
+            nonlocal winner
+            if attempt.ttft is None:
+                attempt.ttft = time.monotonic() - attempt.started_at
+            if winner is None:
+                winner = attempt
+                decided.set()
+            if winner is attempt:
+                await on_token(token)
+
+        async def run():
+            try:
+                await run_attempt(endpoint, forward_token)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning("call to %s failed: %r", endpoint.name, e)
+                UPSTREAM_ERRORS.inc("chat", endpoint.model, type(e).__name__)
+                endpoint.record_failure(e)
+                raise
+            else:
+                ttft = attempt.ttft or time.monotonic() - attempt.started_at
+                endpoint.record_success(ttft)
+            finally:
+                endpoint.in_flight -= 1
+
+        # counted right away, so that concurrent calls pick other endpoints
+        endpoint.in_flight += 1
+        attempt.task = asyncio.create_task(run())
+        attempts.append(attempt)
+        return attempt
+
+    decided_waiter = asyncio.create_task(decided.wait())
+    tried = []
+    try:
+        for retry in range(max_retries + 1):
+            endpoint = pick_endpoint(model, exclude=tried)
+            tried.append(endpoint)
+            round_attempts = [start_attempt(endpoint)]
+            hedge_delay = endpoint.get_hedge_delay()
+
+            pending = {round_attempts[0].task}
+            while pending and not decided.is_set():
+                timeout = None
+                if hedge_delay is not None and len(round_attempts) == 1:
+                    elapsed = time.monotonic() - round_attempts[0].started_at
+                    timeout = max(0.0, hedge_delay - elapsed)
+                done, pending = await asyncio.wait(
+                    pending | {decided_waiter},
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                pending.discard(decided_waiter)
+                if not done and len(round_attempts) == 1:
+                    hedge_endpoint = pick_endpoint(
+                        model, exclude=tried, healthy_only=True
+                    )
+                    if hedge_endpoint is None or hedge_endpoint in tried:
+                        hedge_delay = None
+                        continue
+                    logging.info("hedging the call to %s", endpoint.name)
+                    tried.append(hedge_endpoint)
+                    round_attempts.append(start_attempt(hedge_endpoint))
+                    pending.add(round_attempts[-1].task)
+
+            if decided.is_set():
+                for attempt in round_attempts:
+                    if attempt is not winner:
+                        attempt.task.cancel()
+                await winner.task
+                return winner.endpoint
+
+            # all the attempts of the round are done, without any token
+            errors = [attempt.task.exception() for attempt in round_attempts]
+            if None in errors:  # an empty answer
+                return round_attempts[errors.index(None)].endpoint
+            error = errors[-1]
+            if not is_retryable(error) or retry == max_retries:
+                raise error
+            await asyncio.sleep(get_backoff(retry))
+    finally:
+        decided_waiter.cancel()
+        for attempt in attempts:
+            attempt.task.cancel()
@@ -0,0 +1,188 @@
+import os
+import time
+import asyncio
+import logging
+import collections
+
+from utils.config_utils import load_config
+
+load_config()
+
+# the rate limits of the models (prefix matched) in requests and tokens per minute,
+# 0 for no limit, e.g. "gpt-4=200/40000,gpt-35-turbo=1200/240000"
+OPENAI_RATE_LIMITS = os.getenv("OPENAI_RATE_LIMITS", "")
+# when the api is rate limited anyway, no request is sent for RATE_LIMIT_BACKOFF s
+RATE_LIMIT_BACKOFF = float(os.getenv("RATE_LIMIT_BACKOFF", "10"))
+
+_SCHEDULERS = {}  # (event loop, model) -> ModelScheduler
+
+
+def parse_rate_limits(text):
+    """
+    Parse "model=rpm/tpm,..." into a dict model -> (rpm, tpm).
+    """
+    rate_limits = {}
+    for item in text.split(","):
+        if "=" in item:
+            name, limits = item.split("=", 1)
+            rpm, _, tpm = limits.partition("/")
+            rate_limits[name.strip()] = (float(rpm or 0), float(tpm or 0))
+    return rate_limits
+
+
+RATE_LIMITS = parse_rate_limits(OPENAI_RATE_LIMITS)
+
+
+def set_rate_limits(text):
+    """
+    Override the rate limits of some models, see OPENAI_RATE_LIMITS.
+    """
+    RATE_LIMITS.update(parse_rate_limits(text))
+    _SCHEDULERS.clear()
+
+
+def get_rate_limits(model):
+    prefixes = [name for name in RATE_LIMITS if model.startswith(name)]
+    if not prefixes:
+        return 0.0, 0.0
+    return RATE_LIMITS[max(prefixes, key=len)]
+
+
+class TokenBucket:
+    """
+    A bucket of `rate_per_minute` tokens, refilled continuously. It may go below
+    zero: a request larger than the bucket waits for a full bucket, and is then
+    paid back by the following ones.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60
+        self.capacity = rate_per_minute
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(
+            self.capacity, self.level + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def get_delay(self, amount, now):
+        """
+        The seconds to wait before `amount` tokens can be consumed.
+        """
+        if self.rate <= 0:
+            return 0.0
+        self.refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def consume(self, amount, now):
+        if self.rate > 0:
+            self.refill(now)
+            self.level -= amount
+
+    def pause(self, seconds, now):
+        if self.rate > 0:
+            self.refill(now)
+            self.level = min(self.level, -seconds * self.rate)
+
+
+class ModelScheduler:
+    """
+    Grant the requests to a model within its requests and tokens per minute.
+
+    The waiting requests are granted in a fair order: round robin over the users,
+    in the order of arrival for each user. A user sending many requests (e.g.
+    the chunks of a long text) only delays the others by one request per turn.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.limited = rpm > 0 or tpm > 0
+
+        self._queues = collections.OrderedDict()  # username -> deque of waiters
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def acquire(self, username, num_tokens):
+        """
+        Wait for the turn of a request of `num_tokens` tokens, return the waited
+        seconds.
+        """
+        if not self.limited:
+            return 0.0
+
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(username, collections.deque()).append(
+            (num_tokens, future)
+        )
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+        try:
+            await future
+        finally:
+            # cancelled requests are dropped by the dispatcher
+            self._wakeup.set()
+        return time.monotonic() - start
+
+    def pause(self, seconds=RATE_LIMIT_BACKOFF):
+        """
+        Stop granting requests for a while, e.g. after a rate limit error.
+        """
+        now = time.monotonic()
+        self.requests.pause(seconds, now)
+        self.tokens.pause(seconds, now)
+
+    async def _dispatch(self):
+        while self._queues:
+            username, queue = next(iter(self._queues.items()))
+            num_tokens, future = queue[0]
+            if future.done():  # cancelled
+                self._pop(username)
+                continue
+
+            now = time.monotonic()
+            delay = max(
+                self.requests.get_delay(1, now),
+                self.tokens.get_delay(num_tokens, now),
+            )
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.requests.consume(1, now)
+            self.tokens.consume(num_tokens, now)
+            self._pop(username)
+            future.set_result(None)
+
+    def _pop(self, username):
+        queue = self._queues[username]
+        queue.popleft()
+        if queue:
+            self._queues.move_to_end(username)
+        else:
+            del self._queues[username]
+
+    def stats(self):
+        return {
+            "waiting": sum(len(queue) for queue in self._queues.values()),
+            "users": len(self._queues),
+        }
+
+
+def get_scheduler(model):
+    """
+    The scheduler of the requests to a model in the current event loop.
+    """
+    key = (asyncio.get_running_loop(), model)
+    if key not in _SCHEDULERS:
+        rpm, tpm = get_rate_limits(model)
+        logging.info("rate limits of %s: %s rpm, %s tpm", model, rpm, tpm)
+        _SCHEDULERS[key] = ModelScheduler(rpm, tpm)
+    return _SCHEDULERS[key]
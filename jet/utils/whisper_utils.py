@@ -1,12 +1,25 @@
+import io
 import os
-import tempfile
-import warnings
+import json
+import wave
+import asyncio
+import hashlib
+import logging
+import functools
+import threading
 
-import dotenv
-import openai
-from gradio.processing_utils import audio_to_file
+import numpy as np
+from utils.db_utils import DiskCache, get_store
+from utils.chat_utils import get_aiohttp_session
+from utils.config_utils import load_config
+from utils.metrics_utils import UPSTREAM_ERRORS, WHISPER_SECONDS
 
-dotenv.load_dotenv()
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+load_config()
 
 OPENAI_WHISPER_API_TYPE = os.getenv("OPENAI_WHISPER_API_TYPE")
 OPENAI_WHISPER_API_BASE = os.getenv("OPENAI_WHISPER_API_BASE")
@@ -14,11 +27,84 @@ OPENAI_WHISPER_API_KEY = os.getenv("OPENAI_WHISPER_API_KEY")
 OPENAI_WHISPER_API_VERSION = os.getenv("OPENAI_WHISPER_API_VERSION")
 OPENAI_WHISPER_MODEL_NAME = os.getenv("OPENAI_WHISPER_MODEL_NAME")
 
+# long recordings are split at the quietest point of the second half of each chunk
+# of WHISPER_MAX_CHUNK_SECONDS, and the chunks are transcribed concurrently
+WHISPER_MAX_CHUNK_SECONDS = float(os.getenv("WHISPER_MAX_CHUNK_SECONDS", "60"))
+# at most WHISPER_CONCURRENCY requests (of all the users) are sent at the same time,
+# each of them times out after WHISPER_TIMEOUT seconds
+WHISPER_CONCURRENCY = int(os.getenv("WHISPER_CONCURRENCY", "4"))
+WHISPER_TIMEOUT = float(os.getenv("WHISPER_TIMEOUT", "120"))
+# the end of the transcript of a chunk is the prompt of the next one
+WHISPER_PROMPT_TAIL_CHARS = int(os.getenv("WHISPER_PROMPT_TAIL_CHARS", "200"))
+
+# the audio is uploaded as mono 16-bit PCM, downsampled to WHISPER_SAMPLE_RATE (the
+# rate of the model), in WHISPER_AUDIO_FORMAT: "wav", or the smaller "flac" or
+# "opus" if soundfile (not a dependency of the app) is installed
+WHISPER_SAMPLE_RATE = int(os.getenv("WHISPER_SAMPLE_RATE", "16000"))
+WHISPER_AUDIO_FORMAT = os.getenv("WHISPER_AUDIO_FORMAT", "wav")
+
+# the transcripts of the recordings are cached on disk (in the state db)
+WHISPER_CACHE_DISK_BYTES = int(
+    os.getenv("WHISPER_CACHE_DISK_BYTES", str(64 * 1024 * 1024))
+)
+WHISPER_CACHE_TTL = float(os.getenv("WHISPER_CACHE_TTL", str(7 * 24 * 3600)))
+
+# the energy is measured on frames of FRAME_SECONDS, smoothed over WINDOW_SECONDS
+FRAME_SECONDS = 0.03
+WINDOW_SECONDS = 0.3
+
+_SEMAPHORES = {}
+_TRANSCRIPT_CACHE = None
+_TRANSCRIPT_CACHE_LOCK = threading.Lock()
+
+
+def get_semaphore():
+    """
+    The limiter of the Whisper requests in the current event loop.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _SEMAPHORES:
+        _SEMAPHORES[loop] = asyncio.Semaphore(WHISPER_CONCURRENCY)
+    return _SEMAPHORES[loop]
+
+
+def get_transcript_cache():
+    global _TRANSCRIPT_CACHE
+    with _TRANSCRIPT_CACHE_LOCK:
+        if _TRANSCRIPT_CACHE is None:
+            _TRANSCRIPT_CACHE = DiskCache(
+                get_store(),
+                "transcripts",
+                max_bytes=WHISPER_CACHE_DISK_BYTES,
+                ttl=WHISPER_CACHE_TTL,
+            )
+    return _TRANSCRIPT_CACHE
+
+
+def get_transcript_cache_stats():
+    stats = get_transcript_cache().stats()
+    num_requests = stats["hits"] + stats["misses"]
+    stats["requests"] = num_requests
+    stats["hit_rate"] = stats["hits"] / num_requests if num_requests else 0.0
+    return stats
+
+
+def make_transcript_key(sr, data, prompt):
+    """
+    Hash the decoded audio (sample rate, format and samples) with the prompt and
+    the model.
+    """
+    data = np.ascontiguousarray(data)
+    request = [sr, data.dtype.str, data.shape, prompt, OPENAI_WHISPER_MODEL_NAME]
+    key = hashlib.sha256(json.dumps(request).encode("utf-8"))
+    key.update(data.data)
+    return key.hexdigest()
+
 
-def transcribe_wav_file(wav_file, prompt):
+def get_transcribe_kwargs(file, prompt):
     assert OPENAI_WHISPER_API_TYPE in [None, "azure", "openai"]
     kwargs = {
-        "file": wav_file,
+        "file": file,
         "api_type": OPENAI_WHISPER_API_TYPE,
         "api_base": OPENAI_WHISPER_API_BASE,
         "api_key": OPENAI_WHISPER_API_KEY,
@@ -29,23 +115,257 @@ def transcribe_wav_file(wav_file, prompt):
         kwargs["deployment_id"] = OPENAI_WHISPER_MODEL_NAME
     else:  # openai
         kwargs["model"] = OPENAI_WHISPER_MODEL_NAME
+    if prompt:
+        kwargs["prompt"] = prompt
+    return kwargs
 
-    transcript = openai.Audio.transcribe(**kwargs, prompt=prompt)
+
+def transcribe_audio_file(file, prompt=None):
+    import openai
+
+    try:
+        with WHISPER_SECONDS.time(OPENAI_WHISPER_MODEL_NAME):
+            transcript = openai.Audio.transcribe(**get_transcribe_kwargs(file, prompt))
+    except Exception as e:
+        UPSTREAM_ERRORS.inc("whisper", OPENAI_WHISPER_MODEL_NAME, type(e).__name__)
+        raise
+
+    return transcript.text
+
+
+async def atranscribe_audio_file(file, prompt=None):
+    import openai
+
+    openai.aiosession.set(get_aiohttp_session())
+    try:
+        with WHISPER_SECONDS.time(OPENAI_WHISPER_MODEL_NAME):
+            transcript = await openai.Audio.atranscribe(
+                **get_transcribe_kwargs(file, prompt)
+            )
+    except Exception as e:
+        UPSTREAM_ERRORS.inc("whisper", OPENAI_WHISPER_MODEL_NAME, type(e).__name__)
+        raise
 
     return transcript.text
 
 
-def transcribe_audio_data(sr, data, prompt=None):
-    with tempfile.NamedTemporaryFile(suffix=".wav") as file:
-        with warnings.catch_warnings():
-            # ignore warnings of converting int32 to int16
-            warnings.simplefilter("ignore")
-            audio_to_file(sr, data, file.name, format="wav")
-        with open(file.name, "rb") as f:
-            transcript = transcribe_wav_file(f, prompt)
-        return transcript
+def to_float(data):
+    """
+    Convert the samples (of gradio audio data) to float32 in [-1, 1].
+    """
+    if data.dtype.kind == "f":
+        return data.astype(np.float32, copy=False)
+    if data.dtype.kind == "u":
+        half = 2 ** (8 * data.dtype.itemsize - 1)
+        return (data.astype(np.float32) - half) / half
+    return data.astype(np.float32) / 2 ** (8 * data.dtype.itemsize - 1)
+
+
+def resample(samples, sr, target_sr):
+    """
+    Resample a mono signal by truncating (or padding) its spectrum, i.e. with an
+    ideal low-pass filter.
+    """
+    if sr == target_sr or len(samples) == 0:
+        return samples
+    num_samples = max(1, round(len(samples) * target_sr / sr))
+    spectrum = np.fft.rfft(samples)
+    resampled = np.fft.irfft(spectrum, num_samples) * (num_samples / len(samples))
+    return resampled.astype(np.float32)
+
+
+def to_pcm16(sr, data, target_sr=WHISPER_SAMPLE_RATE):
+    """
+    Downmix audio data to mono, downsample it to `target_sr` (if higher), and
+    convert it to int16. Return (sr, samples).
+    """
+    samples = to_float(data)
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    if sr > target_sr:
+        samples, sr = resample(samples, sr, target_sr), target_sr
+    samples = np.clip(samples * 32767, -32768, 32767).astype(np.int16)
+    return sr, samples
+
+
+@functools.lru_cache(maxsize=None)
+def get_audio_format(audio_format=None):
+    """
+    Return the format to upload audio in, "wav" if `audio_format` needs soundfile
+    and it is not installed (logged once per format).
+    """
+    audio_format = audio_format or WHISPER_AUDIO_FORMAT
+    assert audio_format in ["wav", "flac", "opus"]
+    if audio_format != "wav" and soundfile is None:
+        logging.warning("soundfile is not installed, upload %s as wav", audio_format)
+        return "wav"
+    return audio_format
+
+
+def encode_audio(sr, samples, audio_format=None):
+    """
+    Encode mono int16 samples in memory, return a named file object to upload.
+    """
+    audio_format = get_audio_format(audio_format)
+    file = io.BytesIO()
+    if audio_format == "wav":
+        with wave.open(file, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(sr)
+            f.writeframes(samples.tobytes())
+        file.name = "audio.wav"
+    elif audio_format == "flac":
+        soundfile.write(file, samples, sr, format="FLAC", subtype="PCM_16")
+        file.name = "audio.flac"
+    else:  # opus
+        soundfile.write(file, samples, sr, format="OGG", subtype="OPUS")
+        file.name = "audio.ogg"
+    file.seek(0)
+    return file
+
+
+def encode_audio_data(sr, data, audio_format=None):
+    sr, samples = to_pcm16(sr, data)
+    return encode_audio(sr, samples, audio_format)
+
+
+async def atranscribe_audio_chunk(sr, data, prompt=None, audio_format=None):
+    file = await asyncio.to_thread(encode_audio_data, sr, data, audio_format)
+    async with get_semaphore():
+        try:
+            return await asyncio.wait_for(
+                atranscribe_audio_file(file, prompt), timeout=WHISPER_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            UPSTREAM_ERRORS.inc("whisper", OPENAI_WHISPER_MODEL_NAME, "TimeoutError")
+            raise
+
+
+def frame_rms(data, frame_length, block_frames=1 << 16):
+    """
+    The RMS of each frame of `frame_length` samples (of the mean of the channels),
+    computed by blocks to bound the memory used on long recordings.
+    """
+    num_frames = len(data) // frame_length
+    rms = np.empty(num_frames, dtype=np.float32)
+    for start in range(0, num_frames, block_frames):
+        end = min(start + block_frames, num_frames)
+        block = data[start * frame_length : end * frame_length]
+        block = block.astype(np.float32)
+        if block.ndim > 1:
+            block = block.mean(axis=1)
+        block = block.reshape(end - start, frame_length)
+        rms[start:end] = np.sqrt(np.mean(block * block, axis=1))
+    return rms
+
+
+def split_audio(sr, data, max_chunk_seconds=WHISPER_MAX_CHUNK_SECONDS):
+    """
+    Split a recording into chunks of at most `max_chunk_seconds` seconds, at the
+    quietest point of the second half of each chunk (the last one if several).
+
+    Return the list of (start, end) sample indices of the chunks. The chunks are at
+    least two energy frames long (except the last one), so each split advances.
+    """
+    frame_length = max(1, int(FRAME_SECONDS * sr))
+    max_length = max(2 * frame_length, int(max_chunk_seconds * sr))
+    if len(data) <= max_length:
+        return [(0, len(data))]
+
+    window = max(1, int(WINDOW_SECONDS / FRAME_SECONDS))
+    energy = np.convolve(frame_rms(data, frame_length), np.ones(window), mode="same")
+
+    bounds = []
+    start = 0
+    while len(data) - start > max_length:
+        # leave at least half a chunk for the last one
+        split_high = min(start + max_length, len(data) - max_length // 2)
+        low = (start + max_length // 2) // frame_length
+        high = max(low + 1, split_high // frame_length)
+        split_frame = high - 1 - int(np.argmin(energy[low:high][::-1]))
+        end = min(split_frame * frame_length + frame_length // 2, start + max_length)
+        assert end > start, f"split_audio did not advance at sample {start}"
+        bounds.append((start, end))
+        start = end
+    bounds.append((start, len(data)))
+    return bounds
+
+
+def make_chunk_prompt(prompt, previous_transcript):
+    tail = previous_transcript.strip()[-WHISPER_PROMPT_TAIL_CHARS:]
+    return "\n".join(part for part in [prompt, tail] if part) or None
+
+
+def join_transcripts(transcripts):
+    """
+    Join the transcripts of consecutive chunks, with a space between them unless
+    one side is a wide (e.g. CJK) character.
+    """
+    text = ""
+    for transcript in transcripts:
+        transcript = transcript.strip()
+        if text and transcript and text[-1] < "\u2e80" and transcript[0] < "\u2e80":
+            text += " "
+        text += transcript
+    return text
+
+
+async def atranscribe_audio_data(
+    sr,
+    data,
+    prompt=None,
+    max_chunk_seconds=WHISPER_MAX_CHUNK_SECONDS,
+    concurrency=WHISPER_CONCURRENCY,
+    transcribe_fn=atranscribe_audio_chunk,
+    use_cache=True,
+):
+    """
+    Transcribe a recording of any length.
+
+    The recording is split at silences into chunks, which are split into at most
+    `concurrency` runs of consecutive chunks transcribed concurrently. In a run,
+    the end of the transcript of a chunk is added to the prompt of the next one.
+
+    The CPU heavy steps (hashing, splitting and encoding) run in threads, off the
+    event loop.
+
+    The transcripts are cached by audio content, prompt and model, unless
+    `use_cache` is False.
+    """
+    cache_key = None
+    if use_cache:
+        cache_key = await asyncio.to_thread(make_transcript_key, sr, data, prompt)
+        cache = get_transcript_cache()
+        transcript = await asyncio.to_thread(cache.get, cache_key)
+        if transcript is not None:
+            return transcript
+
+    bounds = await asyncio.to_thread(split_audio, sr, data, max_chunk_seconds)
+
+    num_runs = max(1, min(concurrency, len(bounds)))
+    runs = [
+        bounds[i * len(bounds) // num_runs : (i + 1) * len(bounds) // num_runs]
+        for i in range(num_runs)
+    ]
+
+    async def transcribe_run(run):
+        transcripts = []
+        for start, end in run:
+            previous = transcripts[-1] if transcripts else ""
+            chunk_prompt = make_chunk_prompt(prompt, previous)
+            transcripts.append(await transcribe_fn(sr, data[start:end], chunk_prompt))
+        return transcripts
+
+    results = await asyncio.gather(*[transcribe_run(run) for run in runs])
+    transcript = join_transcripts(
+        transcript for transcripts in results for transcript in transcripts
+    )
+    if cache_key is not None and transcript:
+        await asyncio.to_thread(get_transcript_cache().put, cache_key, transcript)
+    return transcript
 
 
 if __name__ == "__main__":
     file = open("/path/to/sample.wav", "rb")
-    print(transcribe_wav_file(file))
+    print(transcribe_audio_file(file))
@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import asyncio
+import hashlib
+import logging
+
+from utils.chat_utils import get_current_model, agenerate_new_text
+from utils.config_utils import load_config
+
+load_config()
+
+# long texts are split into chunks of at most WRITING_MAX_CHUNK_CHARS characters
+# (at paragraph, then sentence boundaries), corrected concurrently
+WRITING_MAX_CHUNK_CHARS = int(os.getenv("WRITING_MAX_CHUNK_CHARS", "2000"))
+WRITING_CONCURRENCY = int(os.getenv("WRITING_CONCURRENCY", "4"))
+# the corrections of the chunks are kept per session to resend only the edited ones
+WRITING_MAX_CORRECTIONS = int(os.getenv("WRITING_MAX_CORRECTIONS", "1000"))
+
+PARAGRAPH_SEPARATOR = re.compile(r"(\n\s*\n)")
+SENTENCE_SEPARATOR = re.compile(r"(?<=[.!?;。！？；])(\s+)")
+
+
+def split_long_paragraph(paragraph, max_chars):
+    """
+    Split a paragraph at sentence boundaries into pieces of at most `max_chars`
+    characters (unless a single sentence is longer), keeping the separators.
+    """
+    parts = SENTENCE_SEPARATOR.split(paragraph)
+    sentences, separators = parts[::2], parts[1::2] + [""]
+
+    pieces = []
+    chunk = ""
+    for sentence, separator in zip(sentences, separators):
+        if chunk and len(chunk) + len(sentence) > max_chars:
+            pieces.append((chunk.rstrip(), True))
+            pieces.append((chunk[len(chunk.rstrip()) :], False))
+            chunk = ""
+        chunk += sentence + separator
+    if chunk:
+        pieces.append((chunk.rstrip(), True))
+        pieces.append((chunk[len(chunk.rstrip()) :], False))
+    return pieces
+
+
+def split_text(text, max_chars=WRITING_MAX_CHUNK_CHARS):
+    """
+    Split a text into pieces: a list of (piece, is_chunk), where the chunks are the
+    paragraphs (or sentences of long paragraphs) to correct, and the other pieces
+    are the whitespace between them. Joining all the pieces gives back the text.
+    """
+    pieces = []
+    for i, part in enumerate(PARAGRAPH_SEPARATOR.split(text)):
+        if i % 2 == 1 or not part.strip():  # separator
+            pieces.append((part, False))
+            continue
+
+        stripped = part.strip()
+        start = part.index(stripped)
+        pieces.append((part[:start], False))
+        if len(stripped) > max_chars:
+            pieces.extend(split_long_paragraph(stripped, max_chars))
+        else:
+            pieces.append((stripped, True))
+        pieces.append((part[start + len(stripped) :], False))
+
+    return [(piece, is_chunk) for piece, is_chunk in pieces if piece]
+
+
+def make_correction_key(chunk, system_message, model_name):
+    request = json.dumps([chunk, system_message, model_name], ensure_ascii=False)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+async def acorrect_text(
+    text,
+    system_message,
+    use_cache=None,
+    corrections=None,
+    username=None,
+    temperature=1.0,
+    max_tokens=0,
+    max_corrections=WRITING_MAX_CORRECTIONS,
+    max_chunk_chars=WRITING_MAX_CHUNK_CHARS,
+    concurrency=WRITING_CONCURRENCY,
+):
+    """
+    Correct a text chunk by chunk, with at most `concurrency` concurrent requests.
+
+    Yield (output, info) as the chunks are streamed: the output is the text with
+    its chunks replaced by their (partial) corrections in the original order, and
+    info counts the chunks. The chunks which fail, even after streaming part of
+    their correction, are kept as they are (and neither cached nor reused).
+
+    `corrections` is a dict (e.g. a session state) mapping the hashes of the chunks
+    (with the system message and the model) to their corrections: the chunks found
+    in it are not resent. It is updated with the corrections of this text, and
+    the least recently used ones beyond `max_corrections` are dropped.
+
+    The responses are cached (and reused) if `use_cache`, see `agenerate_new_text`.
+
+    The requests are scheduled with the other requests of `username`.
+    """
+    pieces = split_text(text, max_chunk_chars)
+    outputs = [piece for piece, _ in pieces]
+    chunk_indices = [i for i, (_, is_chunk) in enumerate(pieces) if is_chunk]
+
+    info = {
+        "chunks": len(chunk_indices),
+        "done": 0,
+        "reused": 0,
+        "cached": 0,
+        "failed": 0,
+    }
+    updated = asyncio.Event()
+    semaphore = asyncio.Semaphore(concurrency)
+    model_name = get_current_model()
+    correction_keys = {
+        index: make_correction_key(pieces[index][0], system_message, model_name)
+        for index in chunk_indices
+    }
+
+    async def correct_chunk(index):
+        chunk = pieces[index][0]
+        if corrections is not None and correction_keys[index] in corrections:
+            # move to the end: the dict is ordered from the least recently used
+            outputs[index] = corrections.pop(correction_keys[index])
+            corrections[correction_keys[index]] = outputs[index]
+            info["reused"] += 1
+            return
+
+        content = ""
+        # "error": of the stream, which may fail after some tokens, "cached"
+        request_info = {}
+        async with semaphore:
+            async for content in agenerate_new_text(
+                chunk,
+                [],
+                system_message=system_message,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                info=request_info,
+                username=username,
+                use_cache=use_cache,
+            ):
+                outputs[index] = content
+                updated.set()
+
+        if request_info.get("error"):
+            logging.warning(
+                "failed to correct chunk %d, keep it as it is: %s",
+                index,
+                request_info["error"],
+            )
+            outputs[index] = chunk
+            info["failed"] += 1
+        elif content.strip():
+            outputs[index] = content.strip()
+            if request_info.get("cached"):
+                info["cached"] += 1
+            if corrections is not None:
+                corrections[correction_keys[index]] = outputs[index]
+        else:
+            logging.warning("failed to correct chunk %d, keep it as it is", index)
+            outputs[index] = chunk
+            info["failed"] += 1
+
+    async def run_chunk(index):
+        try:
+            await correct_chunk(index)
+        except Exception as e:
+            logging.error("failed to correct chunk %d: %r", index, e)
+            outputs[index] = pieces[index][0]
+            info["failed"] += 1
+        finally:
+            info["done"] += 1
+            updated.set()
+
+    tasks = [asyncio.create_task(run_chunk(index)) for index in chunk_indices]
+    try:
+        while info["done"] < len(tasks):
+            await updated.wait()
+            updated.clear()
+            yield "".join(outputs), dict(info)
+        if not tasks:
+            yield "".join(outputs), dict(info)
+        if corrections is not None:
+            for key in list(corrections)[: max(0, len(corrections) - max_corrections)]:
+                del corrections[key]
+    finally:
+        for task in tasks:
+            task.cancel()
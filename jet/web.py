@@ -1,15 +1,15 @@
 import sys
+import signal
 import logging
+import threading
 from pathlib import Path
 
-import tabs
 import click
-import dotenv
-import gradio as gr
+from utils.config_utils import load_config
+from utils.profile_utils import StartupProfiler
 
 sys.path.append(str(Path(__file__).parent))
-dotenv.load_dotenv()
-logging.basicConfig(level=logging.INFO)
+load_config()
 
 
 @click.command()
@@ -20,8 +20,9 @@ logging.basicConfig(level=logging.INFO)
 )
 @click.option(
     "--num-chat-tabs",
-    default=5,
-    help="The number of chat tabs.",
+    type=int,
+    default=None,
+    help="Deprecated, ignored: the chat tab lists any number of conversations.",
 )
 @click.option(
     "--share/--no-share",
@@ -38,23 +39,109 @@ logging.basicConfig(level=logging.INFO)
     default="test",
     help="Password for basic auth.",
 )
-def main(bot_name, num_chat_tabs, auth_username, auth_password, share):
-    chat_tabs = [
-        tabs.create_chat_tab(tab_id=f"chattab{i+1}") for i in range(num_chat_tabs)
-    ]
-    chat_tab_names = [f"Chat {i+1}" for i in range(num_chat_tabs)]
-    writing_tab = tabs.create_writing_tab(tab_id="writingtab")
-    speech_tab = tabs.create_speech_tab(tab_id="speechtab")
-    demo = gr.TabbedInterface(
-        [*chat_tabs, writing_tab, speech_tab],
-        tab_names=[*chat_tab_names, "Writing", "Speech"],
-        css="footer {visibility: hidden}",
-        title=f"Chat with {bot_name} (HJY AI bot)",
-        theme=gr.themes.Soft(),
-    )
-    demo.queue().launch(
-        share=share, max_threads=10, auth=[(auth_username, auth_password)]
-    )
+@click.option(
+    "--auth-file",
+    type=click.Path(exists=True, dir_okay=False),
+    help="A file of 'username:password' lines, the users allowed instead of "
+    "--auth-username and --auth-password.",
+)
+@click.option(
+    "--max-threads",
+    default=10,
+    help="The number of threads running the (non async) event handlers.",
+)
+@click.option(
+    "--warmup/--no-warmup",
+    default=True,
+    help="Create the chat clients and connect to the api on startup.",
+)
+@click.option(
+    "--rate-limits",
+    default="",
+    help="The rate limits of the models, e.g. 'gpt-4=200/40000' for 200 requests "
+    "and 40000 tokens per minute (overrides OPENAI_RATE_LIMITS).",
+)
+@click.option(
+    "--metrics/--no-metrics",
+    default=True,
+    help="Serve the metrics in the Prometheus text format on /metrics.",
+)
+@click.option(
+    "--profile-startup",
+    is_flag=True,
+    help="Print the time taken by the imports and the construction of the app.",
+)
+def main(
+    bot_name,
+    num_chat_tabs,
+    auth_username,
+    auth_password,
+    auth_file,
+    max_threads,
+    share,
+    warmup,
+    rate_limits,
+    metrics,
+    profile_startup,
+):
+    if num_chat_tabs is not None:
+        logging.warning(
+            "--num-chat-tabs is deprecated and ignored, the chat tab lists the "
+            "conversations instead of %d fixed tabs",
+            num_chat_tabs,
+        )
+
+    # the heavy modules are imported here, so `--help` is fast and their import
+    # time shows in the profile
+    profiler = StartupProfiler()
+    with profiler.step("import gradio"):
+        import gradio as gr
+    with profiler.step("import tabs"):
+        import tabs
+        from utils import chat_utils, metrics_utils, persist_utils, schedule_utils
+
+    if rate_limits:
+        schedule_utils.set_rate_limits(rate_limits)
+
+    title = f"Chat with {bot_name} (HJY AI bot)"
+    # same layout as gr.TabbedInterface, the tabs are built in place
+    with profiler.step("build the app"), gr.Blocks(
+        css="footer {visibility: hidden}", title=title, theme=gr.themes.Soft()
+    ) as demo:
+        gr.Markdown(f"<h1 style='text-align: center; margin-bottom: 1rem'>{title}</h1>")
+        with gr.Tabs():
+            # a single chat tab listing the conversations, with the ids of the first
+            # of the former fixed chat tabs, so its persisted settings are kept
+            with profiler.step("build chat tab"), gr.Tab(label="Chat"):
+                tabs.create_chat_tab(tab_id="chattab1")
+            with profiler.step("build writing tab"), gr.Tab(label="Writing"):
+                tabs.create_writing_tab(tab_id="writingtab")
+            with profiler.step("build speech tab"), gr.Tab(label="Speech"):
+                tabs.create_speech_tab(tab_id="speechtab")
+        with profiler.step("hydrate"):
+            persist_utils.hydrate()
+    # exit normally on SIGTERM, so the buffered user states are flushed at exit
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    auth = [(auth_username, auth_password)]
+    if auth_file:
+        with open(auth_file) as f:
+            auth = [tuple(line.strip().split(":", 1)) for line in f if ":" in line]
+    with profiler.step("launch"):
+        demo.queue().launch(
+            share=share,
+            max_threads=max_threads,
+            auth=auth,
+            prevent_thread_lock=True,
+        )
+        if metrics:
+            metrics_utils.mount_metrics(demo.server_app)
+            metrics_utils.register_queue_metrics(demo)
+    if profile_startup:
+        print(profiler.report())
+    # after the launch, not to slow down the startup (langchain is imported here)
+    if warmup:
+        threading.Thread(target=chat_utils.warmup_chat_clients, daemon=True).start()
+    demo.block_thread()
 
 
 if __name__ == "__main__":
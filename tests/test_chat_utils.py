@@ -0,0 +1,56 @@
+import logging
+
+import pytest
+from utils import chat_utils
+from langchain.schema import HumanMessage, SystemMessage
+from utils.chat_utils import (
+    CHAT_MIN_MESSAGE_TOKENS,
+    ContextLengthError,
+    count_message_tokens,
+    fit_messages_to_context,
+)
+
+
+def test_max_tokens_beyond_the_context_keeps_the_last_message():
+    messages = [SystemMessage(content="Be brief."), HumanMessage(content="Hi " * 100)]
+    kept, info = fit_messages_to_context(messages, "gpt-4", max_tokens=32000)
+
+    assert kept == messages
+    assert info["cut_tokens"] == 0
+    assert 0 < info["reply_tokens"] < 8192
+    assert info["prompt_tokens"] + info["reply_tokens"] + 3 <= 8192
+
+
+def test_long_last_message_is_cut_to_the_minimum():
+    messages = [HumanMessage(content="word " * 20000)]
+    kept, info = fit_messages_to_context(messages, "gpt-4", max_tokens=32000)
+
+    assert info["cut_tokens"] > 0
+    assert count_message_tokens(kept[-1]) >= CHAT_MIN_MESSAGE_TOKENS
+
+
+def test_long_system_message_raises():
+    messages = [
+        SystemMessage(content="word " * 10000),
+        HumanMessage(content="Hello"),
+    ]
+    with pytest.raises(ContextLengthError, match="does not fit"):
+        fit_messages_to_context(messages, "gpt-4")
+
+
+def test_unknown_model_warns(caplog, monkeypatch):
+    monkeypatch.delenv("OPENAI_MODEL_CONTEXT_SIZES", raising=False)
+    with caplog.at_level(logging.WARNING):
+        context_size = chat_utils.get_context_size("my-deployment")
+    assert context_size == chat_utils.DEFAULT_CONTEXT_SIZE
+    assert "my-deployment" in caplog.text
+
+
+def test_token_counts_are_memoized_without_the_texts(monkeypatch):
+    monkeypatch.setattr(chat_utils, "_TOKEN_COUNTS", chat_utils.LRUCache(2))
+    text = "word " * 1000
+    assert chat_utils.count_tokens(text) == chat_utils.count_tokens(text)
+
+    stats = chat_utils._TOKEN_COUNTS.stats()
+    assert stats["entries"] == 1 and stats["hits"] == 1
+    assert all(len(key) == 16 for key in chat_utils._TOKEN_COUNTS._items)
@@ -0,0 +1,49 @@
+import pytest
+from utils import db_utils, conversation_utils
+from utils.db_utils import StateStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = StateStore(tmp_path / "state.sqlite")
+    monkeypatch.setattr(db_utils, "_STORE", store)
+    monkeypatch.setattr(conversation_utils, "_CONVERSATION_STORE", None)
+    monkeypatch.setattr(conversation_utils, "_MIGRATED_USERS", set())
+    yield store
+    store.close()
+
+
+def test_legacy_histories_are_listed(store):
+    history = [["Hello", "Hi!"], ["How are you?", "Fine."]]
+    db_utils.update_user_states(
+        "user", {"chattab2chat-chatbot": history, "chattab1chat-system-message": "s"}
+    )
+    db_utils.update_user_states("other", {"chattab1chat-chatbot": [["x", "y"]]})
+
+    conversations = conversation_utils.list_conversations("user")
+    assert [c["key"] for c in conversations] == ["chattab2chat-chatbot"]
+    assert conversations[0]["title"] == "Hello"
+    assert conversation_utils.load_histories("user", ["chattab2chat-chatbot"]) == {
+        "chattab2chat-chatbot": history
+    }
+
+
+def test_deleted_legacy_history_is_not_migrated_again(store):
+    db_utils.update_user_states("user", {"chattab1chat-chatbot": [["Hello", "Hi!"]]})
+    assert len(conversation_utils.list_conversations("user")) == 1
+    conversation_utils.delete_conversation("user", "chattab1chat-chatbot")
+
+    # as in a new process
+    conversation_utils._MIGRATED_USERS.clear()
+    assert conversation_utils.list_conversations("user") == []
+
+
+def test_late_save_does_not_recreate_deleted_conversation(store):
+    key = "conversation-1"
+    conversation_utils.save_histories("user", {key: [["Hello", "Hi"]]})
+    conversation_utils.delete_conversation("user", key)
+
+    # the last save of a reply still streamed when the conversation was deleted
+    conversation_utils.save_histories("user", {key: [["Hello", "Hi, how"]]})
+    assert conversation_utils.list_conversations("user") == []
+    assert conversation_utils.load_histories("user", [key]) == {}
@@ -0,0 +1,30 @@
+import threading
+
+from utils.db_utils import StateStore
+
+
+def test_read_racing_a_write_does_not_cache_stale_value(tmp_path):
+    store = StateStore(tmp_path / "state.sqlite", cache_bytes=1024 * 1024)
+    store.set_many({"key": "old"})
+    store.cache.clear()
+
+    put = store.cache.put
+    writer = None
+
+    def put_racing_a_write(key, blob, size):
+        # the read has checked that no write started, now a write starts before
+        # it caches what it read
+        nonlocal writer
+        if writer is None:
+            writer = threading.Thread(target=store.set_many, args=({"key": "new"},))
+            writer.start()
+            writer.join(0.2)
+        put(key, blob, size)
+
+    store.cache.put = put_racing_a_write
+    assert store.get_many(["key"]) == {"key": "old"}
+    writer.join()
+    store.cache.put = put
+
+    assert store.get_many(["key"]) == {"key": "new"}
+    store.close()
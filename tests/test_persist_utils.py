@@ -0,0 +1,55 @@
+import time
+import threading
+
+from utils.persist_utils import WriteBehindBuffer
+
+
+class RecordingStore:
+    def __init__(self):
+        self.values = {}
+        self.writes = []
+        self.threads = []
+
+    def write(self, username, mapping):
+        self.writes.append((username, dict(mapping)))
+        self.threads.append(threading.current_thread())
+        for key, value in mapping.items():
+            self.values[(username, key)] = value
+
+
+def test_direct_write_replaces_buffered_value():
+    store = RecordingStore()
+    buffer = WriteBehindBuffer(interval=60, write_fn=store.write)
+    buffer.put("user", "active", "conversation-a")
+    buffer.write("user", "active", "conversation-b")
+
+    assert not buffer.has("user", "active")
+    buffer.flush()
+    assert store.values[("user", "active")] == "conversation-b"
+
+
+def test_streamed_reply_is_written_once():
+    store = RecordingStore()
+    buffer = WriteBehindBuffer(interval=60, write_fn=store.write)
+    history = [["hello", ""]]
+    # one save per streamed token, then the flush at the end of the stream
+    for i in range(1000):
+        history = [["hello", history[0][1] + f"token{i} "]]
+        buffer.put("user", "chatbot", history)
+    buffer.flush()
+
+    assert len(store.writes) == 1
+    assert store.values[("user", "chatbot")] == history
+
+
+def test_max_updates_flush_in_the_background():
+    store = RecordingStore()
+    buffer = WriteBehindBuffer(interval=60, max_updates=3, write_fn=store.write)
+    for i in range(3):
+        buffer.put(f"user{i}", "chatbot", i)
+
+    deadline = time.monotonic() + 5
+    while len(store.writes) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(store.writes) == 3
+    assert threading.current_thread() not in store.threads
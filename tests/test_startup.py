@@ -0,0 +1,28 @@
+import sys
+import json
+import subprocess
+from pathlib import Path
+
+JET_DIR = Path(__file__).parent.parent / "jet"
+
+# generous: the import takes ~0.2 s, see benchmarks/bench_startup.py
+MAX_IMPORT_SECONDS = 3.0
+
+IMPORT_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import utils.chat_utils
+seconds = time.perf_counter() - start
+lazy = [name for name in ["langchain", "openai", "gradio"] if name in sys.modules]
+print(json.dumps({"seconds": seconds, "lazy_imported": lazy}))
+"""
+
+
+def test_chat_utils_imports_fast_without_the_heavy_modules():
+    output = subprocess.check_output(
+        [sys.executable, "-c", IMPORT_SCRIPT], cwd=JET_DIR, text=True
+    )
+    result = json.loads(output.splitlines()[-1])
+
+    assert result["lazy_imported"] == []
+    assert result["seconds"] < MAX_IMPORT_SECONDS
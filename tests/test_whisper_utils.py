@@ -0,0 +1,14 @@
+import numpy as np
+import pytest
+from utils.whisper_utils import split_audio
+
+
+@pytest.mark.parametrize("max_chunk_seconds", [0, 1e-4, 0.01, 0.5])
+def test_split_audio_with_tiny_chunks_advances(max_chunk_seconds):
+    sr = 16000
+    data = np.random.default_rng(0).normal(size=sr * 2).astype(np.float32)
+    bounds = split_audio(sr, data, max_chunk_seconds)
+
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(data)
+    for (start, end), (next_start, _) in zip(bounds, bounds[1:] + [(len(data), 0)]):
+        assert start < end == next_start
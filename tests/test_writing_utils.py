@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+from utils import db_utils, chat_utils
+from utils.db_utils import StateStore
+from utils.writing_utils import acorrect_text
+
+
+@pytest.fixture
+def response_cache(tmp_path, monkeypatch):
+    store = StateStore(tmp_path / "state.sqlite")
+    monkeypatch.setattr(db_utils, "_STORE", store)
+    monkeypatch.setattr(chat_utils, "_RESPONSE_CACHE", None)
+    yield chat_utils.get_response_cache()
+    store.close()
+
+
+async def correct(text, corrections, use_cache=True):
+    output, info = None, None
+    async for output, info in acorrect_text(
+        text, "Correct the text.", use_cache=use_cache, corrections=corrections
+    ):
+        pass
+    return output, info
+
+
+def test_stream_failing_midway_keeps_the_chunk(response_cache, monkeypatch):
+    async def arun_routed(model, run_attempt, on_token):
+        await on_token("Hello")
+        await on_token(" wor")
+        raise ConnectionError("connection reset")
+
+    monkeypatch.setattr(chat_utils, "arun_routed", arun_routed)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    corrections = {}
+    text = "helo world, how are you"
+
+    output, info = asyncio.run(correct(text, corrections))
+    assert output == text
+    assert info["failed"] == 1
+    assert corrections == {}
+    assert response_cache.stats()["disk"]["entries"] == 0
+
+
+class FakeChat:
+    """
+    Streams "Fixed: " and the message, and fails midway on the messages with "fail".
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    async def agenerate(self, messages, callbacks, **kwargs):
+        self.calls += 1
+        text = messages[0][-1].content
+        for token in ["Fixed: ", text[:4], text[4:]]:
+            if token == text[4:] and "fail" in text:
+                raise ConnectionError("connection reset")
+            await callbacks[0].on_llm_new_token(token)
+            await asyncio.sleep(0.01)  # the network, between the tokens
+
+
+def test_failed_chunks_fall_back_to_the_source(response_cache, monkeypatch):
+    async def arun_routed(model, run_attempt, on_token):
+        await run_attempt(None, on_token)
+
+    monkeypatch.setattr(chat_utils, "arun_routed", arun_routed)
+    monkeypatch.setattr(chat_utils, "get_chat", lambda **kwargs: FakeChat())
+    corrections = {}
+    text = "First paragraph.\n\nThis one will fail.\n\nThird paragraph."
+
+    output, info = asyncio.run(correct(text, corrections))
+    assert output == (
+        "Fixed: First paragraph.\n\nThis one will fail.\n\nFixed: Third paragraph."
+    )
+    assert info["failed"] == 1 and info["done"] == 3
+    assert sorted(corrections.values()) == [
+        "Fixed: First paragraph.",
+        "Fixed: Third paragraph.",
+    ]
+
+
+def test_responses_are_cached_on_opt_in(response_cache, monkeypatch):
+    async def arun_routed(model, run_attempt, on_token):
+        await run_attempt(None, on_token)
+
+    chat = FakeChat()
+    monkeypatch.setattr(chat_utils, "arun_routed", arun_routed)
+    monkeypatch.setattr(chat_utils, "get_chat", lambda **kwargs: chat)
+    text = "First paragraph."
+
+    # not by default, at the temperature 1.0
+    asyncio.run(correct(text, None, use_cache=None))
+    assert response_cache.stats()["disk"]["entries"] == 0
+
+    asyncio.run(correct(text, None))
+    output, info = asyncio.run(correct(text, None))
+    assert output == "Fixed: First paragraph."
+    assert info["cached"] == 1
+    assert chat.calls == 2